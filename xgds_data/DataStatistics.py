@@ -26,24 +26,30 @@ from django.db.models import (StdDev, fields)
 from xgds_data.models import cacheStatistics
 from xgds_data.introspection import (qualifiedModelName, isAbstract,
                                      modelFields, isNumeric, getModels,
-                                     resolveModel)
+                                     resolveModel, pk, db_table)
+from xgds_data.sketch import HyperLogLog
+from xgds_data.cache import Cache, timeout
 from django.conf import settings
 if cacheStatistics():
-    from xgds_data.models import ModelStatistic
+    from xgds_data.models import ModelStatistic, FieldSketch
 
-tableCounts = dict()
-tableCountsAge = dict()
-fieldCounts = dict()
-fieldCountsAge = dict()
+fieldCounts = Cache('fieldCounts')
 
-def timeout():
+
+def sharedStatistics():
     """
-    Get the timeout for the cache
+    The shared Django cache statistics are also kept in, so other processes
+    needn't work them out again (XGDS_DATA_SHARED_STATISTICS), or None
     """
-    try:
-        return settings.XGDS_DATA_CACHE_TIMEOUT
-    except AttributeError:
-        return 60
+    if not getattr(settings, 'XGDS_DATA_SHARED_STATISTICS', False):
+        return None
+    ## imported here because singleflight is only needed with a shared cache
+    from xgds_data.singleflight import sharedCache
+    return sharedCache()
+
+
+def statisticKey(qname, field, stat):
+    return 'xgds_data_stat:%s:%s:%s' % (qname, field, stat)
 
 
 def getStatistic(model, field, stat, statFn):
@@ -51,7 +57,15 @@ def getStatistic(model, field, stat, statFn):
     whatever it is
     """
     qname = qualifiedModelName(model)
+    if getattr(model, 'partitionOf', None) is not None:
+        ## a period table clone is reported as its model, but has its own statistics
+        qname = '%s:%s' % (qname, db_table(model))
     statVal = None
+    shared = sharedStatistics()
+    if shared is not None:
+        statVal = shared.get(statisticKey(qname, field, stat))
+        if statVal is not None:
+            return statVal
     if cacheStatistics():
         try:
             statVal = ModelStatistic.objects.filter(model=qname,field=field,statistic=stat)[0].value
@@ -71,6 +85,8 @@ def getStatistic(model, field, stat, statFn):
                                           model = qname,
                                           field = field,
                                           statistic = stat).delete()
+    if shared is not None:
+        shared.set(statisticKey(qname, field, stat), statVal, timeout())
 
     return statVal
 
@@ -86,32 +102,114 @@ def fieldSize(field, itemCount, maxItemCount, maxFieldCount):
     """
     Get table size either from cache or live
     """
-    estCount = None
-    try:
-        if timeout() is not None:
-            maxage = datetime.timedelta(seconds = timeout())
-            aged = datetime.datetime.now(pytz.utc) - fieldCountsAge[field]
-            if (aged < maxage):
-                estCount = fieldCounts[field]
-        else:
-            estCount = fieldCounts[field]
-    except KeyError: # not in cache yet
-        pass
-
+    estCount = fieldCounts.get(field)
+    shared = sharedStatistics()
+    if (estCount is None) and (shared is not None):
+        sharedKey = statisticKey(qualifiedModelName(field.model), field.name, 'distinct')
+        estCount = shared.get(sharedKey)
+        if estCount is not None:
+            fieldCounts.set(field, estCount)
     if estCount is None:
         try:
             estCount = tableSize(field.rel.to)
         except AttributeError:
             if (itemCount < maxItemCount):
                 estCount = itemCount
-            elif (itemCount < maxFieldCount):
-                estCount = field.model.objects.values(field.name).order_by().distinct().count()
+            else:
+                sketch = fieldSketch(field.model, field.name)
+                if sketch is not None:
+                    estCount = int(round(sketch.estimate()))
+                elif (itemCount < maxFieldCount):
+                    estCount = field.model.objects.values(field.name).order_by().distinct().count()
 
-        fieldCountsAge[field] = datetime.datetime.now(pytz.utc)
-        fieldCounts[field] = estCount
+        fieldCounts.set(field, estCount)
+        if (shared is not None) and (estCount is not None):
+            shared.set(sharedKey, estCount, timeout())
     return estCount
 
 
+def fieldSketch(model, fieldName):
+    """
+    Get the stored distinct value sketch for this field, if one has been built
+    """
+    if not cacheStatistics():
+        return None
+    try:
+        record = FieldSketch.objects.filter(model=qualifiedModelName(model),
+                                            field=fieldName).order_by('-recorded')[0]
+    except IndexError:
+        return None
+    return HyperLogLog.deserialize(record.registers, precision=record.precision)
+
+
+def sketchableFields(model):
+    """
+    Fields that get distinct value sketches; the others are ordinal or are
+    sized by their related table
+    """
+    sfields = []
+    for f in model._meta.fields:
+        if (f is pk(model)) or getattr(f, 'rel', None) is not None:
+            pass
+        elif isNumeric(model, f):
+            pass
+        else:
+            sfields.append(f)
+    return sfields
+
+
+def refreshSketch(model, field, rebuild=False, chunkSize=10000):
+    """
+    Fold rows added since the last refresh into the field's sketch, or
+    rebuild it from scratch. Returns the sketch.
+    """
+    qname = qualifiedModelName(model)
+    pkname = pk(model).attname
+    record = None
+    ## can only resume from integer keys
+    resumable = isinstance(pk(model), (fields.AutoField, fields.IntegerField))
+    if resumable and not rebuild:
+        try:
+            record = FieldSketch.objects.filter(model=qname,
+                                                field=field.name).order_by('-recorded')[0]
+        except IndexError:
+            pass
+    if record is None:
+        sketch = HyperLogLog()
+        maxPk = None
+    else:
+        sketch = HyperLogLog.deserialize(record.registers, precision=record.precision)
+        maxPk = record.maxPk
+
+    ## walk the table in primary key order so we can resume from maxPk later
+    while True:
+        rows = model.objects.order_by(pkname)
+        if maxPk is not None:
+            rows = rows.filter(**{pkname + '__gt': maxPk})
+        rows = list(rows.values_list(pkname, field.attname)[:chunkSize])
+        if len(rows) == 0:
+            break
+        for rowPk, val in rows:
+            sketch.add(val)
+        maxPk = rows[-1][0]
+        if len(rows) < chunkSize:
+            break
+
+    timestamp = datetime.datetime.now(pytz.utc)
+    FieldSketch.objects.create(recorded=timestamp,
+                               model=qname,
+                               field=field.name,
+                               precision=sketch.precision,
+                               registers=sketch.serialize(),
+                               maxPk=maxPk if resumable else None)
+    ## remove old entries
+    FieldSketch.objects.filter(recorded__lt=timestamp,
+                               model=qname,
+                               field=field.name).delete()
+    fieldCounts.pop(field)
+    return sketch
+
+
 def nextPercentile(model, fld, val, kind):
     """
     Returns the next percentile, else none
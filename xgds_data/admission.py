@@ -0,0 +1,183 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Admission control, so a few heavy searches can't take every database
+connection while cheap requests queue behind them.
+
+Each search is put in a cost class ('light', 'medium' or 'heavy') from
+the rows it is expected to touch: the table size, the fraction of the
+stored sample passing its hard constraints, and how many soft terms have
+to be scored for each of those rows (or the EXPLAIN cost, with
+XGDS_DATA_ADMISSION_EXPLAIN). Exports and plots, which fetch every match,
+go one class up. The cut-offs are XGDS_DATA_ADMISSION_COSTS.
+
+Each class runs at most XGDS_DATA_ADMISSION_SLOTS[class] searches at once
+per process, with at most XGDS_DATA_ADMISSION_QUEUE[class] more waiting up
+to XGDS_DATA_ADMISSION_WAIT seconds. Beyond that the request gets a 503
+with a Retry-After of XGDS_DATA_ADMISSION_RETRY_AFTER seconds. It is off
+unless XGDS_DATA_ADMISSION = True. Identical concurrent searches are
+coalesced first (see singleflight), so only the one that runs takes a slot.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.db.utils import DatabaseError
+
+from xgds_data.DataStatistics import tableSize
+from xgds_data.search import (reservoirMatches, desiredRanges, desiredSimilarities,
+                              getMatches)
+from xgds_data.limits import estimatedCost
+
+CLASSES = ('light', 'medium', 'heavy')
+DEFAULT_COSTS = {'light': 1E4, 'medium': 1E6}
+DEFAULT_SLOTS = {'light': 16, 'medium': 4, 'heavy': 2}
+DEFAULT_QUEUE = {'light': 64, 'medium': 16, 'heavy': 4}
+
+gates = dict()
+gatesLock = threading.Lock()
+
+
+class Overloaded(Exception):
+    def __init__(self, costClass, retryAfter):
+        Exception.__init__(self, 'Too many %s searches are running; please try again in %d seconds.'
+                           % (costClass, retryAfter))
+        self.costClass = costClass
+        self.retryAfter = retryAfter
+
+
+def admissionEnabled():
+    return getattr(settings, 'XGDS_DATA_ADMISSION', False)
+
+
+def classSetting(name, defaults, costClass):
+    return getattr(settings, name, defaults).get(costClass, defaults[costClass])
+
+
+def estimatedRows(model, qdatas, soft=True):
+    """
+    Rough number of rows a search reads and scores
+    """
+    if getattr(settings, 'XGDS_DATA_ADMISSION_EXPLAIN', False):
+        try:
+            cost = estimatedCost(getMatches(model, qdatas, threshold=1.0))
+            if cost is not None:
+                return cost
+        except (DatabaseError, AttributeError, KeyError, IndexError, ValueError):
+            pass  # fall back on the statistics
+    rows = tableSize(model) or 0
+    fraction = reservoirMatches(model, qdatas, soft=False)
+    if fraction is not None:
+        rows = rows * fraction
+    if soft:
+        rows = rows * (1 + len(desiredRanges(qdatas)) + len(desiredSimilarities(qdatas)))
+    return rows
+
+
+def costClass(model, qdatas, soft=True, fetchAll=False):
+    """
+    'light', 'medium' or 'heavy'; fetchAll for requests that read every match
+    """
+    try:
+        rows = estimatedRows(model, qdatas, soft=soft)
+    except Exception:
+        return 'medium'  # can't tell (e.g., an abstract model)
+    costs = getattr(settings, 'XGDS_DATA_ADMISSION_COSTS', DEFAULT_COSTS)
+    if rows <= costs.get('light', DEFAULT_COSTS['light']):
+        n = 0
+    elif rows <= costs.get('medium', DEFAULT_COSTS['medium']):
+        n = 1
+    else:
+        n = 2
+    if fetchAll:
+        n = min(n + 1, 2)
+    return CLASSES[n]
+
+
+class Gate(object):
+    """
+    A counting semaphore with a bounded, timed wait queue
+    """
+    def __init__(self, slots, queue):
+        self.slots = slots
+        self.queue = queue
+        self.running = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+
+    def enter(self, timeout):
+        giveUp = time.time() + timeout
+        with self.cond:
+            if self.running < self.slots:
+                self.running = self.running + 1
+                return True
+            if self.waiting >= self.queue:
+                return False
+            self.waiting = self.waiting + 1
+            try:
+                while self.running >= self.slots:
+                    remaining = giveUp - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+                self.running = self.running + 1
+                return True
+            finally:
+                self.waiting = self.waiting - 1
+
+    def leave(self):
+        with self.cond:
+            self.running = self.running - 1
+            self.cond.notify()
+
+
+def gate(costClass):
+    with gatesLock:
+        if costClass not in gates:
+            gates[costClass] = Gate(classSetting('XGDS_DATA_ADMISSION_SLOTS', DEFAULT_SLOTS, costClass),
+                                    classSetting('XGDS_DATA_ADMISSION_QUEUE', DEFAULT_QUEUE, costClass))
+        return gates[costClass]
+
+
+@contextmanager
+def admitted(model, qdatas, soft=True, fetchAll=False):
+    """
+    Run the enclosed search once its cost class has a free slot; raises
+    Overloaded if the queue is full or the wait runs out
+    """
+    if not admissionEnabled():
+        yield None
+        return
+    cls = costClass(model, qdatas, soft=soft, fetchAll=fetchAll)
+    g = gate(cls)
+    if not g.enter(getattr(settings, 'XGDS_DATA_ADMISSION_WAIT', 10)):
+        raise Overloaded(cls, getattr(settings, 'XGDS_DATA_ADMISSION_RETRY_AFTER', 5))
+    try:
+        yield cls
+    finally:
+        g.leave()
+
+
+def overloadedResponse(e):
+    response = HttpResponse(unicode(e), content_type='text/plain', status=503)
+    response['Retry-After'] = str(e.retryAfter)
+    return response
@@ -0,0 +1,60 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
+from django.db.backends.signals import connection_created
+from django.test.signals import setting_changed
+
+
+class XgdsDataConfig(AppConfig):
+    name = 'xgds_data'
+    verbose_name = 'xGDS Data'
+
+    def ready(self):
+        from xgds_data.introspection import buildRegistry, settingChangedHandler
+        buildRegistry()
+        setting_changed.connect(settingChangedHandler, dispatch_uid='xgds_data_registry')
+        from xgds_data.reservoir import reservoirInsertHandler
+        from xgds_data.textindex import trigramSaveHandler, trigramDeleteHandler
+        post_save.connect(reservoirInsertHandler, dispatch_uid='xgds_data_reservoir')
+        post_save.connect(trigramSaveHandler, dispatch_uid='xgds_data_trigram_save')
+        post_delete.connect(trigramDeleteHandler, dispatch_uid='xgds_data_trigram_delete')
+        from xgds_data.globalindex import globalSaveHandler, globalDeleteHandler
+        post_save.connect(globalSaveHandler, dispatch_uid='xgds_data_global_save')
+        post_delete.connect(globalDeleteHandler, dispatch_uid='xgds_data_global_delete')
+        from xgds_data.spatial import locationSaveHandler, locationDeleteHandler
+        post_save.connect(locationSaveHandler, dispatch_uid='xgds_data_location_save')
+        post_delete.connect(locationDeleteHandler, dispatch_uid='xgds_data_location_delete')
+        from xgds_data.knn import knnInsertHandler
+        post_save.connect(knnInsertHandler, dispatch_uid='xgds_data_knn')
+        from xgds_data.models import StandingQuery
+        from xgds_data.standing import standingInsertHandler, invalidateStandingQueries
+        post_save.connect(standingInsertHandler, dispatch_uid='xgds_data_standing')
+        post_save.connect(invalidateStandingQueries, sender=StandingQuery,
+                          dispatch_uid='xgds_data_standing_changed')
+        post_delete.connect(invalidateStandingQueries, sender=StandingQuery,
+                            dispatch_uid='xgds_data_standing_deleted')
+        from xgds_data.through import throughTypeHandler
+        post_save.connect(throughTypeHandler, dispatch_uid='xgds_data_through_types')
+        from xgds_data.mirror import registerFunctions
+        connection_created.connect(registerFunctions, dispatch_uid='xgds_data_sqlite_functions')
+        from xgds_data.singleflight import dataChangedHandler
+        post_save.connect(dataChangedHandler, dispatch_uid='xgds_data_version_save')
+        post_delete.connect(dataChangedHandler, dispatch_uid='xgds_data_version_delete')
+        from xgds_data.warmup import readyWarmUp
+        readyWarmUp()
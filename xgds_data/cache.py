@@ -0,0 +1,208 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+In-process caches that are safe to share between the threads of a
+threaded WSGI worker.
+
+Each Cache splits its keys over a number of stripes, each with its own
+lock, so threads only contend when they touch the same stripe. Entries
+expire after a time to live (XGDS_DATA_CACHE_TIMEOUT unless the cache
+says otherwise) and each cache holds a bounded number of entries, the
+least recently used going first. Sizes can be overridden per cache name
+with XGDS_DATA_CACHE_SIZES, e.g. {'query': 20}.
+"""
+
+import time
+import weakref
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+## every live cache, so they can be cleared or reported on together;
+## weak, so throwaway caches (in tests, say) don't pile up here
+caches = weakref.WeakSet()
+missing = object()
+
+
+def timeout():
+    """
+    Get the timeout for the cache
+    """
+    try:
+        return settings.XGDS_DATA_CACHE_TIMEOUT
+    except AttributeError:
+        return 60
+
+
+def cacheSize(name, default):
+    """
+    The configured entry limit of a cache, None for no limit
+    """
+    try:
+        return settings.XGDS_DATA_CACHE_SIZES.get(name, default)
+    except AttributeError:
+        return default
+
+
+class Stripe(object):
+    """
+    One lock and the entries it guards
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expiry, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+
+class Cache(object):
+    """
+    A thread safe, size limited cache with expiring entries. ttl is a number
+    of seconds, None for entries that never expire, or a function returning
+    either (by default the XGDS_DATA_CACHE_TIMEOUT setting).
+    """
+    def __init__(self, name, ttl=timeout, maxSize=1000, stripes=16):
+        self.name = name
+        self.ttl = ttl
+        self.maxSize = cacheSize(name, maxSize)
+        self.stripes = [Stripe() for i in range(stripes)]
+        if self.maxSize is None:
+            self.stripeSize = None
+        else:
+            ## the limit is kept per stripe, so it is approximate
+            self.stripeSize = max(1, (self.maxSize + stripes - 1) // stripes)
+        caches.add(self)
+
+    def stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def expiry(self):
+        ttl = self.ttl() if callable(self.ttl) else self.ttl
+        if ttl is None:
+            return None
+        return time.time() + ttl
+
+    def lookup(self, stripe, key):
+        """
+        The live value of key, or missing; call with the stripe lock held
+        """
+        try:
+            expires, value = stripe.entries.pop(key)
+        except KeyError:
+            stripe.misses += 1
+            return missing
+        if (expires is not None) and (expires <= time.time()):
+            stripe.misses += 1
+            return missing
+        ## put it back as the most recently used
+        stripe.entries[key] = (expires, value)
+        stripe.hits += 1
+        return value
+
+    def store(self, stripe, key, value):
+        """
+        Add or replace an entry; call with the stripe lock held
+        """
+        stripe.entries.pop(key, None)
+        stripe.entries[key] = (self.expiry(), value)
+        if self.stripeSize is not None:
+            while len(stripe.entries) > self.stripeSize:
+                stripe.entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        stripe = self.stripe(key)
+        with stripe.lock:
+            value = self.lookup(stripe, key)
+        return default if value is missing else value
+
+    def set(self, key, value):
+        stripe = self.stripe(key)
+        with stripe.lock:
+            self.store(stripe, key, value)
+
+    def pop(self, key, default=None):
+        stripe = self.stripe(key)
+        with stripe.lock:
+            expires, value = stripe.entries.pop(key, (None, missing))
+        if (value is missing) or ((expires is not None) and (expires <= time.time())):
+            return default
+        return value
+
+    def getOrCompute(self, key, compute):
+        """
+        The cached value, or compute() stored as the value. The computation
+        runs without holding a lock; if another thread stored a value in the
+        meantime, theirs is kept and returned.
+        """
+        stripe = self.stripe(key)
+        with stripe.lock:
+            value = self.lookup(stripe, key)
+        if value is not missing:
+            return value
+        value = compute()
+        with stripe.lock:
+            current = self.lookup(stripe, key)
+            if current is not missing:
+                return current
+            self.store(stripe, key, value)
+        return value
+
+    def __contains__(self, key):
+        stripe = self.stripe(key)
+        with stripe.lock:
+            return self.lookup(stripe, key) is not missing
+
+    def __len__(self):
+        return sum(len(s.entries) for s in self.stripes)
+
+    def purge(self):
+        """
+        Drop the expired entries
+        """
+        now = time.time()
+        for stripe in self.stripes:
+            with stripe.lock:
+                for key in [k for k, (expires, v) in stripe.entries.items()
+                            if (expires is not None) and (expires <= now)]:
+                    del stripe.entries[key]
+
+    def clear(self):
+        for stripe in self.stripes:
+            with stripe.lock:
+                stripe.entries.clear()
+
+    def stats(self):
+        return {'name': self.name,
+                'size': len(self),
+                'maxSize': self.maxSize,
+                'hits': sum(s.hits for s in self.stripes),
+                'misses': sum(s.misses for s in self.stripes)}
+
+
+def clearCaches():
+    """
+    Empty every cache, e.g. after a bulk load
+    """
+    for cache in list(caches):
+        cache.clear()
+
+
+def cacheStats():
+    return sorted([cache.stats() for cache in list(caches)], key=lambda s: s['name'])
@@ -52,6 +52,104 @@ XGDS_DATA_SEARCH_SKIP_APP_PATTERNS = (
 XGDS_DATA_MAX_PULLDOWNABLE = 100
 XGDS_DATA_MAX_SERIESABLE = 100
 
+# seconds before cached statistics, samples and query results are refreshed
+# (None keeps them until restart), and per-cache entry limits by cache name,
+# e.g. {'query': 20, 'fieldCounts': 5000}
+XGDS_DATA_CACHE_TIMEOUT = 60
+XGDS_DATA_CACHE_SIZES = {}
+
+# database aliases that searches, counts, samples and statistics scans may
+# read from (writes always go to the primary); needs
+# DATABASE_ROUTERS = ['xgds_data.routers.ReplicaRouter']. The policy is
+# 'round-robin' or 'lag', which skips replicas more than MAX_LAG seconds behind.
+XGDS_DATA_READ_REPLICAS = ()
+XGDS_DATA_REPLICA_POLICY = 'round-robin'
+XGDS_DATA_REPLICA_MAX_LAG = 30
+
+# database aliases (same schema, e.g. one per field campaign) that a model
+# is searched across, merged on score: {'ModelName': ['campaign1', 'campaign2']}
+XGDS_DATA_SEARCH_DATABASES = {}
+
+# models whose open searches are refreshed from a primary time field
+# watermark rather than the primary key, e.g. because concurrent inserts
+# can commit out of key order: {'ModelName': True}
+XGDS_DATA_TIME_WATERMARKS = {}
+
+# register the scoring functions (greatest, epoch conversion, distance, ...)
+# on SQLite connections, so searches run on an SQLite mirror
+XGDS_DATA_SQLITE_FUNCTIONS = True
+
+# identical searches running at the same time are only run once; name a
+# shared Django cache (CACHES alias) to extend that across processes.
+# Waiters run the search themselves after WAIT seconds.
+XGDS_DATA_SINGLE_FLIGHT = True
+XGDS_DATA_SINGLE_FLIGHT_CACHE = None
+XGDS_DATA_SINGLE_FLIGHT_WAIT = 60
+
+# admission control: searches are classed light/medium/heavy by the rows
+# they are expected to touch (up to COSTS['light'], up to COSTS['medium'],
+# more); each class gets SLOTS concurrent searches per process and QUEUE
+# waiting ones, which wait up to WAIT seconds before a 503 with Retry-After.
+# Off by default.
+XGDS_DATA_ADMISSION = False
+XGDS_DATA_ADMISSION_EXPLAIN = False
+XGDS_DATA_ADMISSION_COSTS = {'light': 1E4, 'medium': 1E6}
+XGDS_DATA_ADMISSION_SLOTS = {'light': 16, 'medium': 4, 'heavy': 2}
+XGDS_DATA_ADMISSION_QUEUE = {'light': 64, 'medium': 16, 'heavy': 4}
+XGDS_DATA_ADMISSION_WAIT = 10
+XGDS_DATA_ADMISSION_RETRY_AFTER = 5
+
+# run a page's counts, page query and prefetches side by side on a pool of
+# FETCH_WORKERS threads, each with its own database connection
+XGDS_DATA_CONCURRENT_FETCH = False
+XGDS_DATA_FETCH_WORKERS = 4
+
+# warm-up (./manage.py xgds_data_warmup, or at app ready with WARMUP_ON_READY):
+# builds the registry, through models, size estimates and search forms of
+# every searchable model ahead of the first searches, timing the imports of
+# WARMUP_MODULES; no new models are started after BUDGET seconds (None for
+# no limit). Only WARMUP_ON_READY warms the workers themselves; the command
+# runs in its own process and, with SHARED_STATISTICS, only leaves the table
+# and field size estimates (all the pulldown and series decisions need) in
+# the single flight shared cache for the workers.
+XGDS_DATA_WARMUP_ON_READY = False
+XGDS_DATA_WARMUP_BUDGET = None
+XGDS_DATA_WARMUP_MODULES = ['xgds_data.search', 'xgds_data.forms', 'xgds_data.views']
+XGDS_DATA_SHARED_STATISTICS = False
+
+# rows kept per model in the random sample used for estimates
+# (requires XGDS_DATA_CACHE_STATISTICS)
+XGDS_DATA_RESERVOIR_SIZE = 10000
+
+# threads used to run the searches of one batch request
+XGDS_DATA_BATCH_WORKERS = 4
+
+# background search and export jobs: worker threads, where results go
+# (defaults to a directory under the system temp dir), how long finished
+# jobs are kept (seconds) and how much space they may use (bytes). Jobs
+# still queued or running XGDS_DATA_JOB_GRACE seconds past the job deadline
+# (or the TTL, with no deadline) were lost with their worker; they are
+# marked failed and then expire.
+XGDS_DATA_JOB_WORKERS = 2
+# XGDS_DATA_JOB_DIR = '/var/lib/xgds/jobs'
+XGDS_DATA_JOB_TTL = 24 * 3600
+XGDS_DATA_JOB_QUOTA = 1024 * 1024 * 1024
+XGDS_DATA_JOB_GRACE = 3600
+
+# seconds a search may run before it is stopped with a "narrow your search"
+# message; per model in XGDS_DATA_SEARCH_DEADLINES = {'ModelName': seconds}.
+# Background jobs and CSV exports use XGDS_DATA_JOB_DEADLINE (no limit by
+# default).
+XGDS_DATA_SEARCH_DEADLINE = 30
+XGDS_DATA_SEARCH_DEADLINES = {}
+
+# largest EXPLAIN cost (rows scanned on SQLite) a search may have before it
+# is limited to the stored sample ('sample') or refused ('reject'); per
+# model in XGDS_DATA_SEARCH_COST_BUDGETS. None turns the check off.
+XGDS_DATA_SEARCH_COST_BUDGET = None
+XGDS_DATA_SEARCH_COST_BUDGETS = {}
+XGDS_DATA_SEARCH_OVER_BUDGET = 'sample'
+
 # possible fields to treat as the 'primary time field' for a model.
 # try in order until the model has one of the fields.
 XGDS_DATA_TIME_FIELDS = (
@@ -60,6 +158,43 @@ XGDS_DATA_TIME_FIELDS = (
     'timestamp',
 )
 
+# split large append-only models by their primary time field into one table
+# per 'day', 'month' or 'year', e.g.
+# XGDS_DATA_TIME_PARTITIONS['myapp'] = {'Telemetry': ['month']}
+# maintain the partitions with ./manage.py xgds_data_partition
+XGDS_DATA_TIME_PARTITIONS = getOrCreateDict('XGDS_DATA_TIME_PARTITIONS')
+
+# where ./manage.py xgds_data_knn keeps the nearest-neighbour indexes used by
+# "find similar" (defaults to a directory under the system temp dir), and
+# how many neighbours to show. Needs numpy.
+# XGDS_DATA_KNN_DIR = '/var/lib/xgds/knn'
+XGDS_DATA_KNN_NEIGHBORS = 100
+
+# latitude/longitude field pairs that get location search (box, radius, near),
+# e.g. XGDS_DATA_LATLON_FIELDS['myapp'] = {'Sample': [('latitude', 'longitude')]}
+# rows are filed under grid cells of XGDS_DATA_GEO_CELL_DEGREES; build them
+# with ./manage.py xgds_data_geoindex
+XGDS_DATA_LATLON_FIELDS = getOrCreateDict('XGDS_DATA_LATLON_FIELDS')
+XGDS_DATA_GEO_CELL_DEGREES = 0.1
+XGDS_DATA_GEO_MAX_CELLS = 2500
+
+# text fields to search through a full-text index, e.g.
+# XGDS_DATA_FULLTEXT_FIELDS['myapp'] = {'Note': ['content']}
+# build the indexes with ./manage.py xgds_data_textindex
+XGDS_DATA_FULLTEXT_FIELDS = getOrCreateDict('XGDS_DATA_FULLTEXT_FIELDS')
+XGDS_DATA_FULLTEXT_LANGUAGE = 'english'
+
+# identifier-like text fields to search by substring through a trigram index,
+# e.g. XGDS_DATA_TRIGRAM_FIELDS['myapp'] = {'Sample': ['name']}
+XGDS_DATA_TRIGRAM_FIELDS = getOrCreateDict('XGDS_DATA_TRIGRAM_FIELDS')
+
+# keep a single index across all searchable models for "search everything";
+# build it with ./manage.py xgds_data_globalindex. Numeric fields to include
+# go in XGDS_DATA_GLOBAL_NUMERIC_FIELDS, e.g.
+# XGDS_DATA_GLOBAL_NUMERIC_FIELDS['myapp'] = {'Reading': ['station']}
+XGDS_DATA_GLOBAL_INDEX = False
+XGDS_DATA_GLOBAL_NUMERIC_FIELDS = getOrCreateDict('XGDS_DATA_GLOBAL_NUMERIC_FIELDS')
+
 XGDS_DATA_MASKED_FIELDS = getOrCreateDict('XGDS_DATA_MASKED_FIELDS')
 XGDS_DATA_MASKED_FIELDS['auth']= {'User': ['password', 'is_staff', 'is_active', 'is_superuser',
                                            'last_login',
@@ -0,0 +1,200 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Searching one model across several databases with the same schema (e.g.,
+one per field campaign) as if they were one table.
+
+getMatches(..., databases=[alias, ...]) builds the scored query once per
+alias, with the same sort formula so scores are comparable, and returns a
+FederatedResults. Its counts and pages are fetched from every database at
+once on a small thread pool, so a search costs about as much as the
+slowest database, and pages are merged with a heap on the order each
+database sorts on (score, then the requested orders). Records keep
+the alias they came from, which fullid includes so retrieve can go back to
+the right database. A model's default aliases can be set with
+XGDS_DATA_SEARCH_DATABASES = {'ModelName': ['campaign1', 'campaign2']}.
+The merging itself (MergedResults) also serves searches that span several
+period tables of a partitioned model (see partition).
+"""
+
+import heapq
+from itertools import islice
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db.models import Model
+
+from xgds_data.introspection import resolveSetting
+from xgds_data.routers import replicaReads, closeConnections
+from xgds_data.limits import currentLimit, workerDeadline, waitForWorkers
+
+
+def searchDatabases(model):
+    """
+    The aliases a model is searched across by default, None for just the usual one
+    """
+    aliases = resolveSetting('XGDS_DATA_SEARCH_DATABASES', model, None)
+    if aliases:
+        return [a for a in aliases if a in settings.DATABASES]
+    return None
+
+
+def resultCount(results):
+    try:
+        return results.count()
+    except (AttributeError, TypeError):
+        return len(results)
+
+
+def orderValue(record, name):
+    """
+    The value of a record an order_by name sorts on, following __ lookups;
+    related records sort on their primary key
+    """
+    value = record
+    for part in name.lstrip('-').split('__'):
+        if value is None:
+            return None
+        value = getattr(value, part, None)
+    if isinstance(value, Model):
+        return value.pk
+    return value
+
+
+class Descending(object):
+    """
+    Wraps a value so it sorts the other way
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class MergedResults(object):
+    """
+    The results of several queries, each sorted best score first and then
+    in the given orders (order_by names), merged into one list in the same
+    order. Pages are fetched from every query at once, each only as far as
+    the page needs. The queries are named; each runs on the database alias
+    of its name, or on alias if given.
+    """
+    def __init__(self, model, queries, orders=(), alias=None):
+        self.model = model
+        self.queries = queries  # [(name, results)]
+        self.orders = ['-score'] + [o for o in orders if o.lstrip('-') != 'score']
+        self.alias = alias
+        self.sizes = None
+        self.fetched = [[] for q in queries]
+        self.exhausted = set()
+
+    def runAll(self, task):
+        """
+        Run task(n, results) for every query at once, each on its own
+        connection and under what is left of the caller's deadline
+        """
+        limit = currentLimit(self.model)
+
+        def run(n, name, results):
+            try:
+                with replicaReads(self.alias or name), workerDeadline(limit):
+                    return task(n, results)
+            finally:
+                closeConnections()
+
+        pool = ThreadPool(len(self.queries))
+        try:
+            return waitForWorkers(limit, [pool.apply_async(run, (n, name, results))
+                                          for n, (name, results) in enumerate(self.queries)])
+        finally:
+            pool.close()
+
+    def count(self):
+        if self.sizes is None:
+            self.sizes = OrderedDict(zip([name for name, q in self.queries],
+                                         self.runAll(lambda n, results: resultCount(results))))
+        return sum(self.sizes.values())
+
+    def __len__(self):
+        return self.count()
+
+    def fetch(self, size):
+        """
+        Make sure the best size rows (all rows if None) of every query are in hand
+        """
+        def top(n, results):
+            have = self.fetched[n]
+            if (n in self.exhausted) or ((size is not None) and (len(have) >= size)):
+                return have
+            rows = list(results[len(have):size] if size is not None else results[len(have):])
+            if (size is None) or (len(have) + len(rows) < size):
+                self.exhausted.add(n)
+            return have + rows
+
+        self.fetched = self.runAll(top)
+
+    def merged(self):
+        """
+        The fetched rows of all queries merged on the order each is sorted on
+        """
+        def key(r):
+            return tuple([Descending(orderValue(r, o)) if o.startswith('-') else orderValue(r, o)
+                          for o in self.orders])
+
+        def decorated(n, rows):
+            ## n and i break ties, so records are never compared
+            for i, r in enumerate(rows):
+                yield (key(r), n, i, r)
+
+        streams = [decorated(n, rows) for n, rows in enumerate(self.fetched)]
+        return (r for k, n, i, r in heapq.merge(*streams))
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            if k.step is not None:
+                raise ValueError('%s does not support slice steps' % self.__class__.__name__)
+            start = k.start or 0
+            self.fetch(k.stop)
+            return list(islice(self.merged(), start, k.stop))
+        rows = self[k:k + 1]
+        if not rows:
+            raise IndexError(k)
+        return rows[0]
+
+    def __iter__(self):
+        self.fetch(None)
+        return self.merged()
+
+
+class FederatedResults(MergedResults):
+    """
+    The results of one search on several databases, queries named by their
+    alias. count() is the total; counts has the count of each alias.
+    """
+    @property
+    def counts(self):
+        return self.sizes
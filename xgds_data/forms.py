@@ -14,7 +14,10 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
+import copy
+import datetime
 import pytz
+from collections import OrderedDict
 from django import forms
 from django.db import models
 from django.utils.safestring import mark_safe
@@ -29,8 +32,12 @@ except ImportError:
 
 from django.conf import settings
 from xgds_data.models import VirtualIncludedField
-from xgds_data.introspection import (modelFields, maskField, isOrdinalOveridden, isAbstract, pk, ordinalField, modelName, settingsForModel)
+from xgds_data.introspection import (modelFields, maskField, isOrdinalOveridden, isAbstract, pk, ordinalField, modelName, settingsForModel,
+                                     modelInfo, fieldPath)
 from xgds_data.DataStatistics import tableSize, fieldSize
+from xgds_data.cache import Cache
+from xgds_data.textindex import isFullTextField
+from xgds_data.spatial import spatialFormFields, latLonPairs, geoPrefix
 from xgds_data.utils import label
 # try:
 #     from geocamTrack.forms import AbstractImportTrackedForm
@@ -42,6 +49,10 @@ from xgds_data.utils import label
 
 # pylint: disable=R0924
 
+axesChoicesCache = Cache('axesChoices')
+## (model, enumerable fields) -> fields of its search form, see searchFormSchema
+searchFormCache = Cache('searchForm', maxSize=200)
+
 
 class QueryForm(forms.Form):
     query = forms.CharField(max_length=256, required=False,
@@ -110,6 +121,10 @@ def operatorFormField(mymodel, field, widget):
                             ('!=', '!='))
     textOperators = (('=', '='),
                      ('!=', '!='))
+    ## MATCH uses the text index, = remains a substring match
+    ## =~ ranks by text similarity rather than filtering
+    similarTextOperators = textOperators + (('=~', '=~'),)
+    fullTextOperators = (('MATCH', 'MATCH'),) + similarTextOperators
     if widget is 'pulldown':
         return forms.ChoiceField(choices=categoricalOperators,
                                  initial=categoricalOperators[0][0],
@@ -122,6 +137,14 @@ def operatorFormField(mymodel, field, widget):
         return forms.ChoiceField(choices=rangeOperators,
                                  initial=rangeOperators[0][0],
                                  required=True)
+    elif isinstance(field, (models.CharField, models.TextField)) and isFullTextField(mymodel, field):
+        return forms.ChoiceField(choices=fullTextOperators,
+                                 initial=fullTextOperators[0][0],
+                                 required=True)
+    elif isinstance(field, (models.CharField, models.TextField)) and not isOrdinalOveridden(mymodel, field):
+        return forms.ChoiceField(choices=similarTextOperators,
+                                 initial=similarTextOperators[0][0],
+                                 required=True)
     elif isinstance(field, (models.AutoField, models.CharField, models.TextField)) or isOrdinalOveridden(mymodel, field):
         return forms.ChoiceField(choices=textOperators,
                                  initial=textOperators[0][0],
@@ -271,6 +294,25 @@ def searchFormFields(mymodel, field, enumerableFields,
     return formfields
 
 
+def searchFormSchema(mymodel, enumerableFields=None, queryGenerator=None):
+    """
+    The fields of a search form on this model. Without a queryGenerator they
+    are built once (the pulldown choices need size estimates) and each form
+    gets its own copy, as with a form's base_fields.
+    """
+    def build():
+        formfields = OrderedDict()
+        for field in modelFields(mymodel):
+            formfields.update(searchFormFields(mymodel, field, enumerableFields, queryGenerator=queryGenerator))
+        formfields.update(spatialFormFields(mymodel))
+        return formfields
+
+    if queryGenerator is not None:
+        return build()
+    key = (mymodel, tuple(enumerableFields) if enumerableFields else None)
+    return copy.deepcopy(searchFormCache.getOrCompute(key, build))
+
+
 class SearchForm(forms.Form):
     """
     Dynamically creates a form to search the given class
@@ -281,13 +323,12 @@ class SearchForm(forms.Form):
         forms.Form.__init__(self, *args, **kwargs)
         self.model = mymodel
 
-        for field in modelFields(mymodel):
-            self.fields.update(searchFormFields(mymodel, field, enumerableFields, queryGenerator=queryGenerator))
+        self.fields.update(searchFormSchema(mymodel, enumerableFields, queryGenerator=queryGenerator))
 
     def as_table(self, expert=False):
         output = []
 
-        fieldmap = dict([(f.name, f) for f in modelFields(self.model)])
+        fieldmap = modelInfo(self.model).fieldsByName
         print(self.model)
         for ffield in self.fields:
             if ffield.endswith('_operator'):
@@ -300,7 +341,7 @@ class SearchForm(forms.Form):
                     mfield = fieldmap[basename]
                 except KeyError:
                     ## foreign key branch
-                    mfield = fieldmap[basename.split('__')[0]]
+                    mfield = fieldmap[fieldPath(self.model, basename).names[0]]
 
                 ofield = forms.forms.BoundField(self, self.fields[ffield], ffield)
                 if not expert:
@@ -337,6 +378,15 @@ class SearchForm(forms.Form):
                     row = row + u'</tr>'
                     output.append(row)
 
+        for pair in latLonPairs(self.model):
+            prefix = geoPrefix(pair)
+            bound = dict([(name, unicode(forms.forms.BoundField(self, self.fields[prefix + '_' + name], prefix + '_' + name)))
+                          for name in ('shape', 'lat', 'lon', 'km', 'south', 'west', 'north', 'east')])
+            bound['label'] = unicode(fieldmap[pair[0]].verbose_name) + u' / ' + unicode(fieldmap[pair[1]].verbose_name)
+            output.append(u'<tr><td style="text-align:right;">%(label)s</td><td>%(shape)s</td>'
+                          u'<td colspan=3>%(km)s km of %(lat)s, %(lon)s<br/>'
+                          u'or box %(south)s S %(west)s W %(north)s N %(east)s E</td></tr>' % bound)
+
         return mark_safe(u'\n'.join(output))
 
     def as_expert_table(self):
@@ -468,6 +518,53 @@ def SpecializedForm(formModel, myModel, queryGenerator=None):
     return tmpFormClass
 
 
+def axesFieldChoices(mfields):
+    """
+    Figure out which fields can be plotted as axes and which can be plot series.
+    Cached per model, as the series decision needs field size estimates.
+    """
+    try:
+        mymodel = mfields[0].model
+    except (IndexError, AttributeError):
+        mymodel = None
+    cacheKey = (mymodel, tuple(x.name for x in mfields))
+    choices = axesChoicesCache.get(cacheKey)
+    if choices is not None:
+        return choices
+
+    chartablefields = []
+    seriesablefields = []
+    itemCount = None
+    try:
+        itemCount = tableSize(mymodel)  # an upper bound
+    except AttributeError:
+        pass  # no fields, apparently
+    try:
+        maxseriesable = settings.XGDS_DATA_MAX_SERIESABLE
+    except AttributeError:
+        maxseriesable = 100
+
+    for x in mfields:
+        if (not isinstance(x, VirtualIncludedField)) and (not maskField(x)):
+            if ordinalField(x.model, x):
+                chartablefields.append(x)
+            elif ((isinstance(x, GenericForeignKey)) or
+                  (isAbstract(x.model)) or
+                  (itemCount is None)):
+                pass
+            else:
+                estCount = fieldSize(x,
+                                     tableSize(x.model),
+                                     maxseriesable,
+                                     maxseriesable * 1000)
+                if (estCount is not None) and (estCount <= maxseriesable):
+                    seriesablefields.append(x)
+
+    choices = (chartablefields, seriesablefields)
+    axesChoicesCache.set(cacheKey, choices)
+    return choices
+
+
 class AxesForm(forms.Form):
     """
     Dynamically creates the form to choose the axes and series of a corresponding plot
@@ -475,38 +572,14 @@ class AxesForm(forms.Form):
     def __init__(self, mfields, *args, **kwargs):
         seriesablefields = kwargs.pop('seriesablefields', None)
         forms.Form.__init__(self, *args, **kwargs)
-        chartablefields = []
 
         if (seriesablefields is None):
-            seriesablePreset = False
-            seriesablefields = []
-            try:
-                itemCount = tableSize(mfields[0].model)  # an upper bound
-            except (IndexError,AttributeError):
-                pass  # no fields, apparently
-            try:
-                maxseriesable = settings.XGDS_DATA_MAX_SERIESABLE
-            except AttributeError:
-                maxseriesable = 100
+            chartablefields, seriesablefields = axesFieldChoices(mfields)
         else:
-            seriesablePreset = True
-
-        for x in mfields:
-            if (not isinstance(x, VirtualIncludedField)) and (not maskField(x)):
-                if ordinalField(x.model, x):
-                    chartablefields.append(x)
-                elif ((seriesablePreset) or
-                      (isinstance(x, GenericForeignKey)) or
-                      (isAbstract(x.model)) or
-                      (itemCount is None)):
-                    pass
-                else:
-                    estCount = fieldSize(x,
-                                         tableSize(x.model),
-                                          maxseriesable,
-                                          maxseriesable * 1000)
-                    if (estCount is not None) and (estCount <= maxseriesable):
-                        seriesablefields.append(x)
+            chartablefields = [x for x in mfields
+                               if ((not isinstance(x, VirtualIncludedField)) and
+                                   (not maskField(x)) and
+                                   ordinalField(x.model, x))]
 
         if len(chartablefields) > 1:
             datachoices = (tuple((x, x)
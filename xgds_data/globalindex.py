@@ -0,0 +1,203 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+A single denormalized index across all searchable models, so that one
+query ("station 12 last Tuesday") can return a ranked mixed-model list
+without searching each model separately.
+
+Each record contributes the words of its text fields, its model name, the
+fields listed in XGDS_DATA_GLOBAL_NUMERIC_FIELDS and its primary time
+(from XGDS_DATA_TIME_FIELDS). The index is enabled with
+XGDS_DATA_GLOBAL_INDEX, kept current by signals and built with
+./manage.py xgds_data_globalindex.
+"""
+
+import re
+
+from django.db import transaction
+from django.db.models import Q, Count, Max, fields
+from django.conf import settings
+
+from xgds_data.introspection import (settingsForModel, isSkippedApp, maskField,
+                                     moduleName, modelName, fullid, pk, getPrimaryTimeField,
+                                     isAbstract)
+from xgds_data.models import GlobalSearchTerm
+from xgds_data.reservoir import comparableValue
+
+wordPattern = re.compile(r'\w+', re.UNICODE)
+## name:value or name:low..high in a query is a numeric field constraint
+numericPattern = re.compile(r'^(\w+):(-?[\d.]+)(?:\.\.(-?[\d.]+))?$', re.UNICODE)
+
+
+def globalIndexEnabled():
+    try:
+        return settings.XGDS_DATA_GLOBAL_INDEX
+    except AttributeError:
+        return False
+
+
+def isGloballyIndexed(model):
+    """
+    Does this model belong in the global index?
+    """
+    return ((moduleName(model) != 'xgds_data') and
+            (not isSkippedApp(moduleName(model))) and
+            (not isAbstract(model)) and
+            (not model._meta.proxy))
+
+
+def globalNumericFields(model):
+    try:
+        names = settingsForModel(settings.XGDS_DATA_GLOBAL_NUMERIC_FIELDS, model)
+    except AttributeError:
+        return []
+    return [f for f in model._meta.fields if f.name in names]
+
+
+def globalTextFields(model):
+    return [f for f in model._meta.fields
+            if isinstance(f, (fields.CharField, fields.TextField)) and not maskField(f)]
+
+
+def words(text):
+    return [w.lower()[:64] for w in wordPattern.findall(text)]
+
+
+def recordTerms(instance):
+    """
+    The index rows for one record
+    """
+    model = instance.__class__
+    fid = fullid(instance)
+    timeField = getPrimaryTimeField(model)
+    epoch = None
+    if timeField is not None:
+        epoch = comparableValue(getattr(instance, timeField))
+        if not isinstance(epoch, (int, long, float)):
+            epoch = None
+    terms = set(words(model._meta.verbose_name))
+    for f in globalTextFields(model):
+        val = getattr(instance, f.attname)
+        if val:
+            terms.update(words(u'%s' % val))
+    result = [GlobalSearchTerm(fullid=fid, term=t, epoch=epoch) for t in terms]
+    for f in globalNumericFields(model):
+        val = comparableValue(getattr(instance, f.attname))
+        if isinstance(val, (int, long, float)):
+            result.append(GlobalSearchTerm(fullid=fid, term=f.name.lower()[:64],
+                                           number=val, epoch=epoch))
+    return result
+
+
+def indexRecord(instance):
+    with transaction.atomic():
+        GlobalSearchTerm.objects.filter(fullid=fullid(instance)).delete()
+        GlobalSearchTerm.objects.bulk_create(recordTerms(instance))
+
+
+def rebuildGlobalIndex(model, chunkSize=1000):
+    """
+    Reindex every record of the model
+    """
+    prefix = '%s:%s:' % (moduleName(model), modelName(model))
+    GlobalSearchTerm.objects.filter(fullid__startswith=prefix).delete()
+    terms = []
+    rows = 0
+    for instance in model.objects.order_by(pk(model).name).iterator():
+        rows = rows + 1
+        terms.extend(recordTerms(instance))
+        if len(terms) >= chunkSize:
+            GlobalSearchTerm.objects.bulk_create(terms)
+            terms = []
+    GlobalSearchTerm.objects.bulk_create(terms)
+    return rows
+
+
+def globalSaveHandler(sender, instance, raw=False, **kwargs):
+    """
+    post_save handler that keeps the global index current
+    """
+    if globalIndexEnabled() and (not raw) and isGloballyIndexed(sender):
+        indexRecord(instance)
+
+
+def globalDeleteHandler(sender, instance, **kwargs):
+    """
+    post_delete handler that keeps the global index current
+    """
+    if globalIndexEnabled() and isGloballyIndexed(sender):
+        GlobalSearchTerm.objects.filter(fullid=fullid(instance)).delete()
+
+
+def parseGlobalQuery(text):
+    """
+    Split a query into plain words and numeric constraints {name: (low, high)}
+    """
+    plain = []
+    numeric = dict()
+    for token in text.split():
+        m = numericPattern.match(token)
+        if m:
+            low = float(m.group(2))
+            high = float(m.group(3)) if m.group(3) else low
+            numeric[m.group(1).lower()] = (min(low, high), max(low, high))
+        else:
+            plain.extend(words(token))
+    return plain, numeric
+
+
+def globalMatches(text, start=None, end=None, limit=50):
+    """
+    Ranked fullids of the records matching the most query terms within
+    the time bounds (epoch seconds), most recent first among ties
+    """
+    plain, numeric = parseGlobalQuery(text)
+    clause = Q()
+    if plain:
+        clause = clause | Q(term__in=plain)
+    for name, (low, high) in numeric.items():
+        clause = clause | Q(term=name, number__gte=low, number__lte=high)
+    terms = GlobalSearchTerm.objects.all()
+    if plain or numeric:
+        terms = terms.filter(clause)
+    if start is not None:
+        terms = terms.filter(epoch__gte=start)
+    if end is not None:
+        terms = terms.filter(epoch__lte=end)
+    ranked = (terms.values('fullid')
+              .annotate(hits=Count('term', distinct=True), latest=Max('epoch'))
+              .order_by('-hits', '-latest')[:limit])
+    return [(r['fullid'], r['hits']) for r in ranked]
+
+
+def globalSearch(text, start=None, end=None, limit=50):
+    """
+    The matching records themselves, loaded in bulk, with their number of matching terms
+    """
+    ## imported here because search imports from most of the package
+    from xgds_data.search import retrieve
+    ranked = globalMatches(text, start=start, end=end, limit=limit)
+    fullids = [fid for fid, hits in ranked]
+    try:
+        records = retrieve(fullids)
+    except KeyError:
+        ## index is ahead of a deletion; drop what's missing
+        found = dict([(fullid(r), r) for qs in retrieve(fullids, flat=False) for r in qs])
+        records = [found.get(fid) for fid in fullids]
+    return [(rec, hits) for rec, (fid, hits) in zip(records, ranked) if rec is not None]
@@ -14,13 +14,15 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
+import re
+
 try:
     from taggit.managers import TaggableManager
 except (ImportError, RuntimeError):
     pass
 
 from django.conf import settings
-from django.db.models import fields
+from django.db.models import fields, Model
 try:
     from django.apps import apps
 except ImportError:
@@ -28,12 +30,92 @@ except ImportError:
 
 #from xgds_data.models import VirtualIncludedField
 import xgds_data.models
+from xgds_data.routers import isPrimaryCopy
+
+## model -> ModelInfo, filled at app ready (see buildRegistry) and on first use
+registry = {}
+## (id(setting), model) -> (setting, list)
+settingsCache = {}
+
+
+class ModelInfo(object):
+    """
+    What the introspection helpers need about a model, worked out once:
+    its fields, which are masked or ordinal, and the unmasked ones shown
+    in results
+    """
+    def __init__(self, model):
+        self.model = model
+        self.fields = buildModelFields(model)
+        ## the first field wins, as in the old scan
+        self.fieldsByName = dict([(f.name, f) for f in reversed(self.fields)])
+        self.nonordinal = frozenset(settingsList('XGDS_DATA_NONORDINAL_FIELDS', model))
+        self.masked = dict([(f.name, computeMaskField(f)) for f in self.fields])
+        ## virtual fields are left out, as their through models depend on the data
+        self.ordinal = dict([(f.name, (f.name not in self.nonordinal) and computeOrdinalField(model, f))
+                             for f in self.fields
+                             if not isinstance(f, xgds_data.models.VirtualIncludedField)])
+        self.visibleFields = tuple([f for f in self.fields if not self.masked[f.name]])
+        ## filled on first use; related models may not all be loaded yet
+        self.accessors = None
+        self.paths = {}
+
+    def owns(self, field):
+        return self.fieldsByName.get(field.name) is field
+
+
+def modelInfo(model):
+    """
+    The registry entry for this model (or the instance's model)
+    """
+    if not isinstance(model, type):
+        model = type(model)
+    info = registry.get(model)
+    if info is None:
+        info = registry.setdefault(model, ModelInfo(model))
+    return info
+
+
+def buildRegistry():
+    """
+    Fill the registry for every installed model
+    """
+    for model in apps.get_models():
+        modelInfo(model)
+
+
+def clearRegistry():
+    registry.clear()
+    settingsCache.clear()
+
+
+def settingChangedHandler(setting=None, **kwargs):
+    """
+    The registry is built from the XGDS_DATA settings, so start over when they change
+    """
+    if setting and setting.startswith('XGDS_DATA_'):
+        clearRegistry()
+
+
+def settingsList(settingName, model):
+    try:
+        return settingsForModel(getattr(settings, settingName), model)
+    except AttributeError:
+        return []
 
 
 def settingsForModel(settng, model):
     """
     Does the setting list this field?
     """
+    key = (id(settng), model)
+    try:
+        cached, mysettings = settingsCache[key]
+        if cached is settng:
+            return mysettings
+    except KeyError:
+        pass
+
     mysettings = []
     for amodel in model.__mro__:
         try:
@@ -41,6 +123,7 @@ def settingsForModel(settng, model):
         except (AttributeError, KeyError):
             pass
 
+    settingsCache[key] = (settng, mysettings)
     return mysettings
 
 
@@ -48,6 +131,13 @@ def accessorDict(model):
     """
     returns a dict of accessor, base relation parts that can be used on this model
     """
+    info = modelInfo(model)
+    if info.accessors is None:
+        info.accessors = buildAccessorDict(model)
+    return info.accessors
+
+
+def buildAccessorDict(model):
     ad = dict([(x.name, x) for x in model._meta.fields])
     ad.update(dict([(x.name, x) for x in model._meta.many_to_many]))
     ## do we need virtual_fields? Not sure what those are
@@ -57,10 +147,75 @@ def accessorDict(model):
     return ad
 
 
+class FieldPath(object):
+    """
+    An 'a__b__c' lookup path on a model, worked out once (see fieldPath):
+    the relations it goes through, for filters, and its value on a record
+    """
+    def __init__(self, model, path):
+        self.model = model
+        self.path = path
+        self.names = tuple(path.split('__'))
+        self.chain = None
+
+    def relations(self):
+        """
+        The relation (field, or inverse) for each part of the path; KeyError if it doesn't resolve
+        """
+        if self.chain is None:
+            chain = []
+            model = self.model
+            for name in self.names:
+                ## "relation" because it's not necessarily field, could be inverse
+                relation = accessorDict(model)[name]
+                chain.append(relation)
+                try:
+                    model = relation.rel.to
+                except AttributeError:
+                    model = relation.model
+            self.chain = tuple(chain)
+        return self.chain
+
+    def value(self, record):
+        """
+        Follow the path from this record, stopping at a missing link
+        """
+        for name in self.names:
+            if record is None:
+                return None
+            record = getattr(record, name)
+        return record
+
+
+def fieldPath(model, path):
+    """
+    The compiled lookup path on this model
+    """
+    paths = modelInfo(model).paths
+    fp = paths.get(path)
+    if fp is None:
+        fp = paths.setdefault(path, FieldPath(model, path))
+    return fp
+
+
 def modelFields(model):
     """
     Retrieve the fields associated with the given model
     """
+    return modelInfo(model).fields
+
+
+def visibleFields(model):
+    """
+    The fields of the model that aren't masked, for search and display
+    """
+    return modelInfo(model).visibleFields
+
+
+def buildModelFields(model):
+    """
+    Work out the fields associated with the given model (see modelFields)
+    """
     fields = model._meta.fields
     many_to_many = model._meta.many_to_many
     virtual_fields = model._meta.virtual_fields
@@ -90,7 +245,7 @@ def modelFields(model):
         else:
             print("Error- VirtualField {0} on {1} references nonexistent field {2}".format(relVerboseName, modelName(model), throughFieldName))
 
-    return myfields
+    return tuple(myfields)
 
 
 def isAbstract(model):
@@ -121,11 +276,19 @@ def pkValue(instance):
             return pkval
 
 
+def reportedModel(model):
+    """
+    The model records of this model (or instance) are shown and linked as;
+    the model itself, except for period table clones (see partition)
+    """
+    return getattr(model, 'partitionOf', None) or model
+
+
 def modelName(model):
     """
     return the short name of the model (or of the instance's model)
     """
-    return concrete_model(model)._meta.object_name
+    return concrete_model(reportedModel(model))._meta.object_name
 
 
 def qualifiedModelName(model):
@@ -139,7 +302,7 @@ def moduleName(model):
     """
     return the short name of the module (or of the instance's module)
     """
-    return model._meta.app_label
+    return reportedModel(model)._meta.app_label
 
 
 def verbose_name(model):
@@ -188,6 +351,68 @@ def getModels(moduleName):
         return get_models(get_app(moduleName))
 
 
+def isSkippedApp(appName):
+    """
+    Is this app excluded from search?
+    """
+    try:
+        return any((re.match(p, appName) for p in settings.XGDS_DATA_SEARCH_SKIP_APP_PATTERNS))
+    except AttributeError:
+        return (appName.find('django') > -1)
+
+
+def searchableModels(moduleName=None):
+    """
+    The concrete models that can be searched, optionally just those of one module
+    """
+    if moduleName is None:
+        moduleNames = [re.sub(r'\.models$', '', app) for app in getModuleNames()]
+        moduleNames = [app for app in moduleNames if not isSkippedApp(app)]
+    else:
+        moduleNames = [moduleName]
+    models = []
+    for mname in moduleNames:
+        try:
+            models.extend([m for m in getModels(mname) if not isAbstract(m)])
+        except LookupError:
+            pass  # not an app with models
+    return models
+
+
+def getPrimaryTimeField(model):
+    fieldDict = dict([(f.name, f)
+                      for f in model._meta.fields])
+    try:
+        for f in settings.XGDS_DATA_TIME_FIELDS:
+            if f in fieldDict:
+                return f
+    except AttributeError:
+        pass  # no worries
+    return None
+
+
+def resolveSetting(configName, myModel, defaultSetting, override=None):
+    """
+    Figures out whether a specialized setting exists, or if the default should be used
+    """
+    setting = None
+    if override:
+        oconfig = override.get(configName,None)
+    else:
+        oconfig = None
+    config = getattr(settings, configName, None)
+    for model in myModel.__mro__:
+        if issubclass(model, Model) and model != Model:
+            if not setting and oconfig:
+                setting = oconfig.get(model._meta.object_name, None)
+            if not setting and config:
+                setting = config.get(model._meta.object_name, None)
+    if setting:
+        return setting
+    else:
+        return defaultSetting
+
+
 def resolveModel(moduleName, modelName):
     """
     Return the model with this name
@@ -207,17 +432,23 @@ def resolveField(model, fieldName):
     """
     Retrieve the field corresponding to the the name, if any
     """
-    for f in modelFields(model):
-        if (fieldName == f.name):
-            return f
-
-    return None
+    return modelInfo(model).fieldsByName.get(fieldName)
 
 
 def maskField(field):
     """
     Should we omit this field from search and display?
     """
+    try:
+        info = modelInfo(field.model)
+    except AttributeError:
+        info = None
+    if (info is not None) and info.owns(field):
+        return info.masked[field.name]
+    return computeMaskField(field)
+
+
+def computeMaskField(field):
     try:
         if isinstance(field, TaggableManager):
             return True
@@ -252,10 +483,7 @@ def isOrdinalOveridden(model, field):
     """
     Is this a field that looks ordinal, but isn't really?
     """
-    try:
-        return field.name in settingsForModel(settings.XGDS_DATA_NONORDINAL_FIELDS, model)
-    except AttributeError:
-        return False
+    return field.name in modelInfo(model).nonordinal
 
 
 def isNumeric(model, field):
@@ -295,9 +523,19 @@ def ordinalField(model, field):
     """
     Does this field support ranges?
     """
-    if isOrdinalOveridden(model, field):
+    info = modelInfo(model)
+    if info.owns(field) and (field.name in info.ordinal):
+        return info.ordinal[field.name]
+    elif field.name in info.nonordinal:
         return False
-    elif isinstance(field, xgds_data.models.VirtualIncludedField):
+    return computeOrdinalField(model, field)
+
+
+def computeOrdinalField(model, field):
+    """
+    ordinalField, leaving out the settings override
+    """
+    if isinstance(field, xgds_data.models.VirtualIncludedField):
         if len(field.targetFields()):
             for tmf in field.targetFields():
                 if not ordinalField(tmf.model, tmf):
@@ -339,8 +577,15 @@ def concrete_model(model):
 
 
 def fullid(record):
-    """An id that includes class info"""
-    return '%s:%s:%s' % (moduleName(record),
-                         modelName(record),
-                         record.pk)
+    """
+    An id that includes class info, and the database alias for records
+    from a database other than the primary (see federation)
+    """
+    fid = '%s:%s:%s' % (moduleName(record),
+                        modelName(record),
+                        record.pk)
+    db = getattr(getattr(record, '_state', None), 'db', None)
+    if db and not isPrimaryCopy(db):
+        fid = '%s:%s' % (fid, db)
+    return fid
 ## getattr(record,pk(record).name))
@@ -0,0 +1,326 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Background search and export jobs.
+
+Large soft searches and csv exports can take longer than a proxy will wait
+for. submitJob queues them on a small local thread pool and returns a job
+id right away. Each job has a directory under XGDS_DATA_JOB_DIR that holds
+status.json (state, row counts, timing), written under the job's lock
+file, a cancel marker file once cancelJob is called, and its results:
+results.jsonl, one record per line, for searches, or the export file.
+Any process can read these, so status and paged results don't depend on
+which worker handles the request. Finished jobs are removed after XGDS_DATA_JOB_TTL
+seconds, or sooner, oldest first, when the directory grows past
+XGDS_DATA_JOB_QUOTA bytes. Jobs whose worker went away before finishing
+them are marked failed once they are well past the job deadline.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import fcntl
+import traceback
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from xgds_data.routers import replicaReads, closeConnections
+
+KINDS = ('search', 'csv', 'csvhard')
+## files in a job's directory besides status.json and the results
+LOCK = 'lock'
+CANCEL = 'cancel'
+
+jobIdPattern = re.compile(r'^[0-9a-f]{32}$')
+poolLock = threading.Lock()
+jobPool = None
+
+
+def jobDirectory():
+    try:
+        base = settings.XGDS_DATA_JOB_DIR
+    except AttributeError:
+        base = None
+    if not base:
+        base = os.path.join(tempfile.gettempdir(), 'xgds_data_jobs')
+    return base
+
+
+def jobPath(jobId, name=None):
+    """
+    Path of a job's directory, or of a file in it; None for a bad id
+    """
+    if not jobIdPattern.match(jobId or ''):
+        return None
+    if name is None:
+        return os.path.join(jobDirectory(), jobId)
+    return os.path.join(jobDirectory(), jobId, name)
+
+
+def jobSetting(name, default):
+    try:
+        return getattr(settings, name)
+    except AttributeError:
+        return default
+
+
+def workerPool():
+    global jobPool
+    with poolLock:
+        if jobPool is None:
+            jobPool = ThreadPool(jobSetting('XGDS_DATA_JOB_WORKERS', 2))
+    return jobPool
+
+
+@contextmanager
+def jobLock(jobId):
+    """
+    Hold the job's lock, which excludes other threads and processes
+    """
+    with open(jobPath(jobId, LOCK), 'a') as lockFile:
+        fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+
+
+def writeStatus(jobId, **updates):
+    """
+    Merge updates into the job's status file, under the job's lock; written
+    to a temporary file and renamed so readers never see half of it
+    """
+    with jobLock(jobId):
+        status = readStatus(jobId) or dict()
+        status.pop('cancelRequested', None)  # kept in its own file
+        status.update(updates)
+        status['updated'] = time.time()
+        fd, tmp = tempfile.mkstemp(dir=jobPath(jobId), prefix='status.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as out:
+            json.dump(status, out)
+        os.rename(tmp, jobPath(jobId, 'status.json'))
+    return status
+
+
+def readStatus(jobId):
+    """
+    The job's status, with cancelRequested if someone asked it to stop;
+    None if there's no such job
+    """
+    path = jobPath(jobId, 'status.json')
+    if path is None:
+        return None
+    try:
+        with open(path) as statusFile:
+            status = json.load(statusFile)
+    except (IOError, OSError, ValueError):
+        return None
+    if cancelRequested(jobId):
+        status['cancelRequested'] = True
+    return status
+
+
+def requestCancel(jobId):
+    """
+    Leave the cancel request in a file of its own, which status writes
+    never touch, so a progress update can't lose it
+    """
+    with open(jobPath(jobId, CANCEL), 'a'):
+        pass
+
+
+def cancelRequested(jobId):
+    return os.path.exists(jobPath(jobId, CANCEL))
+
+
+def directorySize(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total = total + os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+def cleanupJobs():
+    """
+    Fail jobs left queued or running too long, drop finished jobs past
+    their TTL, then the oldest finished ones until everything fits in the quota
+    """
+    base = jobDirectory()
+    if not os.path.isdir(base):
+        return
+    ttl = jobSetting('XGDS_DATA_JOB_TTL', 24 * 3600)
+    quota = jobSetting('XGDS_DATA_JOB_QUOTA', 1024 * 1024 * 1024)
+    stale = ((jobSetting('XGDS_DATA_JOB_DEADLINE', None) or ttl)
+             + jobSetting('XGDS_DATA_JOB_GRACE', 3600))
+    now = time.time()
+    finished = []
+    total = 0
+    for jobId in os.listdir(base):
+        status = readStatus(jobId)
+        if status is None:
+            continue
+        size = directorySize(jobPath(jobId))
+        total = total + size
+        if status.get('state') in ('queued', 'running'):
+            since = status.get('started') or status.get('submitted') or 0
+            if now - since > stale:
+                ## its worker was recycled or died without finishing it
+                status = writeStatus(jobId, state='failed', finished=now, error='abandoned')
+        if status.get('state') in ('done', 'failed'):
+            finished.append((status.get('finished', 0), jobId, size))
+    for finishedAt, jobId, size in sorted(finished):
+        if (now - finishedAt > ttl) or (total > quota):
+            shutil.rmtree(jobPath(jobId), ignore_errors=True)
+            total = total - size
+
+
+def submitJob(kind, myModel, formset, soft=True, user=None):
+    """
+    Queue a search or export and return its id
+    """
+    assert kind in KINDS
+    cleanupJobs()
+    jobId = uuid.uuid4().hex
+    os.makedirs(jobPath(jobId))
+    writeStatus(jobId, id=jobId, kind=kind, state='queued',
+                module=myModel._meta.app_label, model=myModel._meta.object_name,
+                user=user, submitted=time.time(), rows=0, count=None)
+    workerPool().apply_async(runJob, (jobId, kind, myModel, formset, soft))
+    return jobId
+
+
+def runJob(jobId, kind, myModel, formset, soft):
+    ## imported here because views imports this module
+    from xgds_data.views import queryLogic, writeCsv, jsonify
+    from xgds_data.introspection import visibleFields, fullid
+    from xgds_data.limits import deadline, backendId, SearchLimitExceeded
+    status = readStatus(jobId)
+    if (status is None) or (status.get('state') != 'queued'):
+        return  # given up on (see cleanupJobs) while it waited
+    if status.get('cancelRequested'):
+        writeStatus(jobId, state='failed', finished=time.time(), error='cancelled')
+        return
+    notes = []
+    try:
+        with replicaReads() as alias:
+            writeStatus(jobId, state='running', started=time.time(),
+                        backend=backendId(), database=alias)
+            if kind == 'csvhard':
+                soft = False
+            with deadline(jobSetting('XGDS_DATA_JOB_DEADLINE', None), searchId=jobId,
+                          cancelled=lambda: cancelRequested(jobId)):
+                results, hardCount, totalCount = queryLogic(myModel, formset, soft=soft, notes=notes)
+                writeStatus(jobId, count=totalCount, exactCount=hardCount, notes=notes)
+                if kind == 'search':
+                    rows = 0
+                    with open(jobPath(jobId, 'results.jsonl'), 'w') as out:
+                        for r in resultIterator(results):
+                            out.write(json.dumps(dict(jsonify(r), fullid=fullid(r),
+                                                      score=getattr(r, 'score', None)),
+                                                 default=jsonify))
+                            out.write('\n')
+                            rows = rows + 1
+                            if rows % 1000 == 0:
+                                writeStatus(jobId, rows=rows)
+                    writeStatus(jobId, rows=rows)
+                else:
+                    myFields = list(visibleFields(myModel))
+                    counter = CountingList(jobId, resultIterator(results))
+                    with open(jobPath(jobId, 'export.csv'), 'wb') as out:
+                        writeCsv(out, counter, myFields)
+                    writeStatus(jobId, rows=counter.rows, filename='export.csv',
+                                contentType='text/csv')
+            writeStatus(jobId, state='done', finished=time.time())
+    except SearchLimitExceeded as e:
+        writeStatus(jobId, state='failed', finished=time.time(), error=unicode(e))
+    except Exception as e:
+        writeStatus(jobId, state='failed', finished=time.time(),
+                    error=unicode(e), trace=traceback.format_exc())
+    finally:
+        closeConnections()
+
+
+def cancelJob(jobId):
+    """
+    Ask a queued or running job to stop. Works from any process: the
+    database query is cancelled through the job's backend id.
+    """
+    from xgds_data.limits import cancelSearch
+    status = readStatus(jobId)
+    if (status is None) or (status.get('state') in ('done', 'failed')):
+        return False
+    requestCancel(jobId)
+    if status.get('state') == 'running':
+        cancelSearch(jobId, backend=status.get('backend'), alias=status.get('database'))
+    return True
+
+
+def resultIterator(results):
+    """
+    Stream query sets rather than loading them whole
+    """
+    try:
+        return results.iterator()
+    except AttributeError:
+        return iter(results)
+
+
+class CountingList(object):
+    """
+    Wraps an iterator of results, reporting progress every so often
+    """
+    def __init__(self, jobId, results):
+        self.jobId = jobId
+        self.results = results
+        self.rows = 0
+
+    def __iter__(self):
+        for r in self.results:
+            self.rows = self.rows + 1
+            if self.rows % 1000 == 0:
+                writeStatus(self.jobId, rows=self.rows)
+            yield r
+
+
+def jobResults(jobId, start=0, end=None):
+    """
+    Stored search results [start:end] of a job
+    """
+    path = jobPath(jobId, 'results.jsonl')
+    if (path is None) or not os.path.exists(path):
+        return None
+    records = []
+    with open(path) as resultFile:
+        for i, line in enumerate(resultFile):
+            if (end is not None) and (i >= end):
+                break
+            if i >= start:
+                records.append(json.loads(line))
+    return records
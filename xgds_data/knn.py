@@ -0,0 +1,346 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Nearest-neighbour index for "find similar".
+
+Each record becomes a vector of its numeric and time fields, each centred
+and scaled by the field's spread (from the stored sample when there is
+one), so that no one field dominates the distance. The vectors are kept
+in a static KD-tree saved as numpy arrays under XGDS_DATA_KNN_DIR and
+memory-mapped on use. Rows added after the build go into a small pending
+file that is searched exhaustively, until the next
+./manage.py xgds_data_knn folds them into the tree; edits to existing rows
+are picked up by the rebuild.
+
+Needs numpy; without it similarRecords returns None and callers fall back
+to the soft search.
+"""
+
+import os
+import json
+import heapq
+import tempfile
+
+from django.db.models import fields
+from django.conf import settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from xgds_data.introspection import (qualifiedModelName, maskField, isNumeric, pk)
+from xgds_data.reservoir import comparableValue, sampledValues
+from xgds_data.cache import Cache
+
+LEAF_SIZE = 32
+
+## rows added since the build, as pendingRecord records
+PENDING = 'pending.rec'
+## loaded indexes by model; checked against the index file's time stamp
+knnCache = Cache('knn', ttl=None, maxSize=100)
+
+
+def knnAvailable():
+    return numpy is not None
+
+
+def knnDirectory(model):
+    try:
+        base = settings.XGDS_DATA_KNN_DIR
+    except AttributeError:
+        base = None
+    if not base:
+        base = os.path.join(tempfile.gettempdir(), 'xgds_data_knn')
+    return os.path.join(base, qualifiedModelName(model))
+
+
+def knnSupported(model):
+    """
+    Ids are kept as 64 bit integers, so the model needs an integer key
+    """
+    return isinstance(pk(model), (fields.AutoField, fields.IntegerField))
+
+
+def knnFields(model):
+    """
+    The fields that make up a record's vector
+    """
+    return [f for f in model._meta.fields
+            if (f is not pk(model)) and not maskField(f) and
+            (isNumeric(model, f) or isinstance(f, (fields.DateTimeField, fields.DateField)))]
+
+
+def fieldScale(model, field, column=None):
+    """
+    Centre and spread of a field, from the stored sample, else from column
+    """
+    values = sampledValues(model, field.name)
+    if values:
+        values = numpy.array([v for v in values if v is not None], dtype=numpy.float64)
+    else:
+        values = column[~numpy.isnan(column)] if column is not None else numpy.array([])
+    if len(values) == 0:
+        return 0.0, 1.0
+    spread = float(values.std())
+    return float(values.mean()), (spread if spread > 0 else 1.0)
+
+
+def rawVector(instance, kfields):
+    vec = []
+    for f in kfields:
+        val = comparableValue(getattr(instance, f.attname))
+        try:
+            vec.append(float(val))
+        except (TypeError, ValueError):
+            vec.append(float('nan'))
+    return vec
+
+
+def normalize(raw, means, scales):
+    vecs = (numpy.asarray(raw, dtype=numpy.float64) - means) / scales
+    ## a missing value counts as typical
+    vecs[numpy.isnan(vecs)] = 0.0
+    return vecs.astype(numpy.float32)
+
+
+def buildTree(points, ids):
+    """
+    Reorder points and ids in place into an implicit KD-tree: the node for
+    rows [lo, hi) is the median row mid, split on splitDims[mid], with
+    children [lo, mid) and [mid + 1, hi). Ranges of LEAF_SIZE rows or
+    fewer are leaves.
+    """
+    splitDims = numpy.zeros(len(points), dtype=numpy.int8)
+    stack = [(0, len(points))]
+    while stack:
+        lo, hi = stack.pop()
+        if hi - lo <= LEAF_SIZE:
+            continue
+        block = points[lo:hi]
+        dim = int(numpy.argmax(block.max(axis=0) - block.min(axis=0)))
+        mid = (hi - lo) // 2
+        order = numpy.argpartition(block[:, dim], mid)
+        points[lo:hi] = block[order]
+        ids[lo:hi] = ids[lo:hi][order]
+        splitDims[lo + mid] = dim
+        stack.append((lo, lo + mid))
+        stack.append((lo + mid + 1, hi))
+    return splitDims
+
+
+def buildIndex(model):
+    """
+    Build and save the index for a model; returns the number of rows
+    """
+    kfields = knnFields(model)
+    ids = []
+    raw = []
+    for instance in model.objects.only(*[f.name for f in kfields]).iterator():
+        ids.append(instance.pk)
+        raw.append(rawVector(instance, kfields))
+    raw = numpy.array(raw, dtype=numpy.float64).reshape(len(ids), len(kfields))
+    stats = [fieldScale(model, f, raw[:, i]) for i, f in enumerate(kfields)]
+    means = numpy.array([s[0] for s in stats])
+    scales = numpy.array([s[1] for s in stats])
+    points = normalize(raw, means, scales)
+    ids = numpy.array(ids, dtype=numpy.int64)
+    splitDims = buildTree(points, ids)
+
+    directory = knnDirectory(model)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    numpy.save(os.path.join(directory, 'points.npy'), points)
+    numpy.save(os.path.join(directory, 'ids.npy'), ids)
+    numpy.save(os.path.join(directory, 'splits.npy'), splitDims)
+    for name in (PENDING, 'pending.f32', 'pending.ids'):
+        if os.path.exists(os.path.join(directory, name)):
+            os.remove(os.path.join(directory, name))
+    ## written last, so a half-built index is never picked up
+    with open(os.path.join(directory, 'meta.json'), 'w') as meta:
+        json.dump({'fields': [f.name for f in kfields],
+                   'means': means.tolist(),
+                   'scales': scales.tolist(),
+                   'count': len(ids)}, meta)
+    knnCache.pop(model)
+    return len(ids)
+
+
+def loadIndex(model):
+    """
+    The memory-mapped index of a model, or None if it hasn't been built
+    """
+    directory = knnDirectory(model)
+    metaPath = os.path.join(directory, 'meta.json')
+    try:
+        stamp = os.path.getmtime(metaPath)
+    except OSError:
+        return None
+    cached = knnCache.get(model)
+    if (cached is None) or (cached['stamp'] != stamp):
+        with open(metaPath) as meta:
+            info = json.load(meta)
+        info['stamp'] = stamp
+        info['means'] = numpy.array(info['means'])
+        info['scales'] = numpy.array(info['scales'])
+        for name in ('points', 'ids', 'splits'):
+            info[name] = numpy.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+        knnCache.set(model, info)
+        cached = info
+    return cached
+
+
+def pendingRecord(width):
+    """
+    numpy dtype of one pending row: its id, then its vector
+    """
+    return numpy.dtype([('id', '<i8'), ('vec', '<f4', (width,))])
+
+
+def pendingRows(model, width):
+    """
+    Vectors and ids of rows saved since the index was built
+    """
+    directory = knnDirectory(model)
+    record = pendingRecord(width)
+    try:
+        with open(os.path.join(directory, PENDING), 'rb') as pending:
+            data = pending.read()
+    except IOError:
+        return numpy.zeros((0, width), dtype=numpy.float32), numpy.zeros(0, dtype=numpy.int64)
+    ## leave off a record still being written
+    rows = numpy.frombuffer(data[:len(data) - len(data) % record.itemsize], dtype=record)
+    return rows['vec'].reshape(len(rows), width), rows['id']
+
+
+def knnInsertHandler(sender, instance, created=False, raw=False, **kwargs):
+    """
+    post_save handler that adds a new row to the pending part of the index
+    """
+    if raw or (not created) or (numpy is None):
+        return
+    index = loadIndex(sender)
+    if index is None:
+        return
+    kfields = [sender._meta.get_field(name) for name in index['fields']]
+    vec = normalize([rawVector(instance, kfields)], index['means'], index['scales'])
+    row = numpy.zeros(1, dtype=pendingRecord(len(kfields)))
+    row['id'] = instance.pk
+    row['vec'] = vec
+    ## one append of the whole record, so rows written by several
+    ## processes at once never get mixed up
+    fd = os.open(os.path.join(knnDirectory(sender), PENDING),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, row.tobytes())
+    finally:
+        os.close(fd)
+
+
+def treeSearch(index, query, k, skip):
+    """
+    The k nearest tree rows to query as a list of (-squared distance, id),
+    ignoring ids in skip
+    """
+    points = index['points']
+    ids = index['ids']
+    splits = index['splits']
+    best = []  # max-heap on distance, via negation
+    stack = [(0, len(points), 0.0)]
+    while stack:
+        lo, hi, bound = stack.pop()
+        if (len(best) == k) and (bound > -best[0][0]):
+            continue
+        if hi - lo <= LEAF_SIZE:
+            dists = ((points[lo:hi] - query) ** 2).sum(axis=1)
+            for d, rid in zip(dists.tolist(), ids[lo:hi].tolist()):
+                if rid in skip:
+                    continue
+                if len(best) < k:
+                    heapq.heappush(best, (-d, rid))
+                elif d < -best[0][0]:
+                    heapq.heapreplace(best, (-d, rid))
+            continue
+        mid = lo + (hi - lo) // 2
+        dim = splits[mid]
+        diff = float(query[dim] - points[mid][dim])
+        d = float(((points[mid] - query) ** 2).sum())
+        if int(ids[mid]) not in skip:
+            if len(best) < k:
+                heapq.heappush(best, (-d, int(ids[mid])))
+            elif d < -best[0][0]:
+                heapq.heapreplace(best, (-d, int(ids[mid])))
+        near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+        ## far side pushed first, so the near side is searched first
+        stack.append((far[0], far[1], max(bound, diff * diff)))
+        stack.append((near[0], near[1], bound))
+    return best
+
+
+def nearestNeighbors(model, instance, k):
+    """
+    [(pk, distance)] of the k records closest to instance, nearest first,
+    not including instance itself; None if there is no index
+    """
+    if (numpy is None) or not knnSupported(model):
+        return None
+    index = loadIndex(model)
+    if index is None:
+        return None
+    kfields = [model._meta.get_field(name) for name in index['fields']]
+    query = normalize([rawVector(instance, kfields)], index['means'], index['scales'])[0]
+    pendingPoints, pendingIds = pendingRows(model, len(kfields))
+    ## pending rows supersede any tree entries they have
+    skip = set(pendingIds.tolist())
+    skip.add(instance.pk)
+    best = treeSearch(index, query, k, skip)
+    if len(pendingIds):
+        dists = ((pendingPoints - query) ** 2).sum(axis=1)
+        latest = dict(zip(pendingIds.tolist(), dists.tolist()))
+        for rid, d in latest.items():
+            if rid == instance.pk:
+                continue
+            if len(best) < k:
+                heapq.heappush(best, (-d, rid))
+            elif d < -best[0][0]:
+                heapq.heapreplace(best, (-d, rid))
+    return [(rid, (-negd) ** 0.5) for negd, rid in sorted(best, reverse=True)]
+
+
+def similarRecords(model, instance, k=None):
+    """
+    The k records most like instance, nearest first, with a score from 1
+    down; None if there is no index to answer from
+    """
+    if k is None:
+        try:
+            k = settings.XGDS_DATA_KNN_NEIGHBORS
+        except AttributeError:
+            k = 100
+    neighbors = nearestNeighbors(model, instance, k)
+    if neighbors is None:
+        return None
+    records = model.objects.in_bulk([rid for rid, d in neighbors])
+    results = []
+    for rid, d in neighbors:
+        rec = records.get(rid)
+        if rec is not None:
+            rec.score = 1.0 / (1.0 + d)
+            results.append(rec)
+    return results
@@ -0,0 +1,376 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Keeping a bad search from tying up the database.
+
+Every search runs under a deadline, XGDS_DATA_SEARCH_DEADLINE seconds or a
+per-model value from XGDS_DATA_SEARCH_DEADLINES ({'ModelName': seconds}).
+The deadline is enforced by the database: statement_timeout on Postgres,
+max_execution_time on MySQL and a progress handler on SQLite. A running
+search can also be cancelled from elsewhere with cancelSearch. Queries a
+search hands to worker threads run under workerDeadline, with what is left
+of the search's own deadline, and are cancelled along with it.
+
+Before the results query runs, its EXPLAIN cost (rows scanned on SQLite) is
+compared with XGDS_DATA_SEARCH_COST_BUDGET (or per model,
+XGDS_DATA_SEARCH_COST_BUDGETS). Over budget, the query is either limited to
+the stored random sample or rejected, per XGDS_DATA_SEARCH_OVER_BUDGET
+('sample' or 'reject').
+"""
+
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+from multiprocessing import TimeoutError
+
+from django.db import connections
+from django.db.utils import DatabaseError
+from django.conf import settings
+
+from xgds_data.introspection import resolveSetting, pk
+from xgds_data.DataStatistics import tableSize
+from xgds_data.reservoir import sampledIds
+from xgds_data.routers import readConnection
+
+NARROW = 'Please narrow your search.'
+
+activeSearches = dict()
+activeLock = threading.Lock()
+limitState = threading.local()
+
+
+class SearchLimitExceeded(Exception):
+    pass
+
+
+class SearchTimeout(SearchLimitExceeded):
+    def __init__(self, seconds=None):
+        if seconds:
+            msg = 'The search took longer than %g seconds. %s' % (seconds, NARROW)
+        else:
+            msg = 'The search was cancelled.'
+        SearchLimitExceeded.__init__(self, msg)
+
+
+class SearchTooExpensive(SearchLimitExceeded):
+    def __init__(self, cost=None, budget=None):
+        SearchLimitExceeded.__init__(self, 'The search would scan too much data. %s' % NARROW)
+        self.cost = cost
+        self.budget = budget
+
+
+def searchDeadline(model):
+    """
+    Seconds a search of this model may take, None for no limit
+    """
+    return resolveSetting('XGDS_DATA_SEARCH_DEADLINES', model,
+                          getattr(settings, 'XGDS_DATA_SEARCH_DEADLINE', 30))
+
+
+def exportDeadline(model):
+    """
+    Seconds an export of this model may take: the background job deadline
+    (XGDS_DATA_JOB_DEADLINE), not the interactive one
+    """
+    return getattr(settings, 'XGDS_DATA_JOB_DEADLINE', None)
+
+
+def costBudget(model):
+    return resolveSetting('XGDS_DATA_SEARCH_COST_BUDGETS', model,
+                          getattr(settings, 'XGDS_DATA_SEARCH_COST_BUDGET', None))
+
+
+def backendId():
+    """
+    Server-side id of our connection, for cancelling from another connection
+    """
+    connection = readConnection()
+    connection.ensure_connection()
+    vendor = connection.vendor
+    with connection.cursor() as cursor:
+        if vendor == 'postgresql':
+            cursor.execute('SELECT pg_backend_pid()')
+        elif vendor == 'mysql':
+            cursor.execute('SELECT CONNECTION_ID()')
+        else:
+            return None
+        return cursor.fetchone()[0]
+
+
+def setTimeout(milliseconds):
+    connection = readConnection()
+    vendor = connection.vendor
+    with connection.cursor() as cursor:
+        if vendor == 'postgresql':
+            cursor.execute('SET statement_timeout = %s', [milliseconds])
+        elif vendor == 'mysql':
+            cursor.execute('SET SESSION max_execution_time = %s', [milliseconds])
+
+
+class Limit(object):
+    """
+    The deadline a thread is under, for handing on to worker threads: when
+    it runs out, and how to tell the search was cancelled
+    """
+    def __init__(self, seconds, stop=None, cancelled=None):
+        self.seconds = seconds
+        self.ends = (time.time() + seconds) if seconds else None
+        self.stop = stop if stop is not None else threading.Event()
+        self.cancelled = cancelled
+        self.workers = dict()  # worker thread -> (alias, backend id)
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        """
+        Seconds left, None for no limit
+        """
+        if self.ends is None:
+            return None
+        return self.ends - time.time()
+
+    def isCancelled(self):
+        if self.stop.is_set():
+            return True
+        if (self.cancelled is not None) and self.cancelled():
+            self.stop.set()
+            return True
+        return False
+
+    def cancelWorkers(self):
+        """
+        Stop the queries the workers are running right now
+        """
+        self.stop.set()
+        with self.lock:
+            workers = list(self.workers.values())
+        for alias, backend in workers:
+            try:
+                cancelBackend(backend, alias)
+            except DatabaseError:
+                pass  # the query may be over already
+
+
+def currentLimit(model):
+    """
+    The Limit this thread is under, to hand on to workers; outside of any
+    deadline, the model's search deadline starting now
+    """
+    return getattr(limitState, 'limit', None) or Limit(searchDeadline(model))
+
+
+@contextmanager
+def workerDeadline(limit):
+    """
+    deadline() in a worker thread for what is left of the caller's Limit,
+    so time spent waiting for the worker counts, and cancelling the
+    caller's search stops the worker too
+    """
+    if limit.isCancelled():
+        raise SearchTimeout()
+    seconds = limit.remaining()
+    if (seconds is not None) and (seconds < 0.001):
+        ## (a zero statement_timeout would mean no limit at all)
+        raise SearchTimeout(limit.seconds)
+    worker = threading.current_thread()
+    try:
+        with deadline(seconds, cancelled=limit.isCancelled) as stop:
+            backend = backendId()
+            if backend is not None:
+                with limit.lock:
+                    limit.workers[worker] = (readConnection().alias, backend)
+            try:
+                yield stop
+            finally:
+                with limit.lock:
+                    limit.workers.pop(worker, None)
+    except SearchTimeout:
+        if limit.isCancelled():
+            raise
+        raise SearchTimeout(limit.seconds)
+    except DatabaseError:
+        if limit.isCancelled():
+            raise SearchTimeout()
+        raise
+
+
+def waitForWorkers(limit, pending):
+    """
+    The results of the worker pool's AsyncResults, in order. If the
+    search is cancelled while waiting, the workers' queries are cancelled.
+    """
+    results = []
+    for result in pending:
+        while True:
+            try:
+                results.append(result.get(1))
+                break
+            except TimeoutError:
+                if (not limit.stop.is_set()) and limit.isCancelled():
+                    limit.cancelWorkers()
+    return results
+
+
+@contextmanager
+def deadline(seconds, searchId=None, cancelled=None):
+    """
+    Run the enclosed queries under a time limit (None for no limit),
+    raising SearchTimeout when it passes or when the search is cancelled.
+    searchId registers the search for cancelSearch; cancelled is an
+    optional callable that says whether someone else asked to stop.
+    The limit applies to the connection reads are going to (see routers).
+    """
+    connection = readConnection()
+    connection.ensure_connection()
+    vendor = connection.vendor
+    stop = threading.Event()
+    started = time.time()
+    if searchId is not None:
+        with activeLock:
+            activeSearches[searchId] = (stop, backendId())
+    if seconds and vendor in ('postgresql', 'mysql'):
+        setTimeout(int(seconds * 1000))
+    elif vendor == 'sqlite':
+        checked = [started]
+
+        def progress():
+            now = time.time()
+            if stop.is_set() or (seconds and (now - started > seconds)):
+                return 1
+            if (cancelled is not None) and (now - checked[0] > 1):
+                checked[0] = now
+                if cancelled():
+                    stop.set()
+                    return 1
+            return 0
+        connection.connection.set_progress_handler(progress, 10000)
+    outer = getattr(limitState, 'limit', None)
+    limitState.limit = Limit(seconds, stop, cancelled)
+    try:
+        yield stop
+    except DatabaseError:
+        if stop.is_set():
+            raise SearchTimeout()
+        elif seconds and (time.time() - started >= seconds * 0.99):
+            raise SearchTimeout(seconds)
+        raise
+    finally:
+        limitState.limit = outer
+        if searchId is not None:
+            with activeLock:
+                activeSearches.pop(searchId, None)
+        try:
+            if seconds and vendor in ('postgresql', 'mysql'):
+                setTimeout(0)
+            elif vendor == 'sqlite':
+                connection.connection.set_progress_handler(None, 0)
+        except DatabaseError:
+            pass  # connection is unusable anyway
+
+
+def cancelSearch(searchId, backend=None, alias=None):
+    """
+    Stop a running search: the one registered in this process under
+    searchId, or the one running on the given backend id (of the
+    database alias) elsewhere
+    """
+    with activeLock:
+        active = activeSearches.get(searchId)
+    if active is not None:
+        stop, backend = active
+        stop.set()
+    if backend is None:
+        return active is not None
+    cancelBackend(backend, alias)
+    return True
+
+
+def cancelBackend(backend, alias=None):
+    """
+    Cancel the query running on a server-side connection id
+    """
+    connection = connections[alias] if alias else readConnection()
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT pg_cancel_backend(%s)', [backend])
+        elif connection.vendor == 'mysql':
+            cursor.execute('KILL QUERY %s' % int(backend))
+
+
+def estimatedCost(query):
+    """
+    The database's estimate of the cost of running a query set, None if unknown
+    """
+    sql, params = query.query.sql_with_params()
+    connection = readConnection()
+    vendor = connection.vendor
+    with connection.cursor() as cursor:
+        if vendor == 'postgresql':
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+            if not isinstance(plan, list):
+                plan = json.loads(plan)
+            return float(plan[0]['Plan']['Total Cost'])
+        elif vendor == 'mysql':
+            cursor.execute('EXPLAIN FORMAT=JSON ' + sql, params)
+            plan = json.loads(cursor.fetchone()[0])
+            return float(plan['query_block']['cost_info']['query_cost'])
+        elif vendor == 'sqlite':
+            ## no costs, so count the rows a full scan would touch
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            details = [row[-1] for row in cursor.fetchall()]
+            rows = tableSize(query.model) or 0
+            cost = 0.0
+            for d in details:
+                if d.startswith('SCAN') and ('INDEX' not in d):
+                    cost = max(cost, rows)
+                elif d.startswith('SEARCH'):
+                    cost = max(cost, math.sqrt(rows))
+                elif 'TEMP B-TREE' in d:
+                    cost = cost * max(1.0, math.log(max(rows, 2), 2))
+            return cost
+    return None
+
+
+def guardCost(model, query, notes=None):
+    """
+    Check the query against the cost budget; returns the query to run,
+    which may be limited to the stored sample. Raises SearchTooExpensive
+    if it's over budget and can't be downgraded.
+    """
+    budget = costBudget(model)
+    if (budget is None) or not hasattr(query, 'query'):
+        ## no budget, or already a list (e.g., virtual field results)
+        return query
+    try:
+        cost = estimatedCost(query)
+    except (DatabaseError, KeyError, IndexError, ValueError):
+        return query  # can't tell, so let the deadline handle it
+    if (cost is None) or (cost <= budget):
+        return query
+    if getattr(settings, 'XGDS_DATA_SEARCH_OVER_BUDGET', 'sample') == 'sample':
+        ids = sampledIds(model)
+        if ids:
+            if notes is not None:
+                notes.append('This search would scan too much data, so these are the best '
+                             'matches from a random sample of %d records, and the counts are '
+                             'of that sample. %s' % (len(ids), NARROW))
+            return query.filter(**{pk(model).name + '__in': ids})
+    raise SearchTooExpensive(cost, budget)
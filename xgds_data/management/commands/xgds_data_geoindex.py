@@ -0,0 +1,48 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+"""
+File the rows of models with lat/lon pairs (XGDS_DATA_LATLON_FIELDS) under
+their grid cells. Saves keep the cells current afterwards.
+
+  ./manage.py xgds_data_geoindex [moduleName [modelName]]
+"""
+
+from django.core.management.base import BaseCommand
+
+from xgds_data.introspection import (searchableModels, resolveModel,
+                                     qualifiedModelName)
+from xgds_data.spatial import latLonPairs, rebuildLocations
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the location grid cells of searchable models'
+
+    def add_arguments(self, parser):
+        parser.add_argument('moduleName', nargs='?')
+        parser.add_argument('modelName', nargs='?')
+
+    def handle(self, *args, **options):
+        if options['modelName']:
+            models = [resolveModel(options['moduleName'], options['modelName'])]
+        else:
+            models = searchableModels(options['moduleName'])
+
+        for m in models:
+            if latLonPairs(m):
+                rows = rebuildLocations(m)
+                self.stdout.write('%s: filed %d rows' % (qualifiedModelName(m), rows))
@@ -0,0 +1,48 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+"""
+Rebuild the cross-model search index. After the first build, records are
+reindexed when saved.
+
+  ./manage.py xgds_data_globalindex [moduleName [modelName]]
+"""
+
+from django.core.management.base import BaseCommand
+
+from xgds_data.introspection import (searchableModels, resolveModel,
+                                     qualifiedModelName)
+from xgds_data.globalindex import rebuildGlobalIndex, isGloballyIndexed
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the index used to search all models at once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('moduleName', nargs='?')
+        parser.add_argument('modelName', nargs='?')
+
+    def handle(self, *args, **options):
+        if options['modelName']:
+            models = [resolveModel(options['moduleName'], options['modelName'])]
+        else:
+            models = searchableModels(options['moduleName'])
+
+        for m in models:
+            if isGloballyIndexed(m):
+                rows = rebuildGlobalIndex(m)
+                self.stdout.write('%s: indexed %d rows' % (qualifiedModelName(m), rows))
@@ -0,0 +1,50 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+"""
+Build the nearest-neighbour indexes behind "find similar". Rows saved
+afterwards are added incrementally; rerun now and then to rebalance.
+
+  ./manage.py xgds_data_knn [moduleName [modelName]]
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from xgds_data.introspection import (searchableModels, resolveModel,
+                                     qualifiedModelName)
+from xgds_data.knn import knnAvailable, knnSupported, knnFields, buildIndex
+
+
+class Command(BaseCommand):
+    help = 'Build the nearest-neighbour index for searchable models'
+
+    def add_arguments(self, parser):
+        parser.add_argument('moduleName', nargs='?')
+        parser.add_argument('modelName', nargs='?')
+
+    def handle(self, *args, **options):
+        if not knnAvailable():
+            raise CommandError('The nearest-neighbour index needs numpy')
+        if options['modelName']:
+            models = [resolveModel(options['moduleName'], options['modelName'])]
+        else:
+            models = searchableModels(options['moduleName'])
+
+        for m in models:
+            if knnSupported(m) and knnFields(m):
+                rows = buildIndex(m)
+                self.stdout.write('%s: indexed %d rows' % (qualifiedModelName(m), rows))
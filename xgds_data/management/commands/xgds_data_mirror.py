@@ -0,0 +1,64 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Copy searchable models (and the models they point to) into an SQLite
+database alias, indexed for search, so searches can run offline. Without
+--rebuild, only rows added since the last run are copied.
+
+  ./manage.py xgds_data_mirror [moduleName [modelName]] [--database mirror]
+                               [--source default] [--rebuild]
+"""
+
+from django.conf import settings
+from django.db import connections
+from django.core.management.base import BaseCommand, CommandError
+
+from xgds_data.introspection import (searchableModels, resolveModel,
+                                     qualifiedModelName, isAbstract)
+from xgds_data.mirror import relatedModels, mirrorModel, analyzeMirror
+
+
+class Command(BaseCommand):
+    help = 'Build or update an indexed SQLite mirror of searchable models'
+
+    def add_arguments(self, parser):
+        parser.add_argument('moduleName', nargs='?')
+        parser.add_argument('modelName', nargs='?')
+        parser.add_argument('--database', default='mirror',
+                            help='SQLite alias to copy into (default "mirror")')
+        parser.add_argument('--source', default='default',
+                            help='Alias to copy from (default "default")')
+        parser.add_argument('--rebuild', action='store_true', default=False,
+                            help='Recopy every row instead of only new ones')
+
+    def handle(self, *args, **options):
+        target = options['database']
+        if target not in settings.DATABASES:
+            raise CommandError('No database alias %s' % target)
+        if connections[target].vendor != 'sqlite':
+            raise CommandError('The mirror %s has to be an SQLite database' % target)
+        if options['modelName']:
+            models = [resolveModel(options['moduleName'], options['modelName'])]
+        else:
+            models = searchableModels(options['moduleName'])
+
+        for m in relatedModels([m for m in models if not isAbstract(m)]):
+            copied = mirrorModel(m, options['source'], target, rebuild=options['rebuild'])
+            self.stdout.write('%s: copied %d rows' % (qualifiedModelName(m), copied))
+        analyzeMirror(target)
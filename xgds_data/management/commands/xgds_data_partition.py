@@ -0,0 +1,74 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+"""
+Maintain the time partitions of the models in XGDS_DATA_TIME_PARTITIONS.
+
+On Postgres, adds the native partitions for every period from the oldest
+row through the next period; the model's table has to have been created
+PARTITION BY RANGE on its primary time field. On other backends, moves
+every finished period out of the model's table into its own table. Run it
+periodically, e.g. from cron.
+
+  ./manage.py xgds_data_partition [moduleName [modelName]]
+"""
+
+import time
+
+from django.db import connection
+from django.db.models import Min
+from django.core.management.base import BaseCommand
+
+from xgds_data.introspection import (searchableModels, resolveModel,
+                                     qualifiedModelName, getPrimaryTimeField)
+from xgds_data.partition import (isPartitioned, usesNativePartitions, partitionPeriod,
+                                 periodsBetween, periodStart, nextPeriod, toEpoch,
+                                 createPartitionSql, movePeriod)
+
+
+class Command(BaseCommand):
+    help = 'Create or fill the time partitions of partitioned models'
+
+    def add_arguments(self, parser):
+        parser.add_argument('moduleName', nargs='?')
+        parser.add_argument('modelName', nargs='?')
+
+    def handle(self, *args, **options):
+        if options['modelName']:
+            models = [resolveModel(options['moduleName'], options['modelName'])]
+        else:
+            models = searchableModels(options['moduleName'])
+
+        for m in models:
+            if not isPartitioned(m):
+                continue
+            period = partitionPeriod(m)
+            oldest = m.objects.aggregate(Min(getPrimaryTimeField(m))).values()[0]
+            if oldest is None:
+                continue
+            current = periodStart(time.time(), period)
+            if usesNativePartitions():
+                starts = periodsBetween(m, toEpoch(oldest), toEpoch(nextPeriod(nextPeriod(current, period), period)))
+                with connection.cursor() as cursor:
+                    for start in starts:
+                        cursor.execute(createPartitionSql(m, start))
+                self.stdout.write('%s: %d partitions' % (qualifiedModelName(m), len(starts)))
+            else:
+                moved = 0
+                for start in periodsBetween(m, toEpoch(oldest), toEpoch(current)):
+                    moved = moved + movePeriod(m, start)
+                self.stdout.write('%s: moved %d rows to period tables' % (qualifiedModelName(m), moved))
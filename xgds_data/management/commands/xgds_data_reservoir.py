@@ -0,0 +1,55 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Rebuild the stored random sample used for estimates. After the first
+build, new rows are folded in on insert.
+
+  ./manage.py xgds_data_reservoir [moduleName [modelName]] [--size N]
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from xgds_data.models import cacheStatistics
+from xgds_data.introspection import (searchableModels, resolveModel,
+                                     qualifiedModelName)
+from xgds_data.reservoir import rebuildReservoir, reservoirSize
+from xgds_data.routers import replicaReads
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the random sample of rows kept for searchable models'
+
+    def add_arguments(self, parser):
+        parser.add_argument('moduleName', nargs='?')
+        parser.add_argument('modelName', nargs='?')
+        parser.add_argument('--size', type=int, default=None,
+                            help='Rows to keep per model (default XGDS_DATA_RESERVOIR_SIZE)')
+
+    def handle(self, *args, **options):
+        if not cacheStatistics():
+            raise CommandError('Samples are stored with the statistics cache; set XGDS_DATA_CACHE_STATISTICS')
+        if options['modelName']:
+            models = [resolveModel(options['moduleName'], options['modelName'])]
+        else:
+            models = searchableModels(options['moduleName'])
+        size = options['size'] or reservoirSize()
+
+        ## the scans can run on a replica; the results are written to the primary
+        with replicaReads():
+            for m in models:
+                seen = rebuildReservoir(m, size)
+                self.stdout.write('%s: sampled %d of %d rows' % (qualifiedModelName(m), min(seen, size), seen))
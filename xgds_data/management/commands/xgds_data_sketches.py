@@ -0,0 +1,57 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Build or refresh the HyperLogLog sketches used to estimate how many distinct
+values a field holds. By default only rows added since the last run are
+folded in; use --rebuild after bulk edits or deletes.
+
+  ./manage.py xgds_data_sketches [moduleName [modelName]] [--rebuild]
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from xgds_data.models import cacheStatistics
+from xgds_data.introspection import (searchableModels, resolveModel,
+                                     qualifiedModelName)
+from xgds_data.DataStatistics import sketchableFields, refreshSketch
+from xgds_data.routers import replicaReads
+
+
+class Command(BaseCommand):
+    help = 'Build or refresh distinct value sketches for searchable models'
+
+    def add_arguments(self, parser):
+        parser.add_argument('moduleName', nargs='?')
+        parser.add_argument('modelName', nargs='?')
+        parser.add_argument('--rebuild', action='store_true', default=False,
+                            help='Discard existing sketches and rescan whole tables')
+
+    def handle(self, *args, **options):
+        if not cacheStatistics():
+            raise CommandError('Sketches are stored with the statistics cache; set XGDS_DATA_CACHE_STATISTICS')
+        if options['modelName']:
+            models = [resolveModel(options['moduleName'], options['modelName'])]
+        else:
+            models = searchableModels(options['moduleName'])
+
+        ## the scans can run on a replica; the results are written to the primary
+        with replicaReads():
+            for m in models:
+                for f in sketchableFields(m):
+                    sketch = refreshSketch(m, f, rebuild=options['rebuild'])
+                    self.stdout.write('%s.%s ~%d distinct' % (qualifiedModelName(m), f.name,
+                                                              int(round(sketch.estimate()))))
@@ -0,0 +1,91 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Create (or drop) the full-text indexes for the fields listed in
+XGDS_DATA_FULLTEXT_FIELDS, using whatever the database backend provides,
+and the trigram indexes for XGDS_DATA_TRIGRAM_FIELDS (a pg_trgm index on
+Postgres, otherwise a rebuild of the trigram posting table).
+
+  ./manage.py xgds_data_textindex [moduleName [modelName]] [--drop]
+"""
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand
+
+from xgds_data.introspection import (searchableModels, resolveModel,
+                                     qualifiedModelName)
+from xgds_data.models import TrigramPosting
+from xgds_data.textindex import (fullTextFields, createIndexSql, dropIndexSql,
+                                 trigramFields, createTrigramIndexSql,
+                                 dropTrigramIndexSql, usesPostingTable,
+                                 rebuildTrigrams, dbVendor)
+
+
+class Command(BaseCommand):
+    help = 'Create or drop full-text and trigram indexes for configured text fields'
+
+    def add_arguments(self, parser):
+        parser.add_argument('moduleName', nargs='?')
+        parser.add_argument('modelName', nargs='?')
+        parser.add_argument('--drop', action='store_true', default=False,
+                            help='Remove the indexes instead')
+
+    def handle(self, *args, **options):
+        if options['modelName']:
+            models = [resolveModel(options['moduleName'], options['modelName'])]
+        else:
+            models = searchableModels(options['moduleName'])
+
+        for m in models:
+            for f in fullTextFields(m):
+                if options['drop']:
+                    statements = dropIndexSql(m, f)
+                else:
+                    statements = createIndexSql(m, f)
+                if len(statements) == 0:
+                    self.stderr.write('No full-text support for %s; %s.%s will use substring matches'
+                                      % (dbVendor(), qualifiedModelName(m), f.name))
+                    continue
+                with transaction.atomic():
+                    cursor = connection.cursor()
+                    for sql in statements:
+                        cursor.execute(sql)
+                self.stdout.write('%s %s.%s' % ('Dropped' if options['drop'] else 'Indexed',
+                                                qualifiedModelName(m), f.name))
+
+            tfields = trigramFields(m)
+            if len(tfields) == 0:
+                continue
+            if usesPostingTable():
+                if options['drop']:
+                    TrigramPosting.objects.filter(model=qualifiedModelName(m)).delete()
+                    self.stdout.write('Dropped trigrams for %s' % qualifiedModelName(m))
+                else:
+                    rows = rebuildTrigrams(m)
+                    self.stdout.write('Posted trigrams for %d %s rows' % (rows, qualifiedModelName(m)))
+            else:
+                for f in tfields:
+                    if options['drop']:
+                        statements = dropTrigramIndexSql(m, f)
+                    else:
+                        statements = createTrigramIndexSql(m, f)
+                    with transaction.atomic():
+                        cursor = connection.cursor()
+                        for sql in statements:
+                            cursor.execute(sql)
+                    self.stdout.write('%s trigrams %s.%s' % ('Dropped' if options['drop'] else 'Indexed',
+                                                             qualifiedModelName(m), f.name))
@@ -0,0 +1,66 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Work out what the first searches on each model would otherwise build on
+the fly (registry, through models, size estimates, plot choices, search
+form fields), and report how long the imports and each model took. Meant
+to run after a deploy. Only the size estimates outlive this command: with
+XGDS_DATA_SHARED_STATISTICS they land in the shared cache, where the
+workers' pulldown and plot series decisions find them. Everything else is
+built again in each worker; XGDS_DATA_WARMUP_ON_READY does that at startup.
+
+  ./manage.py xgds_data_warmup [moduleName [modelName]] [--budget seconds]
+"""
+
+from django.core.management.base import BaseCommand
+
+from xgds_data.introspection import searchableModels, resolveModel
+from xgds_data.warmup import warmUp, warmUpBudget, report
+from xgds_data.cache import cacheStats
+from xgds_data.DataStatistics import sharedStatistics
+
+
+class Command(BaseCommand):
+    help = 'Precompute search metadata and statistics for searchable models'
+
+    def add_arguments(self, parser):
+        parser.add_argument('moduleName', nargs='?')
+        parser.add_argument('modelName', nargs='?')
+        parser.add_argument('--budget', type=float, default=None,
+                            help='Stop starting new models after this many seconds')
+
+    def handle(self, *args, **options):
+        if options['modelName']:
+            models = [resolveModel(options['moduleName'], options['modelName'])]
+        else:
+            models = searchableModels(options['moduleName'])
+        budget = options['budget']
+        if budget is None:
+            budget = warmUpBudget()
+
+        imports, apps, skipped = warmUp(models, budget=budget, log=self.stdout.write)
+        for line in report(imports, apps, skipped, budget=budget):
+            self.stdout.write(line)
+        for stats in cacheStats():
+            if stats['size']:
+                self.stdout.write('cache %s: %d entries' % (stats['name'], stats['size']))
+        if sharedStatistics() is None:
+            self.stdout.write('nothing was kept for the workers: set XGDS_DATA_SHARED_STATISTICS '
+                              '(and a shared cache) to pre-seed their size estimates, and '
+                              'XGDS_DATA_WARMUP_ON_READY to warm each worker at startup')
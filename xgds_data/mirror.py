@@ -0,0 +1,252 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Searching a local SQLite copy of the data, e.g. on a field laptop with no
+connection to the main database.
+
+The scoring SQL uses functions SQLite lacks (greatest, least, RAND, STDDEV,
+epoch conversion, trigonometry), so they are registered as user-defined
+functions on every new SQLite connection (turn this off with
+XGDS_DATA_SQLITE_FUNCTIONS = False). Pure ones are registered as
+deterministic where the sqlite3 module allows it, so SQLite may use them in
+indexes and constant folding. Search then emits xgds_epoch() and
+xgds_distance() on SQLite instead of its flat-earth and MySQL fallbacks.
+
+./manage.py xgds_data_mirror copies selected models (and the models they
+point to) into an SQLite alias, creating the tables and an index on every
+searchable column, then ANALYZEs it so the planner uses them. Create
+xgds_data's own tables there first with ./manage.py migrate --database
+<alias>, then point DATABASES['default'] at the mirror file.
+"""
+
+import re
+import math
+import random
+import calendar
+
+from django.db import connections
+from django.db.models import fields
+from django.conf import settings
+
+from xgds_data.introspection import db_table
+from xgds_data.reservoir import reservoirFields
+from xgds_data.spatial import haversine
+
+timePattern = re.compile(r'^(\d{4})-(\d\d)-(\d\d)(?:[ T](\d\d):(\d\d)(?::(\d\d)(\.\d+)?)?)?')
+
+
+def sqliteFunctionsEnabled():
+    return getattr(settings, 'XGDS_DATA_SQLITE_FUNCTIONS', True)
+
+
+def sqliteEpoch(value):
+    """
+    Epoch seconds of a datetime or date as SQLite stores them (UTC text)
+    """
+    if value is None or isinstance(value, (int, long, float)):
+        return value
+    match = timePattern.match(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction = match.groups()
+    seconds = calendar.timegm((int(year), int(month), int(day),
+                               int(hour or 0), int(minute or 0), int(second or 0)))
+    if fraction:
+        seconds = seconds + float(fraction)
+    return seconds
+
+
+def sqliteGreatest(*args):
+    ## like MySQL, NULL if any argument is
+    if None in args:
+        return None
+    return max(args)
+
+
+def sqliteLeast(*args):
+    if None in args:
+        return None
+    return min(args)
+
+
+def sqliteDistance(lat1, lon1, lat2, lon2):
+    if None in (lat1, lon1, lat2, lon2):
+        return None
+    return haversine(lat1, lon1, lat2, lon2)
+
+
+def unary(fn):
+    """
+    A one-argument math function that passes NULL through
+    """
+    return lambda x: None if x is None else fn(x)
+
+
+class StdDev(object):
+    """
+    Population standard deviation aggregate, as MySQL's STDDEV and STDDEV_POP
+    """
+    ## subtracted from the count in the divisor
+    ddof = 0
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.squares = 0.0
+
+    def step(self, value):
+        if value is not None:
+            value = float(value)
+            self.n = self.n + 1
+            self.total = self.total + value
+            self.squares = self.squares + value * value
+
+    def finalize(self):
+        if self.n <= self.ddof:
+            return None
+        mean = self.total / self.n
+        sumSquares = max(0.0, self.squares - self.n * mean * mean)
+        return math.sqrt(sumSquares / (self.n - self.ddof))
+
+
+class SampleStdDev(StdDev):
+    """
+    Sample standard deviation aggregate, as STDDEV_SAMP
+    """
+    ddof = 1
+
+
+PURE_FUNCTIONS = (('greatest', -1, sqliteGreatest),
+                  ('least', -1, sqliteLeast),
+                  ('xgds_epoch', 1, sqliteEpoch),
+                  ('xgds_distance', 4, sqliteDistance),
+                  ('sqrt', 1, unary(math.sqrt)),
+                  ('asin', 1, unary(math.asin)),
+                  ('sin', 1, unary(math.sin)),
+                  ('cos', 1, unary(math.cos)),
+                  ('radians', 1, unary(math.radians)),
+                  ('power', 2, lambda x, y: None if None in (x, y) else math.pow(x, y)))
+
+
+def registerFunctions(sender, connection, **kwargs):
+    """
+    connection_created handler that adds the scoring functions to SQLite
+    """
+    if (connection.vendor != 'sqlite') or not sqliteFunctionsEnabled():
+        return
+    db = connection.connection
+    for name, nargs, fn in PURE_FUNCTIONS:
+        try:
+            db.create_function(name, nargs, fn, deterministic=True)
+        except (TypeError, NotImplementedError):
+            ## older sqlite3 modules can't mark functions deterministic
+            db.create_function(name, nargs, fn)
+    db.create_function('rand', 0, random.random)
+    ## Django's StdDev emits STDDEV_POP, or STDDEV_SAMP with sample=True
+    db.create_aggregate('stddev', 1, StdDev)
+    db.create_aggregate('stddev_pop', 1, StdDev)
+    db.create_aggregate('stddev_samp', 1, SampleStdDev)
+
+
+def usesSqliteFunctions(connection):
+    return (connection.vendor == 'sqlite') and sqliteFunctionsEnabled()
+
+
+def relatedModels(models):
+    """
+    The models plus their parents and every model they point to with a
+    foreign key, parents first
+    """
+    found = []
+    for m in models:
+        targets = [f.rel.to for f in m._meta.fields
+                   if isinstance(f, fields.related.ForeignKey) and f.rel.to is not m]
+        for candidate in list(m._meta.parents.keys()) + targets + [m]:
+            if candidate not in found:
+                found.append(candidate)
+    return found
+
+
+def mirrorIndexes(model, connection):
+    """
+    Index every searchable column that doesn't have one
+    """
+    qn = connection.ops.quote_name
+    table = db_table(model)
+    made = 0
+    with connection.cursor() as cursor:
+        for f in reservoirFields(model):
+            if f.primary_key or f.db_index or f.unique:
+                continue  # already indexed
+            cursor.execute('CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})'
+                           .format(qn('xgds_mirror_%s_%s' % (table, f.column)), qn(table), qn(f.column)))
+            made = made + 1
+    return made
+
+
+def mirrorModel(model, source, target, rebuild=False, batchSize=1000):
+    """
+    Copy a model's rows from the source alias to the target SQLite alias;
+    returns the number copied. Without rebuild, only rows with a larger
+    integer primary key than the mirror's largest are copied.
+    """
+    connection = connections[target]
+    if db_table(model) not in connection.introspection.table_names():
+        with connection.schema_editor() as editor:
+            editor.create_model(model)
+        rebuild = True
+    mirrorIndexes(model, connection)
+
+    rows = model._base_manager.using(source).order_by('pk')
+    incremental = (not rebuild) and isinstance(model._meta.pk, (fields.AutoField, fields.IntegerField))
+    if incremental:
+        last = list(model._base_manager.using(target).order_by('-pk').values_list('pk', flat=True)[:1])
+        if last:
+            rows = rows.filter(pk__gt=last[0])
+    else:
+        ## plain SQL, so nothing cascades into other mirrored tables
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % connection.ops.quote_name(db_table(model)))
+
+    copied = 0
+    batch = []
+    for instance in rows.iterator():
+        if model._meta.parents:
+            ## bulk_create can't do inherited models; a raw save writes only
+            ## this model's table, the parents are mirrored on their own
+            instance.save_base(using=target, raw=True, force_insert=True)
+            copied = copied + 1
+            continue
+        batch.append(instance)
+        if len(batch) >= batchSize:
+            model._base_manager.using(target).bulk_create(batch)
+            copied = copied + len(batch)
+            batch = []
+    if batch:
+        model._base_manager.using(target).bulk_create(batch)
+        copied = copied + len(batch)
+    return copied
+
+
+def analyzeMirror(target):
+    """
+    Refresh SQLite's statistics so the planner uses the new indexes
+    """
+    with connections[target].cursor() as cursor:
+        cursor.execute('ANALYZE')
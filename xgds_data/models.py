@@ -233,31 +233,85 @@ class VirtualIncludedField(models.Field):
         self.verbose_name = base_verbose_name
 
     def throughModels(self):
-        match = None
-        for f in xgds_data.introspection.modelFields(self.model):
-            if f.name == self.throughfield_name:
-                match = f
-        if (match is not None):
-            try:
-                ct_field = match.ct_field
-            except AttributeError:  # not a GenericForeignKey
-                ct_field = None
-            if ct_field:
-                throughmodels = [ContentType.objects.get_for_id(x[0]).model_class()
-                                 for x in self.model.objects.values_list(match.ct_field).distinct()]
-            else:
-                throughmodels = [match.rel.to]
-            return throughmodels
-        else:
-            return []
+        ## imported here because through imports introspection, which imports this module
+        from xgds_data.through import resolveThrough
+        return list(resolveThrough(self)[0])
 
     def targetFields(self):
-        targets = []
-        for tm in self.throughModels():
-            for tmf in xgds_data.introspection.modelFields(tm):
-                if tmf.name == self.base_name:
-                    targets.append(tmf)
-        return targets
+        from xgds_data.through import resolveThrough
+        return list(resolveThrough(self)[1])
+
+
+class TrigramPosting(models.Model):
+    """
+    Inverted trigram index entry, for substring search on backends without pg_trgm
+    """
+    model = models.CharField(max_length=128, blank=False)
+    field = models.CharField(max_length=128, blank=False)
+    trigram = models.CharField(max_length=3, blank=False)
+    rowId = models.BigIntegerField(blank=False)
+
+    class Meta:
+        index_together = (('model', 'field', 'trigram'),
+                          ('model', 'field', 'rowId'))
+
+
+class GeoCell(models.Model):
+    """
+    Grid cell of a row's location, for one of the model's lat/lon field pairs
+    (named by its latitude field)
+    """
+    model = models.CharField(max_length=128, blank=False)
+    field = models.CharField(max_length=128, blank=False)
+    cell = models.CharField(max_length=32, blank=False)
+    rowId = models.BigIntegerField(blank=False)
+
+    class Meta:
+        index_together = (('model', 'field', 'cell'),
+                          ('model', 'field', 'rowId'))
+
+
+class GlobalSearchTerm(models.Model):
+    """
+    One term of a record in the cross-model search index. Text words have no
+    number; configured numeric fields are stored as their field name plus
+    the value. The record's primary time is copied onto every term.
+    """
+    fullid = models.CharField(max_length=255, blank=False, db_index=True)
+    term = models.CharField(max_length=64, blank=False)
+    number = models.FloatField(null=True, blank=True)
+    epoch = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        index_together = (('term', 'epoch'),
+                          ('term', 'number'))
+
+
+class StandingQuery(models.Model):
+    """
+    A saved search that is checked against every new row of its model
+    """
+    name = models.CharField(max_length=128, blank=False)
+    model = models.CharField(max_length=128, blank=False, db_index=True)
+    user = models.ForeignKey(User, null=True, blank=True)
+    data = models.TextField(blank=False)  # formset data, as JSON
+    soft = models.BooleanField(default=False)
+    threshold = models.FloatField(null=True, blank=True)
+    active = models.BooleanField(default=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return self.name
+
+
+class StandingQueryHit(models.Model):
+    """
+    A new row that matched a standing query
+    """
+    query = models.ForeignKey(StandingQuery, related_name='hits')
+    fullid = models.CharField(max_length=128, blank=False)
+    score = models.FloatField(null=True, blank=True)
+    recorded = models.DateTimeField(auto_now_add=True, db_index=True)
 
 
 ## taken from http://stackoverflow.com/questions/4581789/how-do-i-get-user-ip-address-in-django
@@ -387,3 +441,38 @@ if cacheStatistics():
         field = models.CharField(max_length=128, db_index=True, blank=True)
         statistic = models.CharField(max_length=128, db_index=True, blank=False)
         value = models.FloatField(blank=False)
+
+    class FieldSketch(models.Model):
+        """
+        HyperLogLog sketch of the distinct values of a field, so we can
+        estimate field cardinality without a DISTINCT scan
+        """
+        recorded = models.DateTimeField(blank=False, default=timezone.now)
+        model = models.CharField(max_length=128, db_index=True, blank=False)
+        field = models.CharField(max_length=128, db_index=True, blank=False)
+        precision = models.PositiveSmallIntegerField(default=12)
+        registers = models.TextField(blank=False)
+        ## highest primary key folded into the sketch, for incremental refresh
+        maxPk = models.BigIntegerField(null=True, blank=True)
+
+    class ReservoirSample(models.Model):
+        """
+        Bookkeeping for the uniform random sample of rows kept for a model
+        """
+        recorded = models.DateTimeField(blank=False, default=timezone.now)
+        model = models.CharField(max_length=128, unique=True, blank=False)
+        size = models.PositiveIntegerField(blank=False)
+        ## rows offered to the reservoir so far
+        seen = models.BigIntegerField(default=0)
+
+    class ReservoirRow(models.Model):
+        """
+        One sampled row; only numeric, time and categorical values are kept, as json
+        """
+        reservoir = models.ForeignKey(ReservoirSample, related_name='rows')
+        slot = models.PositiveIntegerField(blank=False)
+        rowId = models.CharField(max_length=128, blank=False)
+        values = models.TextField(blank=False)
+
+        class Meta:
+            unique_together = (('reservoir', 'slot'),)
@@ -0,0 +1,182 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Fetching a page of search results with its queries running side by side.
+
+Normally the hard count, the soft count, the page and then each related
+prefetch run one after another. With XGDS_DATA_CONCURRENT_FETCH, the
+counts and the page queries are issued at once on a small pool of worker
+threads (XGDS_DATA_FETCH_WORKERS), each with its own database connection,
+and the prefetches of the chosen page run side by side too, so a page
+takes about as long as its slowest query. The workers run under what is
+left of the request's search deadline, and stop if it is cancelled. The
+soft queries are issued speculatively only when the stored sample doesn't
+already show the hard matches are too many for a soft search. The results
+are the same as views.queryLogic's.
+"""
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import close_old_connections
+try:
+    from django.db.models import prefetch_related_objects
+
+    def prefetchLookup(results, lookup):
+        prefetch_related_objects(results, lookup)
+except ImportError:
+    ## before Django 1.10
+    from django.db.models.query import prefetch_related_objects
+
+    def prefetchLookup(results, lookup):
+        prefetch_related_objects(results, [lookup])
+
+from xgds_data.routers import readAlias, replicaReads
+from xgds_data.limits import (currentLimit, workerDeadline, waitForWorkers, guardCost,
+                              SearchTooExpensive)
+from xgds_data.search import getMatches, estimateMatches
+
+## the most hard matches for which a soft search is run (as in queryLogic)
+SOFT_LIMIT = 1E2
+
+poolLock = threading.Lock()
+fetchPool = None
+
+
+def concurrentFetchEnabled():
+    return getattr(settings, 'XGDS_DATA_CONCURRENT_FETCH', False)
+
+
+def workerPool():
+    global fetchPool
+    with poolLock:
+        if fetchPool is None:
+            fetchPool = ThreadPool(getattr(settings, 'XGDS_DATA_FETCH_WORKERS', 4))
+    return fetchPool
+
+
+def runConcurrently(model, tasks):
+    """
+    Run the (name, function) tasks on the worker pool, reading from the
+    caller's database alias under what is left of the caller's deadline
+    (time queued for a worker counts, and cancelling the search stops the
+    workers); returns {name: result}
+    """
+    alias = readAlias()
+    limit = currentLimit(model)
+
+    def run(fn):
+        ## workers keep their connections between tasks, within CONN_MAX_AGE
+        close_old_connections()
+        with replicaReads(alias), workerDeadline(limit):
+            return fn()
+
+    names = [name for name, fn in tasks]
+    pending = [workerPool().apply_async(run, (fn,)) for name, fn in tasks]
+    return dict(zip(names, waitForWorkers(limit, pending)))
+
+
+def pageOf(results, queryStart, queryEnd):
+    if (queryEnd is not None) and (queryStart is None):
+        return results[0:queryEnd]
+    elif (queryEnd is None) and (queryStart is not None):
+        return results[queryStart:]
+    elif (queryEnd is not None) and (queryStart is not None):
+        return results[queryStart:queryEnd]
+    return results
+
+
+def prefetchConcurrently(model, results, lookups):
+    """
+    prefetch_related on a fetched list, one lookup per worker
+    """
+    if (not results) or (not lookups):
+        return
+    for r in results:
+        ## made up front, so the workers only add keys to it
+        if not hasattr(r, '_prefetched_objects_cache'):
+            r._prefetched_objects_cache = {}
+    runConcurrently(model, [(lookup, (lambda l: lambda: prefetchLookup(results, l))(lookup))
+                            for lookup in lookups])
+
+
+def parallelFetchPage(myModel, qdatas, queryStart=None, queryEnd=None, soft=True,
+                      queryGenerator=None, notes=None, databases=None, prefetch=()):
+    """
+    (results, hardCount, totalCount) for a page, with the queries run side
+    by side; None if the results aren't plain query sets, so there's
+    nothing to run side by side
+    """
+    hardresults = getMatches(myModel, qdatas, threshold=1.0,
+                             queryGenerator=queryGenerator, databases=databases)
+    if not hasattr(hardresults, 'query'):
+        return None
+    candidateNotes = {'hard': [], 'soft': []}
+    ## as in queryLogic, the cost guard runs before anything is counted, and
+    ## the count and the page come from the same (possibly sampled) query
+    hardresults = guardCost(myModel, hardresults, notes=candidateNotes['hard'])
+
+    def fetch(results):
+        return lambda: list(pageOf(results, queryStart, queryEnd))
+
+    def softTasks(speculative=False):
+        softresults = getMatches(myModel, qdatas, queryGenerator=queryGenerator,
+                                 databases=databases)
+        if not hasattr(softresults, 'query'):
+            return None
+        try:
+            softresults = guardCost(myModel, softresults, notes=candidateNotes['soft'])
+        except SearchTooExpensive:
+            if speculative:
+                return []  # only an error if the soft search turns out to be needed
+            raise
+        return [('softCount', softresults.count), ('softPage', fetch(softresults))]
+
+    speculate = soft
+    if soft:
+        ## don't start the soft queries if the sample says they won't be used
+        estimate = estimateMatches(myModel, qdatas, soft=False)
+        if (estimate is not None) and (estimate > 10 * SOFT_LIMIT):
+            speculate = False
+    tasks = [('hardCount', hardresults.count), ('hardPage', fetch(hardresults))]
+    if speculate:
+        more = softTasks(speculative=True)
+        if more is None:
+            return None
+        tasks.extend(more)
+    done = runConcurrently(myModel, tasks)
+
+    hardCount = done['hardCount']
+    if soft and (hardCount <= SOFT_LIMIT):
+        if 'softCount' not in done:
+            ## the sample was wrong; run the soft queries after all
+            more = softTasks()
+            if more is None:
+                return None
+            done.update(runConcurrently(myModel, more))
+        kind = 'soft'
+    else:
+        kind = 'hard'
+    totalCount = done[kind + 'Count']
+    results = done[kind + 'Page'] if totalCount else []
+    if notes is not None:
+        notes.extend(candidateNotes[kind])
+    prefetchConcurrently(myModel, results, prefetch)
+    return (results, hardCount, totalCount)
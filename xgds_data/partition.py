@@ -0,0 +1,267 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Time-partitioned storage for large append-only models.
+
+Models listed in XGDS_DATA_TIME_PARTITIONS are split by their primary time
+field (see XGDS_DATA_TIME_FIELDS) into one table per day, month or year:
+
+XGDS_DATA_TIME_PARTITIONS['myapp'] = {'Telemetry': ['month']}
+
+On Postgres the model's table is a native declarative partitioned table and
+./manage.py xgds_data_partition adds the period partitions; the planner
+prunes them once the query carries bounds on the time field. On other
+backends the model's own table holds recent rows and the command moves
+each finished period into its own table, which search reaches through an
+unmanaged clone of the model.
+"""
+
+import re
+import datetime
+import threading
+import calendar
+
+import pytz
+from django.db import connection, models, transaction
+from django.conf import settings
+
+from xgds_data.introspection import (settingsForModel, getPrimaryTimeField,
+                                     db_table, modelName)
+from xgds_data.cache import Cache
+
+PERIODS = ('day', 'month', 'year')
+
+## model classes can't be made twice, so these never expire and are made under a lock
+partitionModelCache = Cache('partitionModel', ttl=None, maxSize=None)
+partitionModelLock = threading.Lock()
+
+
+def partitionPeriod(model):
+    """
+    'day', 'month' or 'year' if the model is time partitioned, else None
+    """
+    try:
+        periods = settingsForModel(settings.XGDS_DATA_TIME_PARTITIONS, model)
+    except AttributeError:
+        return None
+    for p in periods:
+        if p in PERIODS:
+            return p
+    return None
+
+
+def isPartitioned(model):
+    return ((partitionPeriod(model) is not None) and
+            (getPrimaryTimeField(model) is not None) and
+            (not isPartitionClone(model)))
+
+
+def isPartitionClone(model):
+    return getattr(model, 'partitionOf', None) is not None
+
+
+def usesNativePartitions():
+    return connection.vendor == 'postgresql'
+
+
+def toEpoch(value):
+    """
+    Epoch seconds (UTC) of a time value; numbers are assumed to be epoch seconds already
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.utc)
+        return calendar.timegm(value.timetuple()) + value.microsecond / 1E6
+    elif isinstance(value, datetime.date):
+        return calendar.timegm(value.timetuple())
+    else:
+        return float(value)
+
+
+def periodStart(epoch, period):
+    dt = datetime.datetime.utcfromtimestamp(epoch)
+    if period == 'day':
+        dt = datetime.datetime(dt.year, dt.month, dt.day)
+    elif period == 'month':
+        dt = datetime.datetime(dt.year, dt.month, 1)
+    else:
+        dt = datetime.datetime(dt.year, 1, 1)
+    return dt
+
+
+def nextPeriod(dt, period):
+    if period == 'day':
+        return dt + datetime.timedelta(days=1)
+    elif period == 'month':
+        if dt.month == 12:
+            return datetime.datetime(dt.year + 1, 1, 1)
+        return datetime.datetime(dt.year, dt.month + 1, 1)
+    else:
+        return datetime.datetime(dt.year + 1, 1, 1)
+
+
+def periodKey(dt, period):
+    return dt.strftime({'day': '%Y%m%d', 'month': '%Y%m', 'year': '%Y'}[period])
+
+
+def partitionTable(model, dt):
+    return '%s_p%s' % (db_table(model), periodKey(dt, partitionPeriod(model)))
+
+
+def periodsBetween(model, loEpoch, hiEpoch):
+    """
+    Start times of the periods overlapping [loEpoch, hiEpoch)
+    """
+    period = partitionPeriod(model)
+    dt = periodStart(loEpoch, period)
+    starts = []
+    while toEpoch(dt) < hiEpoch:
+        starts.append(dt)
+        dt = nextPeriod(dt, period)
+    return starts
+
+
+def existingPartitions(model):
+    """
+    {period start: table name} of the period tables that exist
+    """
+    period = partitionPeriod(model)
+    pattern = re.compile(r'^%s_p(\d+)$' % re.escape(db_table(model)))
+    fmt = {'day': '%Y%m%d', 'month': '%Y%m', 'year': '%Y'}[period]
+    result = dict()
+    for name in connection.introspection.table_names():
+        m = pattern.match(name)
+        if m:
+            try:
+                result[datetime.datetime.strptime(m.group(1), fmt)] = name
+            except ValueError:
+                pass  # some other table
+    return result
+
+
+def timeValue(model, epoch):
+    """
+    Epoch seconds as a value of the model's time field
+    """
+    field = model._meta.get_field(getPrimaryTimeField(model))
+    if isinstance(field, models.DateTimeField):
+        dt = datetime.datetime.utcfromtimestamp(epoch)
+        if settings.USE_TZ:
+            dt = dt.replace(tzinfo=pytz.utc)
+        return dt
+    return epoch
+
+
+def partitionModel(model, table):
+    """
+    Unmanaged clone of the model that reads from one period table
+    """
+    key = (model, table)
+    clone = partitionModelCache.get(key)
+    if clone is not None:
+        return clone
+    with partitionModelLock:
+        clone = partitionModelCache.get(key)
+        if clone is not None:
+            return clone
+        attrs = {'__module__': model.__module__,
+                 'partitionOf': model,
+                 'Meta': type('Meta', (object,),
+                              {'db_table': table,
+                               'managed': False,
+                               'app_label': 'xgds_data',
+                               'verbose_name': model._meta.verbose_name,
+                               'verbose_name_plural': model._meta.verbose_name_plural})}
+        for f in model._meta.local_fields:
+            name, path, args, kwargs = f.deconstruct()
+            if f.is_relation:
+                ## no reverse accessors, they would clash with the real model's
+                kwargs['related_name'] = '+'
+            attrs[f.name] = f.__class__(*args, **kwargs)
+        cloneName = '%s_%s' % (modelName(model), table)
+        clone = type(str(cloneName), (models.Model,), attrs)
+        partitionModelCache.set(key, clone)
+    return clone
+
+
+def partitionsFor(model, bounds):
+    """
+    The models to search for rows within bounds, a list of (lo, hi) epoch
+    intervals or None for no limit. The model itself holds the rows that
+    have not been moved to a period table yet.
+    """
+    tables = existingPartitions(model)
+    if not tables:
+        return [model]
+    period = partitionPeriod(model)
+    ## everything before this has been moved out of the main table
+    movedUntil = toEpoch(nextPeriod(max(tables.keys()), period))
+    if bounds is None:
+        bounds = [(float('-inf'), float('inf'))]
+    wanted = []
+    for start in sorted(tables.keys()):
+        lo = toEpoch(start)
+        hi = toEpoch(nextPeriod(start, period))
+        if any((blo < hi) and (bhi >= lo) for blo, bhi in bounds):
+            wanted.append(partitionModel(model, tables[start]))
+    if any(bhi >= movedUntil for blo, bhi in bounds):
+        wanted.append(model)
+    return wanted
+
+
+def createPartitionSql(model, start):
+    """
+    Statement adding a native partition for the period starting at start (Postgres)
+    """
+    qn = connection.ops.quote_name
+    end = nextPeriod(start, partitionPeriod(model))
+    field = model._meta.get_field(getPrimaryTimeField(model))
+    if isinstance(field, models.DateTimeField):
+        zone = '+00:00' if settings.USE_TZ else ''
+        lo, hi = ("'%s%s'" % (start.isoformat(), zone), "'%s%s'" % (end.isoformat(), zone))
+    else:
+        lo, hi = toEpoch(start), toEpoch(end)
+    return ('CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} FOR VALUES FROM ({2}) TO ({3})'
+            .format(qn(partitionTable(model, start)), qn(db_table(model)), lo, hi))
+
+
+def movePeriod(model, start):
+    """
+    Move the rows of one finished period from the model's table into its
+    own table (non-Postgres backends). Returns the number of rows moved.
+    """
+    table = partitionTable(model, start)
+    clone = partitionModel(model, table)
+    if table not in connection.introspection.table_names():
+        with connection.schema_editor() as editor:
+            editor.create_model(clone)
+    field = model._meta.get_field(getPrimaryTimeField(model))
+    bounds = [field.get_db_prep_value(timeValue(model, toEpoch(t)), connection)
+              for t in (start, nextPeriod(start, partitionPeriod(model)))]
+    qn = connection.ops.quote_name
+    columns = ', '.join([qn(f.column) for f in model._meta.local_fields])
+    where = '{0} >= %s AND {0} < %s'.format(qn(field.column))
+    ## copy and delete in the database; rows referencing these keep their keys
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2} WHERE {3}'
+                           .format(qn(table), columns, qn(db_table(model)), where), bounds)
+            moved = cursor.rowcount
+            cursor.execute('DELETE FROM {0} WHERE {1}'.format(qn(db_table(model)), where), bounds)
+    return moved
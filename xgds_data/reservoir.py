@@ -0,0 +1,230 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+"""
+A stored, uniformly random sample of each searchable model, so that
+estimates (medians, spreads, approximate counts) can be computed in python
+instead of drawing a fresh random sample from the base table every time.
+
+The sample is built with ./manage.py xgds_data_reservoir and kept up to
+date on insert with reservoir sampling (Vitter's algorithm R).
+"""
+
+import json
+import random
+import datetime
+import calendar
+from decimal import Decimal
+
+import pytz
+from django.db import transaction
+from django.db.models import F, Model, fields
+from django.conf import settings
+
+from xgds_data.models import cacheStatistics
+from xgds_data.introspection import (qualifiedModelName, maskField, isNumeric,
+                                     isAbstract, pk)
+from xgds_data.cache import Cache
+if cacheStatistics():
+    from xgds_data.models import ReservoirSample, ReservoirRow
+
+## sampled rows by model, and under SAMPLED the models that have a
+## sample; the sample changes on insert, so entries expire
+reservoirCache = Cache('reservoir', maxSize=200)
+SAMPLED = 'sampledModels'
+
+
+def reservoirSize():
+    """
+    How many rows to keep per model
+    """
+    try:
+        return settings.XGDS_DATA_RESERVOIR_SIZE
+    except AttributeError:
+        return 10000
+
+
+def comparableValue(value):
+    """
+    Convert a field value into something we can store in json and score in
+    python: times become epoch seconds, related objects become their keys
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.utc)
+        return calendar.timegm(value.timetuple()) + value.microsecond / 1E6
+    elif isinstance(value, datetime.date):
+        return calendar.timegm(value.timetuple())
+    elif isinstance(value, Decimal):
+        return float(value)
+    elif isinstance(value, Model):
+        return value.pk
+    else:
+        return value
+
+
+def reservoirFields(model):
+    """
+    The numeric, time and categorical fields of the model, which are the ones sampled
+    """
+    rfields = []
+    for f in model._meta.fields:
+        if maskField(f) and (f is not pk(model)):
+            pass
+        elif (isNumeric(model, f) or
+              isinstance(f, (fields.DateTimeField, fields.DateField,
+                             fields.BooleanField, fields.NullBooleanField,
+                             fields.related.ForeignKey))):
+            rfields.append(f)
+        elif isinstance(f, fields.CharField) and f.choices:
+            rfields.append(f)
+    return rfields
+
+
+def rowValues(instance, rfields):
+    """
+    The sampled values of one row, keyed by field name
+    """
+    return dict([(f.name, comparableValue(getattr(instance, f.attname)))
+                 for f in rfields])
+
+
+def rebuildReservoir(model, size=None):
+    """
+    Draw a new sample in one pass over the table
+    """
+    if size is None:
+        size = reservoirSize()
+    rfields = reservoirFields(model)
+    qname = qualifiedModelName(model)
+    sample = []
+    seen = 0
+    for instance in model.objects.only(*[f.name for f in rfields]).iterator():
+        seen = seen + 1
+        if len(sample) < size:
+            sample.append(instance)
+        else:
+            j = random.randint(0, seen - 1)
+            if j < size:
+                sample[j] = instance
+
+    with transaction.atomic():
+        ReservoirSample.objects.filter(model=qname).delete()
+        reservoir = ReservoirSample.objects.create(model=qname, size=size, seen=seen)
+        ReservoirRow.objects.bulk_create([ReservoirRow(reservoir=reservoir,
+                                                       slot=slot,
+                                                       rowId=str(instance.pk),
+                                                       values=json.dumps(rowValues(instance, rfields)))
+                                          for slot, instance in enumerate(sample)])
+    reservoirCache.pop(model)
+    reservoirCache.pop(SAMPLED)
+    return seen
+
+
+def sampledModels():
+    """
+    {qualified model name: (reservoir id, size)} of the models with a
+    sample, so inserts into the others cost nothing
+    """
+    def load():
+        return dict([(qname, (rid, size)) for qname, rid, size in
+                     ReservoirSample.objects.values_list('model', 'pk', 'size')])
+
+    return reservoirCache.getOrCompute(SAMPLED, load)
+
+
+def offerToReservoir(instance):
+    """
+    Reservoir sampling step for a newly inserted row. It runs once the
+    insert commits, outside the writer's transaction (and not at all if
+    it rolls back).
+    """
+    model = instance.__class__
+    sampled = sampledModels().get(qualifiedModelName(model))
+    if sampled is None:
+        return  # no sample built for this model
+    reservoirId, size = sampled
+    ## taken now, before the caller changes the instance
+    rowId = str(instance.pk)
+    values = json.dumps(rowValues(instance, reservoirFields(model)))
+
+    def offer():
+        ReservoirSample.objects.filter(pk=reservoirId).update(seen=F('seen') + 1)
+        try:
+            seen = ReservoirSample.objects.values_list('seen', flat=True).get(pk=reservoirId)
+        except ReservoirSample.DoesNotExist:
+            return  # rebuilt in the meantime
+        slot = seen - 1
+        if slot >= size:
+            slot = random.randint(0, seen - 1)
+        if slot < size:
+            updated = ReservoirRow.objects.filter(reservoir_id=reservoirId, slot=slot).update(rowId=rowId,
+                                                                                               values=values)
+            if not updated:
+                ReservoirRow.objects.create(reservoir_id=reservoirId, slot=slot,
+                                            rowId=rowId, values=values)
+
+    try:
+        transaction.on_commit(offer)
+    except AttributeError:
+        ## before Django 1.9
+        offer()
+
+
+def reservoirInsertHandler(sender, instance, created=False, raw=False, **kwargs):
+    """
+    post_save handler that keeps the samples current
+    """
+    if created and not raw and cacheStatistics():
+        if sender.__module__.startswith('xgds_data.') or isAbstract(sender):
+            return  # don't sample our own bookkeeping
+        offerToReservoir(instance)
+
+
+def getReservoir(model):
+    """
+    The sampled rows of a model as a list of dicts, or None if there is no sample
+    """
+    if not cacheStatistics():
+        return None
+
+    def loadRows():
+        rows = [json.loads(v) for v in
+                ReservoirRow.objects.filter(reservoir__model=qualifiedModelName(model)).values_list('values', flat=True)]
+        return rows or None
+
+    return reservoirCache.getOrCompute(model, loadRows)
+
+
+def sampledValues(model, fieldName):
+    """
+    Non-null sampled values of one field, or None if the field isn't sampled
+    """
+    rows = getReservoir(model)
+    if (rows is None) or (fieldName not in rows[0]):
+        return None
+    return [r[fieldName] for r in rows if r.get(fieldName) is not None]
+
+
+def sampledIds(model):
+    """
+    Primary keys of the sampled rows, or None if there is no sample
+    """
+    if not cacheStatistics():
+        return None
+    ids = list(ReservoirRow.objects.filter(reservoir__model=qualifiedModelName(model)).values_list('rowId', flat=True))
+    return ids or None
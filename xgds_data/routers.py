@@ -0,0 +1,202 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Sending read-only search work to database replicas.
+
+Searches, counts, samples and statistics scans run inside replicaReads(),
+which picks one alias from XGDS_DATA_READ_REPLICAS for the whole block, so
+that the count and the page of a search come from the same copy. Outside
+such a block, and for every write, the primary ('default', or
+XGDS_DATA_PRIMARY_DATABASE) is used, so logging, edits, deletes and
+collection changes never go to a replica.
+
+To enable it, list the replica aliases in DATABASES and in
+XGDS_DATA_READ_REPLICAS, and add the router:
+
+  DATABASE_ROUTERS = ['xgds_data.routers.ReplicaRouter']
+
+XGDS_DATA_REPLICA_POLICY is 'round-robin' (the default) or 'lag', which
+picks the replica that is least behind, skipping those more than
+XGDS_DATA_REPLICA_MAX_LAG seconds behind (falling back to the primary).
+Locally, two SQLite files will do: copy the primary's file and list the
+copy as a replica; give it TEST = {'MIRROR': 'default'} for tests.
+"""
+
+import threading
+import itertools
+from functools import wraps
+from contextlib import contextmanager
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.utils import DatabaseError
+from django.conf import settings
+
+from xgds_data.cache import Cache
+
+readState = threading.local()
+roundRobin = itertools.count()
+roundRobinLock = threading.Lock()
+replicaLags = Cache('replicaLag', ttl=10, maxSize=None)
+
+
+def primaryAlias():
+    return getattr(settings, 'XGDS_DATA_PRIMARY_DATABASE', DEFAULT_DB_ALIAS)
+
+
+def replicaAliases():
+    """
+    The configured replicas that are actually in DATABASES
+    """
+    return [alias for alias in getattr(settings, 'XGDS_DATA_READ_REPLICAS', ())
+            if alias in settings.DATABASES]
+
+
+def replicationLag(alias):
+    """
+    Seconds the replica is behind the primary; None if it can't be reached
+    """
+    def measure():
+        conn = connections[alias]
+        try:
+            with conn.cursor() as cursor:
+                if conn.vendor == 'postgresql':
+                    ## the last replay gets older while the primary is idle, so a
+                    ## replica that has replayed all it received isn't behind
+                    if getattr(conn, 'pg_version', 0) >= 100000:
+                        received, replayed = 'pg_last_wal_receive_lsn()', 'pg_last_wal_replay_lsn()'
+                    else:
+                        received, replayed = ('pg_last_xlog_receive_location()',
+                                              'pg_last_xlog_replay_location()')
+                    cursor.execute('SELECT CASE WHEN {0} = {1} THEN 0 ELSE '
+                                   'COALESCE(EXTRACT(EPOCH FROM now() - '
+                                   'pg_last_xact_replay_timestamp()), 0) END'
+                                   .format(received, replayed))
+                    return float(cursor.fetchone()[0])
+                elif conn.vendor == 'mysql':
+                    cursor.execute('SHOW SLAVE STATUS')
+                    row = cursor.fetchone()
+                    if row is None:
+                        return 0.0  # not replicating, so not behind
+                    columns = [c[0] for c in cursor.description]
+                    lag = dict(zip(columns, row)).get('Seconds_Behind_Master')
+                    return None if lag is None else float(lag)
+                else:
+                    return 0.0
+        except DatabaseError:
+            return None
+    return replicaLags.getOrCompute(alias, measure)
+
+
+def chooseReplica():
+    """
+    The alias a block of read-only work should use
+    """
+    replicas = replicaAliases()
+    if not replicas:
+        return primaryAlias()
+    if getattr(settings, 'XGDS_DATA_REPLICA_POLICY', 'round-robin') == 'lag':
+        maxLag = getattr(settings, 'XGDS_DATA_REPLICA_MAX_LAG', 30)
+        lags = [(replicationLag(alias), alias) for alias in replicas]
+        lags = [(lag, alias) for lag, alias in lags
+                if (lag is not None) and ((maxLag is None) or (lag <= maxLag))]
+        if not lags:
+            return primaryAlias()
+        return min(lags)[1]
+    with roundRobinLock:
+        n = next(roundRobin)
+    return replicas[n % len(replicas)]
+
+
+@contextmanager
+def replicaReads(alias=None):
+    """
+    Run the enclosed reads on one replica (or the given alias). Nested
+    blocks keep the outer block's choice.
+    """
+    outer = getattr(readState, 'alias', None)
+    if outer is None:
+        readState.alias = alias or chooseReplica()
+    try:
+        yield readState.alias
+    finally:
+        if outer is None:
+            readState.alias = None
+
+
+def readsFromReplica(fn):
+    """
+    Decorator that runs the whole function inside replicaReads
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with replicaReads():
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def readAlias():
+    """
+    The alias reads go to on this thread right now
+    """
+    return getattr(readState, 'alias', None) or primaryAlias()
+
+
+def isPrimaryCopy(alias):
+    """
+    Is this the primary or one of its replicas (as opposed to another database)?
+    """
+    return (alias == primaryAlias()) or (alias in replicaAliases())
+
+
+def readConnection():
+    return connections[readAlias()]
+
+
+def closeConnections():
+    """
+    Close this thread's connections, e.g. at the end of a worker thread
+    """
+    for conn in connections.all():
+        conn.close()
+
+
+class ReplicaRouter(object):
+    """
+    Reads inside replicaReads go to its replica; writes always go to the
+    primary, even for objects that were read from a replica
+    """
+    def db_for_read(self, model, **hints):
+        return getattr(readState, 'alias', None)
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if (instance is not None) and (instance._state.db in replicaAliases()):
+            return primaryAlias()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        copies = set(replicaAliases() + [primaryAlias()])
+        if (obj1._state.db in copies) and (obj2._state.db in copies):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replicaAliases():
+            return False  # replicas get their schema from the primary
+        return None
@@ -23,7 +23,6 @@ from math import floor, log10, pow as mpow  # shadows built-in pow()
 from operator import itemgetter
 
 #from django import forms
-from django.db import connection
 from django.db.models import (Q, Field, fields, StdDev)
 from django.db.models.fields import (PositiveIntegerField, PositiveSmallIntegerField)
 #from django.contrib.contenttypes.generic import GenericForeignKey
@@ -33,16 +32,30 @@ from django.core.exceptions import ObjectDoesNotExist
 
 from xgds_data.introspection import (modelFields, resolveField, maskField,
                                      isAbstract, concreteDescendants,
-                                     pk, db_table, fullid, accessorDict,
-                                     resolveModel, fieldModel, parentField)
+                                     pk, db_table, fullid, fieldPath, modelInfo,
+                                     resolveModel, fieldModel, parentField,
+                                     qualifiedModelName, getPrimaryTimeField,
+                                     resolveSetting)
 from xgds_data.models import (cacheStatistics, VirtualIncludedField)
 if cacheStatistics():
     from xgds_data.models import ModelStatistic
 from xgds_data.DataStatistics import (tableSize, segmentBounds, nextPercentile,
                                       getStatistic)
 from xgds_data.utils import (total_seconds, handleFunnyCharacters)
-
-sdCache = dict()
+from xgds_data.reservoir import (getReservoir, sampledValues, sampledIds, comparableValue)
+from xgds_data.partition import (isPartitioned, usesNativePartitions,
+                                 partitionsFor, toEpoch, timeValue)
+from xgds_data.spatial import (spatialFilter, desiredLocations, scoreLocation,
+                               geoPrefix)
+from xgds_data.textindex import (isFullTextField, fullTextFilter,
+                                 isTrigramField, trigramFilter, trigrams,
+                                 trigramSimilaritySql, usesPostingTable)
+from xgds_data.cache import Cache
+from xgds_data.routers import readAlias, readConnection
+from xgds_data.federation import FederatedResults, MergedResults
+from xgds_data.mirror import usesSqliteFunctions
+
+sdCache = Cache('sd')
 
 def timer(t, msg):
     newtime = datetime.datetime.now(pytz.utc)
@@ -91,14 +104,14 @@ def isPostgres():
     """
     Check to see if the backend is postgres, not mysql
     """
-    return settings.DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql_psycopg2'
+    return settings.DATABASES[readAlias()]['ENGINE'] == 'django.db.backends.postgresql_psycopg2'
 
 
 def virtualArguments(model, qdatas, soft=True):
     """
     Gets the portion of a query that applies to virtual fields
     """
-    mfields = dict([(f.name, f) for f in modelFields(model)])
+    mfields = modelInfo(model).fieldsByName
     fdict = dict()
     for qd in qdatas:
         for fieldname, fieldval in qd.iteritems():
@@ -119,30 +132,21 @@ def virtualArguments(model, qdatas, soft=True):
 
 def queryArgChain(model, qcomplexarg):
     """
+    The relations an 'a__b__c' search key goes through (see FieldPath)
     """
-    qchain = []
-    for qa in qcomplexarg.split('__'):
-        ad = accessorDict(model)
-        ## "relation" because it's not necessarily field, could be inverse
-        ## also need to test with many to many fields
-        relation = ad[qa]
-        qchain.append(relation)
-        try:
-            model = relation.rel.to
-        except AttributeError:
-            model = relation.model
-
-    return qchain
+    return list(fieldPath(model, qcomplexarg).relations())
 
 
 ## TODO: does not appear to do anything with hard VirtualIncludedField
 ## constraints, maybe as they show up as generic
-def makeFilters(model, qdatas, soft=True):
+def makeFilters(model, qdatas, soft=True, threshold=None):
     """
-    Helper for getMatches; figures out restrictions given a query parameters
+    Helper for getMatches; figures out restrictions given a query parameters.
+    The threshold, if known, lets soft location constraints restrict too.
     """
     filters = None
-    mfields = dict([(f.name, f) for f in modelFields(model)])
+    nterms = totalweight(model, qdatas) if (soft and threshold is not None) else 1
+    mfields = modelInfo(model).fieldsByName
     ## forms are interpreted as internally conjunctive, externally disjunctive
     for qd in qdatas:
         subfilter = Q()
@@ -216,6 +220,13 @@ def makeFilters(model, qdatas, soft=True):
                             clause = Q(**{basename + '__exact': qval})
                         elif re.match("\s*$", qval) or (operator == '=~'):
                             pass
+                        elif operator == 'MATCH':
+                            ## word match through the text index, if there is one
+                            prefix = ''.join([x + '__' for x in basename.split('__')[:-1]])
+                            if isFullTextField(terminalfield.model, terminalfield):
+                                clause = fullTextFilter(terminalfield.model, terminalfield, qval, prefix=prefix)
+                            if clause is None:
+                                clause = Q(**{basename + '__icontains': qval})
                         elif qval == 'None' and isinstance(terminalfield, fields.NullBooleanField):
                             pass
                         else:
@@ -228,11 +239,18 @@ def makeFilters(model, qdatas, soft=True):
                                 clause = Q(**{basename + '__exact': 0})
                             else:
                                 clause = Q(**{basename + '__icontains': qval})
+                                if (not negate) and isTrigramField(terminalfield.model, terminalfield):
+                                    ## narrow to rows sharing all the trigrams, then verify the substring
+                                    prefix = ''.join([x + '__' for x in basename.split('__')[:-1]])
+                                    candidates = trigramFilter(terminalfield.model, terminalfield, qval, prefix=prefix)
+                                    if candidates is not None:
+                                        clause = candidates & clause
                         if clause:
                             if negate:
                                 subfilter &= ~clause
                             else:
                                 subfilter &= clause
+        subfilter &= spatialFilter(model, qd, soft, threshold, nterms)
 
         if filters:
             filters |= subfilter
@@ -258,6 +276,9 @@ def baseScore(fieldRef, lorange, hirange):
     if (timeConversion):
         if isPostgres():
             fieldRef = "EXTRACT(EPOCH FROM ({0} AT TIME ZONE 'UTC'))".format(fieldRef)
+        elif usesSqliteFunctions(readConnection()):
+            ## registered by xgds_data.mirror
+            fieldRef = "xgds_epoch({0})".format(fieldRef)
         else:
             ## UGH: mysql's UNIX_TIMESTAMP always assumes system timezone, but we are storing UTC
             ## Solution: convert to system time zone and then get unix timestamp
@@ -291,7 +312,7 @@ def randomSample(model, expression, size, offset=None, limit=None):
     else:
         sql = ('select {2} as score from {0} JOIN ({3}) AS r2 USING ({1}) order by score limit {4},{5};'
                .format(table, pkname, expression, randselect, offset, limit))
-    cursor = connection.cursor()
+    cursor = readConnection().cursor()
 ##    runtime = datetime.datetime.now(pytz.utc)
     cursor.execute(sql)
 ##    runtime = timer(runtime, "<<< inner random sample >>>")
@@ -310,19 +331,26 @@ def sdRandomSample(model, expression, size):
     ## consecutive ids, etc
     sql = ('SELECT STDDEV({2}) AS sd FROM {0} JOIN ({3}) AS r2 USING ({1}) ORDER BY sd;'
                .format(table, pkname, expression, randselect))
-    cursor = connection.cursor()
+    cursor = readConnection().cursor()
 ##    runtime = datetime.datetime.now(pytz.utc)
     cursor.execute(sql)
 ##    runtime = timer(runtime, "<<< inner random sample >>>")
     return cursor.fetchall()[0]
 
 
-def countApproxMatches(model, scorer, maxSize, threshold):
+def countApproxMatches(model, scorer, maxSize, threshold, desiderata=None):
     """
     Take a guess as to how many records match by examining a random sample
     """
     cpass = 0.0
-    sample = randomSample(model, scorer, 10000)
+    sample = None
+    if desiderata is not None:
+        ## score the stored sample in python if we can
+        scores = reservoirScores(model, desiderata)
+        if scores is not None:
+            sample = [(x,) for x in scores]
+    if sample is None:
+        sample = randomSample(model, scorer, 10000)
     if len(sample) == 0:
         return 0
     else:
@@ -331,19 +359,31 @@ def countApproxMatches(model, scorer, maxSize, threshold):
                 cpass = cpass + 1
         ##query = query[0:round(maxSize * cpass / len(sample))]
         resultCount = maxSize * cpass / len(sample)
-        ## make it look approximate
-        if resultCount > 10:
-            resultCount = int(round(resultCount / mpow(10, floor(log10(resultCount))))
-                              * mpow(10, floor(log10(resultCount))))
-        elif resultCount > 0:
-            resultCount = 10
-        return resultCount
+        return roundCount(resultCount)
+
+
+def roundCount(resultCount):
+    """
+    make it look approximate
+    """
+    if resultCount > 10:
+        resultCount = int(round(resultCount / mpow(10, floor(log10(resultCount))))
+                          * mpow(10, floor(log10(resultCount))))
+    elif resultCount > 0:
+        resultCount = 10
+    return resultCount
 
 
 def medianEval(model, expression, size):
     """
     Quick mysql-y way of estimating the median from a sample
     """
+    values = sampledValues(model, expression)
+    if values is not None:
+        if len(values) == 0:
+            return None
+        values = sorted(values)
+        return values[int((len(values) - 1) / 2)]
     count = model.objects.count()
     if count == 0:
         return None
@@ -469,16 +509,17 @@ def sdEval(model, expression, size):
     """
     Quick mysql-y way of estimating the median from a sample
     """
+    values = sampledValues(model, expression)
+    if (values is not None) and (len(values) > 1):
+        return shifted_data_variance(values) ** 0.5
     if cacheStatistics():
         fn = lambda: model.objects.all().aggregate(StdDev(expression)).values()[0]
         return getStatistic(model, expression, 'StdDev', fn)
-    try:
-        return sdCache[model][expression]
-    except KeyError:
+
+    def sampledSd():
         count = model.objects.count()
-        if count == 0:
-            ans= None
-        else:
+        ans = None
+        if count > 0:
             sampleSize = min(size, 1000)
             result = ()
             triesLeft = 100
@@ -490,14 +531,10 @@ def sdEval(model, expression, size):
                     ans = None
                 else:
                     ans = result[0]
-        # sdCache[model] = ans
-        try:
-            sdCache[model][expression] = ans
-        except KeyError:
-            sdCache[model] = dict()
-            sdCache[model][expression] = ans
         return ans
 
+    return sdCache.getOrCompute((model, expression), sampledSd)
+
 
 def scaleEval(model, field, lorange, hirange, size, fieldRef):
     """
@@ -512,7 +549,10 @@ def scaleEval(model, field, lorange, hirange, size, fieldRef):
 
     ## if we haven't returned a value already
     ##print('NOT Guessed')
-    if isPostgres():
+    values = sampledValues(model, field.name)
+    if (values is not None) and (len(values) > 1):
+        return shifted_data_variance(values) ** 0.5
+    elif isPostgres():
         ## postgres doesn't do random samples
         fname = field.name
         dataranges = model.objects.aggregate(Min(fname), Max(fname))
@@ -587,9 +627,9 @@ def autoweight(model, field, lorange, hirange, tblSize):
     return 1
 
 
-def scoreNumeric(model, field, lorange, hirange, tsize):
+def numericFieldRef(field):
     """
-    provide a score for a numeric clause that ranges from 1 (best) to 0 (worst)
+    The field's reference in a numeric score formula
     """
     ## Yuk ... need to convert if field is unsigned
     unsigned = False
@@ -600,12 +640,28 @@ def scoreNumeric(model, field, lorange, hirange, tsize):
     fieldRef = dbFieldRef(field)
     if (unsigned):
         fieldRef = "cast({0} as SIGNED)".format(fieldRef)
-    # median = medianEval(field.model, baseScore(fieldRef, lorange, hirange), tsize)
+    return fieldRef
+
+
+def numericScale(model, field, lorange, hirange, tsize):
+    """
+    The scale of a numeric score term, the distance outside the range at which it scores 1/2
+    """
+    fieldRef = numericFieldRef(field)
     try:
         tf = field.targetFields()[0]
-        scale = scaleEval(tf.model, tf, lorange, hirange, tsize, fieldRef)
+        return scaleEval(tf.model, tf, lorange, hirange, tsize, fieldRef)
     except (IndexError,AttributeError):
-        scale = scaleEval(model, field, lorange, hirange, tsize, fieldRef)
+        return scaleEval(model, field, lorange, hirange, tsize, fieldRef)
+
+
+def scoreNumeric(model, field, lorange, hirange, tsize):
+    """
+    provide a score for a numeric clause that ranges from 1 (best) to 0 (worst)
+    """
+    fieldRef = numericFieldRef(field)
+    # median = medianEval(field.model, baseScore(fieldRef, lorange, hirange), tsize)
+    scale = numericScale(model, field, lorange, hirange, tsize)
     if isPostgres():
         nullcheck ="CAST(({0} IS NOT NULL) AS INT)".format(fieldRef)
     else:
@@ -654,13 +710,89 @@ def desiredRanges(qdatas):
                         loval, hival = hival, loval
                     if ((loval != 'min') or (hival != 'max')):
                         desiderata[base] = [loval, hival]
-                elif operator == '=~':
-                    print('what is ', operator)
                 else:
-                    pass
+                    pass  # '=~' is handled by desiredSimilarities
     return desiderata
 
 
+def desiredSimilarities(qdatas):
+    """
+    Pulls out the approximate (soft) text constraints from the form
+    """
+    similarities = dict()
+    for qd in qdatas:
+        for field in qd:
+            if (qd[field] == '=~') and (field.endswith('_operator')):
+                base = field[:-9]
+                qval = qd.get(base)
+                if (qval is not None) and not re.match(r"\s*$", qval):
+                    similarities[base] = handleFunnyCharacters(qval)
+    return similarities
+
+
+def similarityLiteral(qval):
+    """
+    Reduce the query text to words and spaces so it can be inlined as an sql literal
+    """
+    return re.sub(r'[^\w ]+', ' ', qval.decode('utf-8', 'ignore') if isinstance(qval, str) else qval,
+                  flags=re.UNICODE).strip().lower()
+
+
+def scoreSimilarity(model, field, qval):
+    """
+    provide a score for a text similarity clause that ranges from 1 (best) to 0 (worst)
+    """
+    qval = similarityLiteral(qval)
+    if qval == '':
+        return '1'
+    fieldRef = dbFieldRef(field)
+    if isPostgres():
+        return "similarity(CAST({0} AS text), '{1}')".format(fieldRef, qval)
+    elif isTrigramField(fieldModel(field), field) and usesPostingTable():
+        ## correlated with the posting table where the query runs, so the
+        ## formula holds on a replica or another database of a federated search
+        grams = trigrams(qval)
+        if len(grams) == 0:
+            return '0'
+        return trigramSimilaritySql(fieldModel(field), field, grams, dbFieldRef(pk(fieldModel(field))))
+    else:
+        ## no n-gram index, so settle for substring matches
+        return "(CASE WHEN LOWER({0}) LIKE '%%{1}%%' THEN 1 ELSE 0 END)".format(fieldRef, qval)
+
+
+## pg_trgm's default set_limit, the similarity its % operator requires
+PG_TRGM_LIMIT = 0.3
+
+
+def similarityFilters(model, qdatas, threshold):
+    """
+    On postgres, where clauses that let the pg_trgm index skip the rows too
+    unlike the query text to reach threshold, however well the other terms do
+    """
+    similarities = desiredSimilarities(qdatas)
+    if (not similarities) or (not isPostgres()):
+        return []
+    ## every term scores at most 1, so a row needs at least this much similarity
+    terms = totalweight(model, qdatas)
+    limit = terms * threshold - (terms - 1) - 1E-6
+    if limit <= 0:
+        return []
+    clauses = []
+    for b, qval in similarities.items():
+        field = resolveField(model, b)
+        qval = similarityLiteral(qval)
+        if (field is None) or isinstance(field, VirtualIncludedField) or (qval == ''):
+            continue
+        fieldRef = dbFieldRef(field)
+        clauses.append("similarity(CAST({0} AS text), '{1}') >= {2:f}".format(fieldRef, qval, limit))
+        if limit >= PG_TRGM_LIMIT:
+            ## % passes what similarity() >= the session's limit, which we
+            ## leave at its default; it is there so the pg_trgm index is used
+            ## (the same expression as the index, see textindex)
+            clauses.append("UPPER(CAST({0} AS text)) %% '{1}'".format(fieldRef, qval))
+    return clauses
+
+
 # def ishard(frms):
 #     """
 #     Does the query lack soft constraints?
@@ -672,7 +804,9 @@ def sortFormula(model, qdatas):
     """
     Helper for searchChosenModel; comes up with a formula for ordering the results
     """
-    return sortFormulaRanges(model, desiredRanges(qdatas))
+    return sortFormulaRanges(model, desiredRanges(qdatas),
+                             similarities=desiredSimilarities(qdatas),
+                             locations=desiredLocations(model, qdatas))
 
 
 def totalweight(model, qdatas):
@@ -681,20 +815,24 @@ def totalweight(model, qdatas):
     """
     desiderata = desiredRanges(qdatas)
     tw = 0
-    for b in desiderata.keys():
+    for b in list(desiderata.keys()) + list(desiredSimilarities(qdatas).keys()):
         field = resolveField(model, b)
         if (field is None) or isinstance(field, VirtualIncludedField):
             pass
         else:
             tw = tw + 1
-    return tw
+    return tw + len(desiredLocations(model, qdatas))
 
 
-def sortFormulaRanges(model, desiderata):
+def sortFormulaRanges(model, desiderata, similarities=None, locations=None):
     """
     Helper for searchChosenModel; comes up with a formula for ordering the results
     """
-    if (len(desiderata) > 0):
+    if similarities is None:
+        similarities = dict()
+    if locations is None:
+        locations = dict()
+    if (len(desiderata) > 0) or (len(similarities) > 0) or (len(locations) > 0):
         tsize = tableSize(model)
 #        weights = dict([(b, autoweight(model, resolveField(model, b), desiderata[b][0], desiderata[b][1], tsize)) \
 #                              for b in desiderata.keys()])
@@ -708,6 +846,16 @@ def sortFormulaRanges(model, desiderata):
                 pass
             else:
                 scores[b] = scoreNumeric(model, field, desiderata[b][0], desiderata[b][1], tsize)
+        for b, qval in similarities.items():
+            field = resolveField(model, b)
+            if (field is None) or isinstance(field, VirtualIncludedField):
+                pass
+            else:
+                scores[b] = scoreSimilarity(model, field, qval)
+        for pair, (lat, lon, km) in locations.items():
+            scores[geoPrefix(pair)] = scoreLocation(dbFieldRef(model._meta.get_field(pair[0])),
+                                                    dbFieldRef(model._meta.get_field(pair[1])),
+                                                    lat, lon, km)
         if len(scores) == 0:
             return 1
         else:
@@ -717,14 +865,167 @@ def sortFormulaRanges(model, desiderata):
         return 1
 
 
-def sortThreshold():
+def sortThreshold(model=None, desiderata=None, qdatas=None):
     """
-    Guess on a good threshold to cutoff the search results
+    Guess on a good threshold to cutoff the search results. Given qdatas,
+    desiderata are its ranges, and its other soft terms count too.
     """
     ## rather arbitrary cutoff, which would return 30% of results if scores are uniform
+    ## if we have a stored sample, pick the cutoff that actually returns about 30%
+    scores = None
+    if (model is not None) and (qdatas is not None):
+        desiderata = desiredRanges(qdatas)
+        if desiderata and onlyRanges(model, qdatas):
+            scores = reservoirScores(model, desiderata)
+        if scores is None:
+            ## python can only score ranges, so let the database score the sample
+            scores = sampleScores(model, sortFormula(model, qdatas))
+    elif (model is not None) and desiderata:
+        scores = reservoirScores(model, desiderata)
+    if scores:
+        scores = sorted(scores)
+        return scores[int(0.7 * (len(scores) - 1))]
     return 0.7
 
 
+def onlyRanges(model, qdatas):
+    """
+    Are all the soft terms of the query plain ranges?
+    """
+    return (not desiredSimilarities(qdatas)) and (not desiredLocations(model, qdatas))
+
+
+def sampleScores(model, formula):
+    """
+    Soft scores of the rows in the stored sample, computed by the database
+    with the search's own sort formula; None if there is no sample
+    """
+    ids = sampledIds(model)
+    if (not ids) or (formula == 1):
+        return None
+    ## whole records, so inherited fields the formula uses are joined in
+    return [r.score for r in model.objects.filter(**{pk(model).name + '__in': ids})
+            .extra(select={'score': formula})]
+
+
+def reservoirScores(model, desiderata):
+    """
+    Soft scores of the rows in the stored sample, computed in python with
+    the same scales as the sort formula; None if there is no sample or it
+    lacks one of the fields
+    """
+    rows = getReservoir(model)
+    if rows is None:
+        return None
+    ranges = dict()
+    scales = dict()
+    tsize = tableSize(model)
+    for fname, (loval, hival) in desiderata.items():
+        field = resolveField(model, fname)
+        if (fname not in rows[0]) or (field is None) or isinstance(field, VirtualIncludedField):
+            return None
+        ranges[fname] = [comparableValue(loval), comparableValue(hival)]
+        scales[fname] = numericScale(model, field, loval, hival, tsize)
+    return [multiScore(model, r, ranges, scales=scales) for r in rows]
+
+
+def reservoirMatches(model, qdatas, soft=True, threshold=None):
+    """
+    Fraction of the stored sample that passes the hard constraints and, for a
+    soft search, scores at or above the threshold. None if there is no usable sample.
+    """
+    rows = getReservoir(model)
+    if rows is None:
+        return None
+    predicate = rowPredicate(model, qdatas, rows[0].keys())
+    if predicate is None:
+        return None
+    desiderata = desiredRanges(qdatas)
+    if soft and not onlyRanges(model, qdatas):
+        return None  # python can't score the other terms
+    if soft and desiderata:
+        scores = reservoirScores(model, desiderata)
+        if scores is None:
+            return None
+        if threshold is None:
+            threshold = 0.0
+        passed = [r for r, sc in zip(rows, scores) if sc >= threshold and predicate(r)]
+    else:
+        passed = [r for r in rows if predicate(r)]
+    return float(len(passed)) / len(rows)
+
+
+def estimateMatches(model, qdatas, soft=True, threshold=None):
+    """
+    An "about N results" preview from the stored sample; None if we can't tell
+    """
+    fraction = reservoirMatches(model, qdatas, soft=soft, threshold=threshold)
+    if fraction is None:
+        return None
+    return roundCount(fraction * tableSize(model))
+
+
+def rowPredicate(model, qdatas, available):
+    """
+    Compile the hard constraints of the query into a python test over a dict of
+    comparable values (see comparableValue). Returns None if a constraint
+    involves a field that isn't in available.
+    """
+    clauses = []
+    for qd in qdatas:
+        tests = []
+        for fieldname in qd:
+            if not fieldname.endswith('_operator'):
+                continue
+            basename = fieldname[:-(len('_operator'))]
+            operator = qd[fieldname]
+            try:
+                loval = qd[basename + '_lo']
+                hival = qd[basename + '_hi']
+                rangeQuery = True
+            except KeyError:
+                qval = qd.get(basename)
+                rangeQuery = False
+            if rangeQuery:
+                if operator == 'IN~' or (loval is None and hival is None):
+                    continue
+                loval = comparableValue(loval)
+                hival = comparableValue(hival)
+                if (loval is not None) and (hival is not None) and (loval > hival):
+                    loval, hival = hival, loval
+                test = (lambda b, lo, hi:
+                        lambda r: ((r.get(b) is not None) and
+                                   ((lo is None) or (r[b] >= lo)) and
+                                   ((hi is None) or (r[b] <= hi))))(basename, loval, hival)
+                if operator == 'NOT IN':
+                    test = (lambda t, b: lambda r: (r.get(b) is not None) and not t(r))(test, basename)
+            elif (qval is None) or (qval == '') or (operator == '=~'):
+                continue
+            else:
+                qval = comparableValue(qval)
+                if qval == 'True':
+                    qval = True
+                elif qval == 'False':
+                    qval = False
+                elif qval == 'None':
+                    continue
+                if isinstance(qval, basestring):
+                    ## text matches are substring matches, as in makeFilters
+                    test = (lambda b, v: lambda r: ((r.get(b) is not None) and
+                                                    (v.lower() in unicode(r[b]).lower())))(basename, qval)
+                else:
+                    test = (lambda b, v: lambda r: r.get(b) == v)(basename, qval)
+                if operator in ('!=', 'NOT IN'):
+                    test = (lambda t: lambda r: not t(r))(test)
+            if basename not in available:
+                return None
+            tests.append(test)
+        clauses.append(tests)
+
+    ## forms are interpreted as internally conjunctive, externally disjunctive
+    return lambda r: any(all(t(r) for t in tests) for tests in clauses)
+
+
 def pageLimits(page, pageSize):
     """
     bla
@@ -835,21 +1136,152 @@ def virtualProcessing(myModel, qdatas, query, gargs, threshold):
     return results
 
 
-def getMatches(myModel, qdatas, threshold=0.0, orders=[], queryGenerator=None):
+def timeBounds(model, qdatas, threshold):
+    """
+    The time intervals (epoch seconds) that can contain matches, from the
+    constraints on the primary time field, or None if any time can match.
+    A soft range still bounds the search once the threshold is applied: a
+    row that is too far from the range can't score well enough even if
+    every other constraint is met perfectly.
+    """
+    timeField = getPrimaryTimeField(model)
+    field = resolveField(model, timeField)
+    nterms = totalweight(model, qdatas)
+    bounds = []
+    ## forms are disjunctive, so every one of them has to be bounded
+    for qd in qdatas:
+        operator = qd.get(timeField + '_operator')
+        if operator not in ('IN', 'IN~'):
+            return None
+        lo = qd.get(timeField + '_lo')
+        hi = qd.get(timeField + '_hi')
+        lo = float('-inf') if lo in (None, 'None', 'min') else toEpoch(lo)
+        hi = float('inf') if hi in (None, 'None', 'max') else toEpoch(hi)
+        if lo > hi:
+            lo, hi = hi, lo
+        if (operator == 'IN~') and (threshold < 1.0):
+            ## worst score this term can have and still pass the threshold
+            minScore = nterms * threshold - (nterms - 1)
+            if minScore <= 0:
+                return None
+            scale = scaleEval(model, field, lo, hi, tableSize(model), dbFieldRef(field))
+            if isinstance(scale, datetime.timedelta):
+                scale = scale.total_seconds()
+            if scale is None:
+                return None
+            slack = scale * (1 - minScore) / minScore
+            lo, hi = lo - slack, hi + slack
+        bounds.append((lo, hi))
+    return bounds
+
+
+def timeBoundsFilter(model, bounds):
+    """
+    Q object that keeps a query within the time bounds
+    """
+    timeField = getPrimaryTimeField(model)
+    clause = Q()
+    for lo, hi in bounds:
+        args = dict()
+        if lo != float('-inf'):
+            args[timeField + '__gte'] = timeValue(model, lo)
+        if hi != float('inf'):
+            args[timeField + '__lte'] = timeValue(model, hi)
+        clause = clause | Q(**args)
+    return clause
+
+
+def partitionedMatches(myModel, qdatas, threshold, orders, queryGenerator):
+    """
+    getMatches for a time-partitioned model, searching only the partitions
+    the time constraints allow
+    """
+    soft = (threshold < 1.0)
+    if soft and (threshold is None):
+        threshold = sortThreshold(myModel, qdatas=qdatas)
+    bounds = timeBounds(myModel, qdatas, threshold if soft else 1.0)
+
+    def boundedQueries(m):
+        if queryGenerator is None:
+            baseQuery = m.objects.all()
+        else:
+            baseQuery = queryGenerator(m)
+        if bounds is None:
+            return baseQuery
+        else:
+            return baseQuery.filter(timeBoundsFilter(m, bounds))
+
+    if usesNativePartitions():
+        ## the planner prunes partitions once the bounds are in the query
+        return getMatches(myModel, qdatas, threshold=threshold, orders=orders,
+                          queryGenerator=boundedQueries, partitioned=False)
+    parts = partitionsFor(myModel, bounds)
+    scorer = sortFormula(myModel, qdatas) if soft else 1
+    if len(parts) == 1:
+        return getMatches(parts[0], qdatas, threshold=threshold, orders=orders,
+                          queryGenerator=boundedQueries, partitioned=False,
+                          scorer=partitionScorer(scorer, myModel, parts[0]))
+    ## each partition is sorted as getMatches sorts, and pages are only
+    ## fetched from each as far as they need
+    queries = [(db_table(part), getMatches(part, qdatas, threshold=threshold, orders=orders,
+                                           queryGenerator=boundedQueries, partitioned=False,
+                                           scorer=partitionScorer(scorer, myModel, part)))
+               for part in parts]
+    return MergedResults(myModel, queries, list(orders) + [pk(myModel).name], alias=readAlias())
+
+
+def partitionScorer(scorer, model, part):
+    """
+    The model's sort formula, pointed at one of its partition tables, so
+    every partition is scored on the same scale
+    """
+    if (scorer == 1) or (part == model):
+        return scorer
+    return re.sub(r'\b%s\.' % re.escape(db_table(model)), db_table(part) + '.', scorer)
+
+
+def federatedMatches(myModel, qdatas, threshold, orders, queryGenerator, databases):
+    """
+    getMatches on each database, scored with the same formula and merged
+    on score and then orders, as each database is sorted
+    """
+    soft = (threshold < 1.0)
+    scorer = sortFormula(myModel, qdatas) if soft else 1
+    queries = []
+    for alias in databases:
+        def onAlias(m, alias=alias):
+            if queryGenerator is None:
+                baseQuery = m.objects.all()
+            else:
+                baseQuery = queryGenerator(m)
+            return baseQuery.using(alias)
+        queries.append((alias, getMatches(myModel, qdatas, threshold=threshold, orders=orders,
+                                          queryGenerator=onAlias, scorer=scorer)))
+    return FederatedResults(myModel, queries, orders)
+
+
+def getMatches(myModel, qdatas, threshold=0.0, orders=[], queryGenerator=None,
+               partitioned=True, scorer=None, databases=None):
     """
-    Get the query results
+    Get the query results. scorer overrides the sort formula; partitioned=False
+    skips partition pruning (used when searching the partitions themselves).
+    databases, a list of aliases, searches all of them (see federation).
     """
+    if databases:
+        return federatedMatches(myModel, qdatas, threshold, orders, queryGenerator, databases)
+    if partitioned and isPartitioned(myModel):
+        return partitionedMatches(myModel, qdatas, threshold, orders, queryGenerator)
     soft = (threshold < 1.0)
     threshold = threshold - 1E-12 # account for floating point errors
     #results = []
     #print(qdatas)
     #hardfilter = makeFilters(myModel, qdatas, False)
-    myfilter = makeFilters(myModel, qdatas, soft)
+    myfilter = makeFilters(myModel, qdatas, soft, threshold)
 
-    if soft:
-        scorer = sortFormula(myModel, qdatas)
-    else:
+    if not soft:
         scorer = 1
+    elif scorer is None:
+        scorer = sortFormula(myModel, qdatas)
 
     if isAbstract(myModel):
         aggresults = []
@@ -874,7 +1306,7 @@ def getMatches(myModel, qdatas, threshold=0.0, orders=[], queryGenerator=None):
         processVirtual = len(gargs.keys()) > 0
 
         if (soft or processVirtual) and (threshold is None):
-            threshold = sortThreshold()
+            threshold = sortThreshold(myModel, qdatas=qdatas)
 
         if myfilter:
             query = baseQuery.filter(myfilter)
@@ -901,6 +1333,7 @@ def getMatches(myModel, qdatas, threshold=0.0, orders=[], queryGenerator=None):
             extratables = [db_table(m) for m in extramodels]
             extrawhere = [dbFieldRef(parentField(myModel,p))+" = "+dbFieldRef(pk(p)) for p in extramodels if parentField(myModel,p) is not None]
             extrawhere.append('%s >= %s' % (scorer, threshold))
+            extrawhere.extend(similarityFilters(myModel, qdatas, threshold))
             query = query.extra(tables=extratables, where=extrawhere)
         orders = ['-score'] + orders + [pk(myModel).name]
         query = query.extra(select={'score': scorer}).order_by(*orders)
@@ -942,26 +1375,136 @@ def getMatches(myModel, qdatas, threshold=0.0, orders=[], queryGenerator=None):
             return query
 
 
+def watermarkField(model):
+    """
+    The field whose largest value marks how far a search has seen: an
+    integer primary key, else the primary time field. None if neither.
+    XGDS_DATA_TIME_WATERMARKS ({'ModelName': True}) prefers the time field.
+    """
+    preferTime = resolveSetting('XGDS_DATA_TIME_WATERMARKS', model, False)
+    if isinstance(pk(model), (fields.AutoField, fields.IntegerField)) and not preferTime:
+        return pk(model)
+    timeField = getPrimaryTimeField(model)
+    if timeField is not None:
+        return model._meta.get_field(timeField)
+    return None
+
+
+def searchWatermark(model, queryGenerator=None):
+    """
+    The current watermark of a model (epoch seconds for a time field),
+    None if it can't be tracked
+    """
+    field = watermarkField(model)
+    if field is None:
+        return None
+    if queryGenerator is None:
+        baseQuery = model.objects.all()
+    else:
+        baseQuery = queryGenerator(model)
+    return comparableValue(baseQuery.aggregate(mark=Max(field.name))['mark'])
+
+
+def sinceWatermark(watermark, queryGenerator=None):
+    """
+    A queryGenerator for just the rows past the watermark. A time watermark
+    includes rows stamped at the watermark itself, which may have been added
+    since, so some of the rows may have been seen already. A primary key
+    watermark assumes keys become visible in order: a row whose insert
+    commits after one with a higher key was seen is never picked up, so
+    prefer a time watermark (XGDS_DATA_TIME_WATERMARKS) where inserts overlap.
+    """
+    def newRows(model):
+        if queryGenerator is None:
+            baseQuery = model.objects.all()
+        else:
+            baseQuery = queryGenerator(model)
+        field = watermarkField(model)
+        if (field is None) or (watermark is None):
+            return baseQuery
+        elif field is pk(model):
+            return baseQuery.filter(**{field.name + '__gt': watermark})
+        else:
+            return baseQuery.filter(**{field.name + '__gte': timeValue(model, watermark)})
+    return newRows
+
+
+def refreshMatches(myModel, qdatas, watermark, soft=True, queryGenerator=None):
+    """
+    Evaluate a search over only the rows added since the watermark.
+    Returns (hard matches, soft matches or None) among the new rows.
+    """
+    since = sinceWatermark(watermark, queryGenerator)
+    hardresults = getMatches(myModel, qdatas, threshold=1.0, queryGenerator=since)
+    softresults = None
+    if soft:
+        softresults = getMatches(myModel, qdatas, queryGenerator=since)
+    return hardresults, softresults
+
+
+def mergeTop(top, new, size):
+    """
+    Merge (fullid, score) pairs into a current top list, best first
+    """
+    merged = dict(top)
+    merged.update(dict(new))
+    return sorted(merged.items(), key=lambda x: -(x[1] or 0))[:size]
+
+
 def retrieve(fullids, flat=True):
     """
     Return a bunch of records specifid by fullid
     """
     groupedIds  = dict()
     for fid in fullids:
-        moduleName, modelName, rid = fid.split(':')
+        parts = fid.split(':')
+        moduleName, modelName, rid = parts[:3]
+        ## a fourth part is the database of a federated search
+        alias = parts[3] if len(parts) > 3 else None
         myModel = resolveModel(moduleName, modelName)
-        if myModel not in groupedIds:
-            groupedIds[myModel] = []
-        groupedIds[myModel].append(rid)
+        if (myModel, alias) not in groupedIds:
+            groupedIds[(myModel, alias)] = []
+        groupedIds[(myModel, alias)].append(rid)
     groupedRecords = dict()
+
     if flat:
-        for myModel,ids in groupedIds.iteritems():
-            for rec in myModel.objects.filter(pk__in=ids):
-                groupedRecords[fullid(rec)] = rec
+        for (myModel, alias), ids in groupedIds.iteritems():
+            for qset in recordSets(myModel, alias):
+                for rec in qset.filter(pk__in=ids):
+                    groupedRecords[fullid(rec)] = rec
         ## return in original order
         return [groupedRecords[fid] for fid in fullids]
     else:
-        return [myModel.objects.filter(pk__in=ids) for myModel,ids in groupedIds.iteritems()]
+        return [qset.filter(pk__in=ids)
+                for (myModel, alias), ids in groupedIds.iteritems()
+                for qset in recordSets(myModel, alias)]
+
+
+def recordSets(myModel, alias=None):
+    """
+    Query sets over all the records of the model: one, or one per period
+    table of a partitioned model, whose moved rows are no longer in its own
+    """
+    if isPartitioned(myModel) and not usesNativePartitions():
+        models = partitionsFor(myModel, None)
+    else:
+        models = [myModel]
+    if alias is None:
+        return [m.objects.all() for m in models]
+    return [m.objects.using(alias) for m in models]
+
+
+def getRecord(myModel, rid, alias=None):
+    """
+    The record of the model with this primary key, wherever it is stored;
+    alias is the database it is in, if not the usual one (see fullid)
+    """
+    for qset in recordSets(myModel, alias):
+        try:
+            return qset.get(pk=rid)
+        except ObjectDoesNotExist:
+            pass
+    raise myModel.DoesNotExist()
 
 
 def unitScore(value, lorange, hirange, median):
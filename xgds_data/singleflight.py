@@ -0,0 +1,257 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Running identical concurrent searches once.
+
+When several requests ask for the same search at the same time (a shared
+dashboard loading, say), the first one runs it and the others wait for its
+result. Searches are identified by a fingerprint of the model, the cleaned
+form data, the page and a data version that changes whenever a row of the
+model is saved or deleted, so nobody is handed results from before a write.
+Only post_save and post_delete bump it: after bulk_create (see
+standing.notifyBulkCreate), QuerySet.update(), QuerySet.delete() or raw SQL,
+call bumpDataVersion(model), or identical searches keep sharing results
+from before the write for as long as they are cached.
+
+Within a process this needs nothing else. With
+XGDS_DATA_SINGLE_FLIGHT_CACHE naming a shared Django cache (memcached,
+redis), a lock and the result are kept there so identical searches in
+other processes wait too. Waiters give up after XGDS_DATA_SINGLE_FLIGHT_WAIT
+seconds (or when their own search deadline runs out, whichever is sooner)
+and run the search themselves. XGDS_DATA_SINGLE_FLIGHT = False
+turns it off.
+"""
+
+import json
+import time
+import hashlib
+import datetime
+import threading
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Model
+
+from xgds_data.introspection import qualifiedModelName, fullid, isAbstract
+from xgds_data.limits import SearchTimeout
+
+inFlight = dict()
+inFlightLock = threading.Lock()
+## per-model change counters, for when there is no shared cache
+localVersions = dict()
+versionLock = threading.Lock()
+missing = object()
+
+
+def singleFlightEnabled():
+    return getattr(settings, 'XGDS_DATA_SINGLE_FLIGHT', True)
+
+
+def flightWait():
+    return getattr(settings, 'XGDS_DATA_SINGLE_FLIGHT_WAIT', 60)
+
+
+def sharedCache():
+    """
+    The Django cache used to coordinate processes, or None
+    """
+    alias = getattr(settings, 'XGDS_DATA_SINGLE_FLIGHT_CACHE', None)
+    if alias is None:
+        return None
+    from django.core.cache import caches
+    return caches[alias]
+
+
+def versionKey(model):
+    return 'xgds_data_version:' + qualifiedModelName(model)
+
+
+def dataVersion(model):
+    """
+    A number that changes whenever a row of the model changes
+    """
+    cache = sharedCache()
+    if cache is not None:
+        return cache.get(versionKey(model), 0)
+    return localVersions.get(qualifiedModelName(model), 0)
+
+
+def bumpDataVersion(model):
+    """
+    Mark the model's data as changed, for writes that send no signals
+    """
+    cache = sharedCache()
+    if cache is not None:
+        key = versionKey(model)
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)  # evicted in between
+    else:
+        with versionLock:
+            qname = qualifiedModelName(model)
+            localVersions[qname] = localVersions.get(qname, 0) + 1
+
+
+def dataChangedHandler(sender, raw=False, **kwargs):
+    """
+    post_save and post_delete handler that bumps the model's data version
+    """
+    if raw or sender.__module__.startswith('xgds_data.') or isAbstract(sender):
+        return
+    bumpDataVersion(sender)
+
+
+def canonical(value):
+    """
+    A stable, json-able form of a form value
+    """
+    if (value is None) or isinstance(value, (basestring, bool, int, long, float)):
+        return value
+    elif isinstance(value, Model):
+        return fullid(value)
+    elif isinstance(value, (datetime.datetime, datetime.date, Decimal)):
+        return unicode(value)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return sorted(canonical(v) for v in value)
+    try:
+        ## querysets from multiple choice fields
+        return sorted(fullid(v) for v in value)
+    except TypeError:
+        return unicode(value)
+
+
+def searchFingerprint(model, qdatas, queryGenerator=None, **extra):
+    """
+    Key identifying a search and the data it would see; None if searches
+    like it shouldn't be shared
+    """
+    if not singleFlightEnabled():
+        return None
+    if queryGenerator is None:
+        generator = None
+    elif getattr(queryGenerator, '__closure__', None) is None:
+        generator = '%s.%s' % (queryGenerator.__module__, queryGenerator.__name__)
+    else:
+        ## closures can capture per-request state, and nothing identifies
+        ## them across processes (ids repeat in forked workers), so never share
+        return None
+    described = {'model': qualifiedModelName(model),
+                 'version': dataVersion(model),
+                 'generator': generator,
+                 'forms': [sorted((k, canonical(v)) for k, v in qd.items()
+                                  if v not in (None, '', []))
+                           for qd in qdatas],
+                 'extra': sorted((k, canonical(v)) for k, v in extra.items())}
+    return hashlib.sha1(json.dumps(described, sort_keys=True, default=unicode)).hexdigest()
+
+
+class Flight(object):
+    """
+    One running computation and the requests waiting for it
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def waitLimit(limit):
+    """
+    How long a waiter may wait: XGDS_DATA_SINGLE_FLIGHT_WAIT, or what is
+    left of its own Limit if that is sooner. The second value says whether
+    the Limit is what cut it short.
+    """
+    wait = flightWait()
+    remaining = limit.remaining() if limit is not None else None
+    if (remaining is not None) and (remaining < wait):
+        return (max(remaining, 0), True)
+    return (wait, False)
+
+
+def sharedFlight(key, compute, limit=None):
+    """
+    Run compute once across processes that share the cache
+    """
+    cache = sharedCache()
+    wait = flightWait()
+    lockKey = 'xgds_data_flight:' + key
+    resultKey = 'xgds_data_result:' + key
+    if cache.add(lockKey, 1, wait):
+        try:
+            result = compute()
+            ## kept a little while for waiters that are between polls
+            cache.set(resultKey, result, 10)
+            return result
+        finally:
+            cache.delete(lockKey)
+    wait, byLimit = waitLimit(limit)
+    giveUp = time.time() + wait
+    while time.time() < giveUp:
+        result = cache.get(resultKey, missing)
+        if result is not missing:
+            return result
+        if cache.get(lockKey) is None:
+            result = cache.get(resultKey, missing)
+            if result is not missing:
+                return result
+            break  # the other process failed; run it ourselves
+        time.sleep(0.05)
+    else:
+        if byLimit:
+            raise SearchTimeout(limit.seconds)
+    return compute()
+
+
+def singleFlight(key, compute, limit=None):
+    """
+    compute(), unless an identical computation is already running, in
+    which case wait for and return its result (or raise its error). A
+    waiter whose Limit runs out first gets SearchTimeout.
+    """
+    with inFlightLock:
+        flight = inFlight.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight()
+            inFlight[key] = flight
+    if not leader:
+        wait, byLimit = waitLimit(limit)
+        if flight.done.wait(wait):
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        if byLimit:
+            raise SearchTimeout(limit.seconds)
+        return compute()  # the first one is taking too long
+
+    try:
+        if sharedCache() is not None:
+            flight.result = sharedFlight(key, compute, limit)
+        else:
+            flight.result = compute()
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with inFlightLock:
+            inFlight.pop(key, None)
+        flight.done.set()
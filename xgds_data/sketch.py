@@ -0,0 +1,103 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import base64
+import hashlib
+import math
+
+
+class HyperLogLog(object):
+    """
+    Approximate distinct value counter. Uses 2**precision registers, so the
+    default of 12 gives about 1.6% standard error in 4KB.
+    """
+
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            self.registers = bytearray(self.size)
+        else:
+            self.registers = bytearray(registers)
+            assert len(self.registers) == self.size
+
+    @staticmethod
+    def hashValue(value):
+        """
+        64 bit hash of a field value; None is counted as its own value
+        """
+        try:
+            text = u'%s' % value
+        except UnicodeDecodeError:
+            text = value.decode('utf-8', 'ignore')
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        return int(digest[:16], 16)
+
+    def add(self, value):
+        """
+        Record a value
+        """
+        hval = self.hashValue(value)
+        index = hval >> (64 - self.precision)
+        rest = hval & ((1 << (64 - self.precision)) - 1)
+        ## position of the leftmost 1 bit in the remaining bits
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for v in values:
+            self.add(v)
+
+    def merge(self, other):
+        """
+        Fold another sketch of the same precision into this one
+        """
+        assert other.precision == self.precision
+        for i in range(self.size):
+            if other.registers[i] > self.registers[i]:
+                self.registers[i] = other.registers[i]
+
+    def estimate(self):
+        """
+        Estimated number of distinct values seen
+        """
+        if self.size >= 128:
+            alpha = 0.7213 / (1 + 1.079 / self.size)
+        elif self.size == 64:
+            alpha = 0.709
+        elif self.size == 32:
+            alpha = 0.697
+        else:
+            alpha = 0.673
+        total = 0.0
+        zeros = 0
+        for r in self.registers:
+            total += 2.0 ** (-r)
+            if r == 0:
+                zeros = zeros + 1
+        est = alpha * self.size * self.size / total
+        if (est <= 2.5 * self.size) and (zeros > 0):
+            ## small range correction (linear counting)
+            est = self.size * math.log(float(self.size) / zeros)
+        return est
+
+    def serialize(self):
+        return base64.b64encode(bytes(self.registers)).decode('ascii')
+
+    @classmethod
+    def deserialize(cls, text, precision=12):
+        return cls(precision=precision, registers=base64.b64decode(text))
@@ -0,0 +1,375 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Location search on latitude/longitude field pairs, without PostGIS.
+
+Pairs are configured in XGDS_DATA_LATLON_FIELDS, e.g.
+XGDS_DATA_LATLON_FIELDS['myapp'] = {'Sample': [('latitude', 'longitude')]}
+
+Each pair gets search form fields for a bounding box, a radius or a soft
+"near" (scored by distance, like IN~). Rows are filed in the GeoCell table
+under a fixed grid cell of XGDS_DATA_GEO_CELL_DEGREES, so a search first
+narrows to the rows in the covering cells with an indexed IN lookup, and
+only those get the exact distance test. Build the cells with
+./manage.py xgds_data_geoindex; saves keep them current.
+"""
+
+import math
+
+from django import forms
+from django.db import connection
+from django.db.models import Q, Field, Lookup
+from django.db.models.expressions import RawSQL
+from django.conf import settings
+
+from xgds_data.introspection import (settingsForModel, qualifiedModelName,
+                                     pk)
+from xgds_data.models import GeoCell
+from xgds_data.routers import readConnection
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180.0
+
+SHAPES = (('', 'anywhere'),
+          ('box', 'in box'),
+          ('radius', 'within'),
+          ('near', 'near'))
+
+
+def latLonPairs(model):
+    """
+    (latitude field, longitude field) pairs configured for the model
+    """
+    try:
+        names = settingsForModel(settings.XGDS_DATA_LATLON_FIELDS, model)
+    except AttributeError:
+        return []
+    fieldNames = set([f.name for f in model._meta.fields])
+    return [(lat, lon) for lat, lon in names
+            if (lat in fieldNames) and (lon in fieldNames)]
+
+
+def geoPrefix(pair):
+    return 'geo_%s_%s' % pair
+
+
+def cellDegrees():
+    try:
+        return settings.XGDS_DATA_GEO_CELL_DEGREES
+    except AttributeError:
+        return 0.1
+
+
+def maxCells():
+    """
+    Beyond this many covering cells, the IN list costs more than it saves
+    """
+    try:
+        return settings.XGDS_DATA_GEO_MAX_CELLS
+    except AttributeError:
+        return 2500
+
+
+def cellKey(lat, lon):
+    size = cellDegrees()
+    return '%d:%d' % (math.floor(lat / size), math.floor(lon / size))
+
+
+def cellsForBox(south, west, north, east):
+    """
+    Keys of the cells covering the box, or None if there are too many.
+    A box with west > east crosses the antimeridian.
+    """
+    if west > east:
+        left = cellsForBox(south, west, north, 180.0)
+        right = cellsForBox(south, -180.0, north, east)
+        if (left is None) or (right is None):
+            return None
+        return left + right
+    size = cellDegrees()
+    rows = range(int(math.floor(south / size)), int(math.floor(north / size)) + 1)
+    cols = range(int(math.floor(west / size)), int(math.floor(east / size)) + 1)
+    if len(rows) * len(cols) > maxCells():
+        return None
+    return ['%d:%d' % (r, c) for r in rows for c in cols]
+
+
+def boxForRadius(lat, lon, km):
+    """
+    (south, west, north, east) of a box enclosing the circle
+    """
+    dlat = km / KM_PER_DEGREE
+    south = max(-90.0, lat - dlat)
+    north = min(90.0, lat + dlat)
+    coslat = math.cos(math.radians(max(abs(south), abs(north))))
+    if (coslat <= 1E-9) or (km / (KM_PER_DEGREE * coslat) >= 180.0):
+        return south, -180.0, north, 180.0
+    dlon = km / (KM_PER_DEGREE * coslat)
+    west = lon - dlon
+    east = lon + dlon
+    if west < -180.0:
+        west = west + 360.0
+    if east > 180.0:
+        east = east - 360.0
+    return south, west, north, east
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in km
+    """
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2) ** 2 +
+         math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def distanceSql(latRef, lonRef, lat, lon):
+    """
+    SQL for the distance in km from (lat, lon). Backends without trig
+    functions get a flat-earth estimate, which is fine at search scales.
+    """
+    ## imported here because mirror imports this module
+    from xgds_data.mirror import usesSqliteFunctions
+    connection = readConnection()
+    if usesSqliteFunctions(connection):
+        return 'xgds_distance({0}, {1}, {2}, {3})'.format(latRef, lonRef, lat, lon)
+    elif connection.vendor in ('postgresql', 'mysql'):
+        return ('(2 * {0} * ASIN(LEAST(1, SQRT(POWER(SIN(RADIANS({1} - {3}) / 2), 2) + '
+                '{5} * COS(RADIANS({1})) * POWER(SIN(RADIANS({2} - {4}) / 2), 2)))))'
+                .format(EARTH_RADIUS_KM, latRef, lonRef, lat, lon, math.cos(math.radians(lat))))
+    else:
+        ## no sqrt either, so take the larger offset plus half the smaller
+        dy = 'ABS({0} - {1}) * {2}'.format(latRef, lat, KM_PER_DEGREE)
+        dx = 'ABS({0} - {1}) * {2}'.format(lonRef, lon, KM_PER_DEGREE * math.cos(math.radians(lat)))
+        return ('(CASE WHEN {0} > {1} THEN {0} + ({1}) / 2 ELSE {1} + ({0}) / 2 END)'
+                .format(dy, dx))
+
+
+def withinSql(latRef, lonRef, lat, lon, km, connection=None):
+    """
+    (SQL, params) true for rows within km of (lat, lon). Without trig
+    functions this compares squared flat-earth distances, with the
+    longitude scale of the latitude furthest from the equator that can
+    match, so it never leaves out a row that is within km.
+    """
+    ## imported here because mirror imports this module
+    from xgds_data.mirror import usesSqliteFunctions
+    if connection is None:
+        connection = readConnection()
+    if usesSqliteFunctions(connection) or connection.vendor in ('postgresql', 'mysql'):
+        return ('{0} <= %s'.format(distanceSql(latRef, lonRef, lat, lon)), [km])
+    south, west, north, east = boxForRadius(lat, lon, km)
+    coslat = max(0.0, math.cos(math.radians(max(abs(south), abs(north)))))
+    dy = '(({0} - {1}) * {2})'.format(latRef, lat, KM_PER_DEGREE)
+    ## the shorter way around in longitude
+    dlon = 'ABS({0} - {1})'.format(lonRef, lon)
+    dx = ('((CASE WHEN {0} > 180 THEN 360 - {0} ELSE {0} END) * {1})'
+          .format(dlon, KM_PER_DEGREE * coslat))
+    return ('({0} * {0} + {1} * {1}) <= %s'.format(dy, dx), [km * km])
+
+
+class WithinKm(Lookup):
+    """
+    latitude__xgds_within_km=(longitude column, lat, lon, km): the exact
+    distance test, applied to the rows of the outer query as it stands
+    (already narrowed by cells and box), not as a scan of the whole table
+    """
+    lookup_name = 'xgds_within_km'
+
+    def get_prep_lookup(self):
+        return self.rhs
+
+    def as_sql(self, compiler, connection):
+        latRef, params = self.process_lhs(compiler, connection)
+        lonColumn, lat, lon, km = self.rhs
+        lonRef = '%s.%s' % (compiler.quote_name_unless_alias(self.lhs.alias),
+                            connection.ops.quote_name(lonColumn))
+        sql, withinParams = withinSql(latRef, lonRef, lat, lon, km, connection=connection)
+        return sql, list(params) + withinParams
+
+Field.register_lookup(WithinKm)
+
+
+def spatialFormFields(model):
+    """
+    Search form fields for the model's lat/lon pairs
+    """
+    formfields = dict()
+    for pair in latLonPairs(model):
+        prefix = geoPrefix(pair)
+        formfields[prefix + '_shape'] = forms.ChoiceField(choices=SHAPES, initial='', required=False)
+        for name in ('lat', 'lon', 'km', 'south', 'west', 'north', 'east'):
+            formfields[prefix + '_' + name] = forms.FloatField(required=False)
+    return formfields
+
+
+def spatialConstraints(model, qd):
+    """
+    The location constraints of one search form, as a list of
+    (pair, shape, parameters)
+    """
+    constraints = []
+    for pair in latLonPairs(model):
+        prefix = geoPrefix(pair)
+        shape = qd.get(prefix + '_shape')
+        vals = dict([(name, qd.get(prefix + '_' + name))
+                     for name in ('lat', 'lon', 'km', 'south', 'west', 'north', 'east')])
+        if shape == 'box':
+            if None not in (vals['south'], vals['west'], vals['north'], vals['east']):
+                constraints.append((pair, shape, vals))
+        elif shape in ('radius', 'near'):
+            if None not in (vals['lat'], vals['lon'], vals['km']) and vals['km'] > 0:
+                constraints.append((pair, shape, vals))
+    return constraints
+
+
+def cellFilter(model, pair, cells):
+    """
+    Q object restricting to rows filed under the given cells
+    """
+    sql = ('SELECT {0} FROM {1} WHERE {2} = %s AND {3} = %s AND {4} IN ({5})'
+           .format(*([connection.ops.quote_name(x) for x in
+                      ('rowId', GeoCell._meta.db_table, 'model', 'field', 'cell')] +
+                     [', '.join(['%s'] * len(cells))])))
+    params = [qualifiedModelName(model), pair[0]] + cells
+    return Q(**{pk(model).name + '__in': RawSQL(sql, params)})
+
+
+def boxFilter(model, pair, south, west, north, east):
+    lat, lon = pair
+    clause = Q(**{lat + '__gte': south, lat + '__lte': north})
+    if west > east:
+        clause &= (Q(**{lon + '__gte': west}) | Q(**{lon + '__lte': east}))
+    else:
+        clause &= Q(**{lon + '__gte': west, lon + '__lte': east})
+    cells = cellsForBox(south, west, north, east)
+    if cells is not None:
+        clause = cellFilter(model, pair, cells) & clause
+    return clause
+
+
+def radiusFilter(model, pair, lat, lon, km):
+    """
+    Q object for rows within km of (lat, lon): cells and box first, then the exact distance
+    """
+    south, west, north, east = boxForRadius(lat, lon, km)
+    exact = Q(**{pair[0] + '__xgds_within_km':
+                 (model._meta.get_field(pair[1]).column, lat, lon, km)})
+    return boxFilter(model, pair, south, west, north, east) & exact
+
+
+def spatialFilter(model, qd, soft=True, threshold=None, nterms=1):
+    """
+    Q object for the location constraints of one search form. A soft
+    "near" only restricts once a threshold is known: rows too far away to
+    reach it, even with every other constraint met, are left out.
+    """
+    clause = Q()
+    for pair, shape, vals in spatialConstraints(model, qd):
+        if shape == 'box':
+            clause &= boxFilter(model, pair, vals['south'], vals['west'], vals['north'], vals['east'])
+        elif (shape == 'radius') or not soft:
+            clause &= radiusFilter(model, pair, vals['lat'], vals['lon'], vals['km'])
+        elif threshold is not None:
+            minScore = nterms * threshold - (nterms - 1)
+            if minScore > 0:
+                reach = vals['km'] + vals['km'] * (1 - minScore) / minScore
+                clause &= radiusFilter(model, pair, vals['lat'], vals['lon'], reach)
+    return clause
+
+
+def desiredLocations(model, qdatas):
+    """
+    The soft "near" constraints from the forms, {pair: (lat, lon, km)}
+    """
+    near = dict()
+    for qd in qdatas:
+        for pair, shape, vals in spatialConstraints(model, qd):
+            if shape == 'near':
+                near[pair] = (vals['lat'], vals['lon'], vals['km'])
+    return near
+
+
+def scoreLocation(latRef, lonRef, lat, lon, km):
+    """
+    provide a score for a "near" clause that ranges from 1 (best) to 0 (worst):
+    1 within km, falling off with distance beyond it
+    """
+    beyond = 'greatest(0, {0} - {1})'.format(distanceSql(latRef, lonRef, lat, lon), km)
+    return 'CASE WHEN {0} IS NULL THEN 0 ELSE {1}/({1} + {2}) END'.format(latRef, km, beyond)
+
+
+def indexLocation(instance, pairs=None):
+    """
+    (Re)file one row under its grid cells
+    """
+    model = instance.__class__
+    if pairs is None:
+        pairs = latLonPairs(model)
+    qname = qualifiedModelName(model)
+    for pair in pairs:
+        GeoCell.objects.filter(model=qname, field=pair[0], rowId=instance.pk).delete()
+        lat = getattr(instance, pair[0])
+        lon = getattr(instance, pair[1])
+        if (lat is not None) and (lon is not None):
+            GeoCell.objects.create(model=qname, field=pair[0], rowId=instance.pk,
+                                   cell=cellKey(float(lat), float(lon)))
+
+
+def rebuildLocations(model, chunkSize=1000):
+    """
+    Refile every row of the model
+    """
+    pairs = latLonPairs(model)
+    qname = qualifiedModelName(model)
+    GeoCell.objects.filter(model=qname).delete()
+    cells = []
+    rows = 0
+    names = [pk(model).attname] + [n for pair in pairs for n in pair]
+    for row in model.objects.values_list(*names).iterator():
+        rows = rows + 1
+        for i, pair in enumerate(pairs):
+            lat, lon = row[1 + 2 * i], row[2 + 2 * i]
+            if (lat is not None) and (lon is not None):
+                cells.append(GeoCell(model=qname, field=pair[0], rowId=row[0],
+                                     cell=cellKey(float(lat), float(lon))))
+        if len(cells) >= chunkSize:
+            GeoCell.objects.bulk_create(cells)
+            cells = []
+    GeoCell.objects.bulk_create(cells)
+    return rows
+
+
+def locationSaveHandler(sender, instance, raw=False, **kwargs):
+    """
+    post_save handler that keeps the grid cells current
+    """
+    pairs = latLonPairs(sender)
+    if pairs:
+        indexLocation(instance, pairs)
+
+
+def locationDeleteHandler(sender, instance, **kwargs):
+    """
+    post_delete handler that keeps the grid cells current
+    """
+    if latLonPairs(sender):
+        GeoCell.objects.filter(model=qualifiedModelName(sender), rowId=instance.pk).delete()
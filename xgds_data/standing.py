@@ -0,0 +1,305 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Standing queries: saved searches that are checked against each new row as
+it is inserted, so that clients can poll a short list of hits instead of
+re-running the full search.
+
+A standing query stores the search formset data. The queries of a model are
+compiled once into a python predicate (see rowPredicate) and, for soft
+queries, a score function with a threshold. Queries with an equality
+constraint on a field are indexed by that (field, value), so a new row is
+only checked against the queries it could match plus the unindexed ones.
+
+Rows are offered on post_save and evaluated on a background thread;
+matches are appended to StandingQueryHit, unless the query has been
+cancelled since it was compiled.
+
+Only post_save offers rows. bulk_create, raw SQL and loaddata (raw saves)
+send nothing, so rows inserted that way are never checked unless the
+caller passes them to notifyBulkCreate afterwards:
+
+    rows = MyModel.objects.bulk_create(rows)
+    notifyBulkCreate(MyModel, rows)
+"""
+
+import json
+import Queue
+import logging
+import datetime
+import threading
+
+import pytz
+from django.http import QueryDict
+from django.forms.formsets import formset_factory
+
+from xgds_data.introspection import qualifiedModelName, fullid, isAbstract, resolveField
+from xgds_data.models import StandingQuery, StandingQueryHit
+from xgds_data.DataStatistics import timeout, tableSize
+from xgds_data.reservoir import comparableValue, rowValues
+from xgds_data.cache import Cache
+from xgds_data.routers import closeConnections
+from xgds_data.singleflight import bumpDataVersion
+from xgds_data.search import (rowPredicate, desiredRanges, sortThreshold, multiScore,
+                              scaleEval, dbFieldRef)
+
+logger = logging.getLogger(__name__)
+
+## qualified model name -> {'index': {(field, value): [compiled]}, 'fields': set, 'other': [compiled]}
+## these are dropped together when the active models are reloaded
+standingCache = Cache('standing', ttl=None, maxSize=None)
+standingLoaded = [None]
+standingLock = threading.Lock()
+pendingRows = Queue.Queue()
+workerThread = [None]
+
+
+def formsetData(data):
+    """
+    The stored formset data of a standing query as a QueryDict
+    """
+    qd = QueryDict('', mutable=True)
+    for k, v in json.loads(data).items():
+        if isinstance(v, (list, tuple)):
+            qd.setlist(k, [unicode(x) for x in v])
+        else:
+            qd[k] = unicode(v)
+    return qd
+
+
+def standingQdatas(model, data):
+    """
+    Rebuild the search form data of a standing query; None if it no longer validates
+    """
+    ## imported here because forms imports modules that import this one
+    from xgds_data.forms import SearchForm, SpecializedForm
+    formset = formset_factory(SpecializedForm(SearchForm, model), extra=0)(formsetData(data))
+    if not formset.is_valid():
+        return None
+    return [form.cleaned_data for form in formset]
+
+
+def equalityKey(qd):
+    """
+    An exact (field, value) constraint of one search form that can be used to
+    index the query, or None
+    """
+    for fieldname in qd:
+        if not fieldname.endswith('_operator') or qd[fieldname] != '=':
+            continue
+        basename = fieldname[:-(len('_operator'))]
+        if (basename + '_lo') in qd:
+            continue
+        qval = comparableValue(qd.get(basename))
+        if qval == 'True':
+            qval = True
+        elif qval == 'False':
+            qval = False
+        ## text matches are substring matches, so they can't be looked up
+        if (qval is not None) and not isinstance(qval, basestring):
+            return (basename, qval)
+    return None
+
+
+def compileQuery(model, standing):
+    """
+    Turn a standing query into a dict with its predicate, scorer, threshold
+    and index keys; None if it can't be evaluated in python
+    """
+    qdatas = standingQdatas(model, standing.data)
+    if qdatas is None:
+        return None
+    if not standing.soft:
+        ## a hard search treats approximate ranges as plain ranges
+        qdatas = [dict([(k, 'IN' if (k.endswith('_operator') and v == 'IN~') else v)
+                        for k, v in qd.items()]) for qd in qdatas]
+    predicate = rowPredicate(model, qdatas, [f.name for f in model._meta.fields])
+    if predicate is None:
+        return None
+
+    scorer = None
+    threshold = None
+    desiderata = desiredRanges(qdatas)
+    if standing.soft and desiderata:
+        ranges = dict()
+        scales = dict()
+        tsize = tableSize(model)
+        for fname, (loval, hival) in desiderata.items():
+            field = resolveField(model, fname)
+            if field is None:
+                return None
+            ranges[fname] = [comparableValue(loval), comparableValue(hival)]
+            scales[fname] = scaleEval(model, field, loval, hival, tsize, dbFieldRef(field))
+        scorer = (lambda r, s: lambda values: multiScore(model, values, r, scales=s))(ranges, scales)
+        threshold = standing.threshold
+        if threshold is None:
+            threshold = sortThreshold(model, desiderata)
+
+    ## a row can only match if it matches one of the forms, so the query can
+    ## be indexed if every form has an exact constraint
+    keys = [equalityKey(qd) for qd in qdatas]
+    if None in keys:
+        keys = []
+    return {'query': standing, 'predicate': predicate, 'scorer': scorer,
+            'threshold': threshold, 'keys': keys}
+
+
+def invalidateStandingQueries(*args, **kwargs):
+    """
+    Drop the compiled queries; also a signal handler for StandingQuery changes
+    """
+    with standingLock:
+        standingCache.clear()
+        standingLoaded[0] = None
+
+
+def activeStandingModels():
+    """
+    Names of the models with active standing queries, reloaded after the cache timeout
+    """
+    with standingLock:
+        now = datetime.datetime.now(pytz.utc)
+        loaded = standingLoaded[0]
+        if ((loaded is None) or
+            ((timeout() is not None) and (now - loaded[0] > datetime.timedelta(seconds=timeout())))):
+            standingCache.clear()
+            names = set(StandingQuery.objects.filter(active=True).values_list('model', flat=True))
+            loaded = (now, names)
+            standingLoaded[0] = loaded
+        return loaded[1]
+
+
+def standingQueriesFor(model):
+    """
+    The compiled, indexed standing queries of a model
+    """
+    qname = qualifiedModelName(model)
+    entry = standingCache.get(qname)
+    if entry is not None:
+        return entry
+    entry = {'index': dict(), 'fields': set(), 'other': []}
+    for standing in StandingQuery.objects.filter(active=True, model=qname):
+        compiled = compileQuery(model, standing)
+        if compiled is None:
+            logger.warning("Standing query %s can't be evaluated on insert", standing.pk)
+        elif compiled['keys']:
+            for key in compiled['keys']:
+                entry['index'].setdefault(key, []).append(compiled)
+                entry['fields'].add(key[0])
+        else:
+            entry['other'].append(compiled)
+    standingCache.set(qname, entry)
+    return entry
+
+
+def candidateQueries(entry, values):
+    """
+    The standing queries a row could match, without repeats
+    """
+    candidates = list(entry['other'])
+    for fname in entry['fields']:
+        candidates.extend(entry['index'].get((fname, values.get(fname)), []))
+    unique = []
+    seen = set()
+    for c in candidates:
+        if id(c) not in seen:
+            seen.add(id(c))
+            unique.append(c)
+    return unique
+
+
+def evaluateRows(model, rows):
+    """
+    Check new rows, given as (fullid, values), against the standing queries
+    of their model and record the hits
+    """
+    entry = standingQueriesFor(model)
+    hits = []
+    for rowId, values in rows:
+        for compiled in candidateQueries(entry, values):
+            if not compiled['predicate'](values):
+                continue
+            score = None
+            if compiled['scorer'] is not None:
+                score = compiled['scorer'](values)
+                if score < compiled['threshold']:
+                    continue
+            hits.append(StandingQueryHit(query=compiled['query'], fullid=rowId, score=score))
+    if hits:
+        ## the compiled queries may be stale here: one cancelled in another
+        ## process is only dropped from our cache when it times out
+        active = set(StandingQuery.objects.filter(pk__in=set([h.query.pk for h in hits]), active=True)
+                     .values_list('pk', flat=True))
+        hits = [h for h in hits if h.query.pk in active]
+        StandingQueryHit.objects.bulk_create(hits)
+    return len(hits)
+
+
+def standingWorker():
+    """
+    Background thread that evaluates offered rows
+    """
+    while True:
+        model, rows = pendingRows.get()
+        try:
+            evaluateRows(model, rows)
+        except Exception:
+            logger.exception("Standing query evaluation failed for %s", qualifiedModelName(model))
+        finally:
+            if pendingRows.empty():
+                ## don't hold a connection open while idle
+                closeConnections()
+
+
+def offerRows(model, instances):
+    """
+    Queue new rows of a model for evaluation, if it has standing queries
+    """
+    if qualifiedModelName(model) not in activeStandingModels():
+        return
+    ## take the values now, before the caller changes the instances
+    rows = [(fullid(i), rowValues(i, model._meta.fields)) for i in instances]
+    if workerThread[0] is None:
+        with standingLock:
+            if workerThread[0] is None:
+                thread = threading.Thread(target=standingWorker, name='xgds_data_standing')
+                thread.daemon = True
+                thread.start()
+                workerThread[0] = thread
+    pendingRows.put((model, rows))
+
+
+def notifyBulkCreate(model, instances):
+    """
+    bulk_create sends no post_save, so call this afterwards. Instances need
+    their primary keys, which not every backend sets on bulk_create. This
+    also bumps the model's single-flight data version.
+    """
+    bumpDataVersion(model)
+    offerRows(model, [i for i in instances if i.pk is not None])
+
+
+def standingInsertHandler(sender, instance, created=False, raw=False, **kwargs):
+    """
+    post_save handler that offers new rows to the standing queries
+    """
+    if created and not raw:
+        if sender.__module__.startswith('xgds_data.') or isAbstract(sender):
+            return  # our own bookkeeping never has standing queries
+        offerRows(sender, [instance])
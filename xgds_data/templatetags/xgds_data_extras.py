@@ -35,7 +35,7 @@ except ImportError:
 from string import capwords
 
 from xgds_data.models import VirtualIncludedField, Collection
-from xgds_data.introspection import pkValue
+from xgds_data.introspection import pkValue, fieldPath, fullid
 from xgds_data.introspection import modelName as intmodelName
 from xgds_data.introspection import moduleName as intmoduleName
 from xgds_data.utils import label
@@ -45,11 +45,70 @@ numeric_test = re.compile(r'^[\.\-Ee\d]+$')
 register = template.Library()
 
 register.filter('pkValue', pkValue)
+register.filter('fullid', fullid)
+
+## id(field) -> (field, getter)
+fieldGetters = {}
+
+
+def compileGetter(field):
+    """
+    A function giving this field's value on a record, worked out once per field
+    """
+    name = field.name
+    if isinstance(field, VirtualIncludedField):
+        ## the through field, then the base field on what it links to
+        path = fieldPath(field.model, name)
+
+        def getter(obj):
+            try:
+                return path.value(obj)
+            except AttributeError as inst:
+                print(inst)
+                print('Error on ', obj, field)
+                return None
+    elif isinstance(field, models.Field):
+        def getter(obj):
+            try:
+                return getattr(obj, name)
+            except (ObjectDoesNotExist, OperationalError, DatabaseError, IntegrityError) as expt:
+                # can happen with an inconsistent database, as in plrp
+                print(obj, name)
+                print(expt)
+                # No problem, we love dirty data!
+                return None
+    else:
+        ## GenericForeignKey
+        def getter(obj):
+            return getattr(obj, name, None)
+    return getter
+
+
+def fieldValue(obj, field):
+    """
+    The value of the field on this record, with managers turned into query sets
+    """
+    try:
+        cached, getter = fieldGetters[id(field)]
+        if cached is not field:
+            raise KeyError
+    except KeyError:
+        getter = compileGetter(field)
+        fieldGetters[id(field)] = (field, getter)
+    v = getter(obj)
+    if (isinstance(v, models.Manager)):
+        v = v.all()
+    return v
+
 
 # http://stackoverflow.com/questions/844746/performing-a-getattr-style-lookup-in-a-django-template
 def getattribute(obj, attr):
     """Gets an attribute of an object dynamically from a string name"""
 
+    if isinstance(attr, (models.Field, GenericForeignKey)):
+        ## most cells; skip the string lookups below
+        return fieldValue(obj, attr)
+
     try:
         return getattr(obj, attr)
     except (TypeError, AttributeError):
@@ -62,32 +121,6 @@ def getattribute(obj, attr):
 
     if integer_test.match(str(attr)) and len(obj) > int(attr):
         v = obj[int(attr)]
-    elif isinstance(attr, VirtualIncludedField):
-        try:
-            #throughInstance = attr.throughfield.__get__(obj);
-            if attr.throughfield_name is None:
-                throughInstance = obj
-            else:
-                throughInstance = getattr(obj, attr.throughfield_name)
-            if throughInstance is not None:
-                v = getattr(throughInstance, attr.base_name)
-            else:
-                v = None
-        except AttributeError as inst:
-            print(inst)
-            print('Error on ', obj, attr)
-            v = None
-    elif isinstance(attr, models.Field):
-        try:
-            v = getattr(obj, attr.name)
-        except (ObjectDoesNotExist, OperationalError, DatabaseError, IntegrityError) as expt:
-            # can happen with an inconsistent database, as in plrp
-            print(obj,attr.name)
-            print(expt)
-            # No problem, we love dirty data!
-            v = None
-    elif isinstance(attr, GenericForeignKey):
-        v = getattr(obj, attr.name , None)
     else:
         v = settings.TEMPLATE_STRING_IF_INVALID
     if (isinstance(v, models.Manager)):
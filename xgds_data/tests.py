@@ -14,7 +14,35 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
-from django.test import TestCase
+import os
+import json
+import time
+import uuid
+import random
+import shutil
+import tempfile
+import threading
+from unittest import skipUnless
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import (TestCase, TransactionTestCase, SimpleTestCase, RequestFactory,
+                         override_settings)
+
+from xgds_data import jobs, views
+from xgds_data.cache import Cache, caches, clearCaches
+from xgds_data.federation import MergedResults, FederatedResults
+from xgds_data.introspection import fullid
+from xgds_data.limits import (Limit, deadline, currentLimit, cancelSearch, guardCost,
+                              SearchTimeout, SearchTooExpensive)
+from xgds_data.models import TrigramPosting
+from xgds_data.parallel import runConcurrently, parallelFetchPage
+from xgds_data.search import getRecord, getMatches
+from xgds_data.singleflight import (singleFlight, searchFingerprint, dataVersion,
+                                    dataChangedHandler, bumpDataVersion)
+from xgds_data.routers import (ReplicaRouter, replicaReads, readsFromReplica, readAlias,
+                               chooseReplica, primaryAlias, replicaLags)
 
 
 class xgds_dataTest(TestCase):
@@ -23,3 +51,490 @@ class xgds_dataTest(TestCase):
     """
     def test_xgds_data(self):
         pass
+
+
+class CacheStressTest(SimpleTestCase):
+    """
+    Hammer the shared caches from many threads
+    """
+    threads = 32
+    rounds = 2000
+
+    def hammer(self, work):
+        errors = []
+
+        def run(n):
+            try:
+                work(n)
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=run, args=(n,)) for n in range(self.threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.assertEqual(errors, [])
+
+    def test_mixed_operations(self):
+        cache = Cache('stress', ttl=0.001, maxSize=100, stripes=8)
+
+        def work(n):
+            rng = random.Random(n)
+            for i in range(self.rounds):
+                key = rng.randint(0, 500)
+                op = rng.random()
+                if op < 0.4:
+                    cache.set(key, (key, n))
+                elif op < 0.8:
+                    value = cache.get(key)
+                    if value is not None:
+                        assert value[0] == key
+                elif op < 0.9:
+                    cache.pop(key)
+                elif op < 0.99:
+                    cache.getOrCompute(key, lambda: (key, n))
+                else:
+                    cache.purge()
+
+        self.hammer(work)
+        self.assertTrue(len(cache) <= 8 * cache.stripeSize)
+
+    def test_one_value_per_key(self):
+        cache = Cache('stressCompute', ttl=None, maxSize=None)
+        seen = dict([(n, []) for n in range(self.threads)])
+
+        def work(n):
+            for i in range(self.rounds // 10):
+                seen[n].append(cache.getOrCompute(i % 50, lambda: object()))
+
+        self.hammer(work)
+        ## every thread got the same object for each key
+        for n in range(1, self.threads):
+            self.assertTrue(all(a is b for a, b in zip(seen[0], seen[n])))
+
+    def test_expiry_and_limit(self):
+        cache = Cache('stressExpiry', ttl=0.05, maxSize=10, stripes=1)
+        for i in range(20):
+            cache.set(i, i)
+        self.assertEqual(len(cache), 10)
+        self.assertEqual(cache.get(0), None)
+        self.assertEqual(cache.get(19), 19)
+        time.sleep(0.1)
+        self.assertEqual(cache.get(19), None)
+        cache.purge()
+        self.assertEqual(len(cache), 0)
+
+    def test_pop_expired(self):
+        cache = Cache('stressPop', ttl=0.05, maxSize=10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.pop('a'), 1)
+        time.sleep(0.1)
+        self.assertEqual(cache.pop('b', 'gone'), 'gone')
+        self.assertEqual(cache.pop('c', 'gone'), 'gone')
+
+    def test_caches_not_kept(self):
+        before = len(caches)
+        cache = Cache('stressThrowaway')
+        self.assertEqual(len(caches), before + 1)
+        del cache
+        self.assertEqual(len(caches), before)
+
+
+def twoSqliteFiles():
+    """
+    DATABASES with two SQLite replicas of the primary
+    """
+    databases = dict(settings.DATABASES)
+    for alias in ('replica', 'replica2'):
+        databases[alias] = {'ENGINE': 'django.db.backends.sqlite3',
+                            'NAME': '/tmp/xgds_data_%s.sqlite3' % alias,
+                            'TEST': {'MIRROR': 'default'}}
+    return databases
+
+
+@override_settings(DATABASES=twoSqliteFiles(),
+                   XGDS_DATA_READ_REPLICAS=['replica', 'replica2', 'missing'],
+                   DATABASE_ROUTERS=['xgds_data.routers.ReplicaRouter'])
+class ReplicaRoutingTest(SimpleTestCase):
+    """
+    Reads inside replicaReads go to one replica; writes and everything
+    else go to the primary
+    """
+    def test_reads_outside_a_block(self):
+        self.assertEqual(readAlias(), primaryAlias())
+        self.assertEqual(TrigramPosting.objects.all().db, primaryAlias())
+
+    def test_reads_inside_a_block(self):
+        with replicaReads('replica') as alias:
+            self.assertEqual(alias, 'replica')
+            self.assertEqual(readAlias(), 'replica')
+            self.assertEqual(TrigramPosting.objects.all().db, 'replica')
+            ## nested blocks keep the outer choice
+            with replicaReads('replica2') as inner:
+                self.assertEqual(inner, 'replica')
+            self.assertEqual(readAlias(), 'replica')
+        self.assertEqual(readAlias(), primaryAlias())
+
+    def test_decorator(self):
+        @readsFromReplica
+        def where():
+            return readAlias()
+        self.assertTrue(where() in ('replica', 'replica2'))
+        self.assertEqual(readAlias(), primaryAlias())
+
+    def test_writes_go_to_the_primary(self):
+        router = ReplicaRouter()
+        posting = TrigramPosting(model='m', field='f', trigram='abc', rowId=1)
+        posting._state.db = 'replica'
+        with replicaReads('replica'):
+            self.assertEqual(router.db_for_write(TrigramPosting, instance=posting), primaryAlias())
+            self.assertEqual(router.db_for_write(TrigramPosting), None)
+        self.assertFalse(router.allow_migrate('replica', 'xgds_data'))
+        self.assertEqual(router.allow_migrate(primaryAlias(), 'xgds_data'), None)
+
+    def test_round_robin(self):
+        ## aliases missing from DATABASES are never chosen
+        chosen = set(chooseReplica() for i in range(4))
+        self.assertEqual(chosen, set(['replica', 'replica2']))
+
+    @override_settings(XGDS_DATA_REPLICA_POLICY='lag', XGDS_DATA_REPLICA_MAX_LAG=30)
+    def test_least_lag(self):
+        try:
+            replicaLags.set('replica', 20.0)
+            replicaLags.set('replica2', 5.0)
+            self.assertEqual(chooseReplica(), 'replica2')
+            replicaLags.set('replica2', None)  # unreachable
+            self.assertEqual(chooseReplica(), 'replica')
+            replicaLags.set('replica', 60.0)  # too far behind
+            self.assertEqual(chooseReplica(), primaryAlias())
+        finally:
+            replicaLags.clear()
+
+
+class JobTest(SimpleTestCase):
+    """
+    Job status files, cancel requests, cleanup and result pages
+    """
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.override = override_settings(XGDS_DATA_JOB_DIR=self.base)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def makeJob(self, records=None, **status):
+        jobId = uuid.uuid4().hex
+        os.makedirs(jobs.jobPath(jobId))
+        jobs.writeStatus(jobId, id=jobId, **status)
+        if records is not None:
+            with open(jobs.jobPath(jobId, 'results.jsonl'), 'w') as out:
+                for r in records:
+                    out.write(json.dumps(r) + '\n')
+        return jobId
+
+    def test_status_updates_merge(self):
+        jobId = self.makeJob(state='queued', rows=0)
+        jobs.writeStatus(jobId, state='running')
+        status = jobs.readStatus(jobId)
+        self.assertEqual(status['state'], 'running')
+        self.assertEqual(status['rows'], 0)
+        self.assertEqual(jobs.readStatus('not-a-job-id'), None)
+
+    def test_concurrent_status_writes(self):
+        jobId = self.makeJob(state='running')
+
+        def work(n):
+            for i in range(50):
+                jobs.writeStatus(jobId, **{'field%d' % n: i})
+
+        workers = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        status = jobs.readStatus(jobId)
+        ## no update was lost, and no temporary file was left behind
+        for n in range(8):
+            self.assertEqual(status['field%d' % n], 49)
+        self.assertEqual([f for f in os.listdir(jobs.jobPath(jobId)) if f.endswith('.tmp')], [])
+
+    def test_cancel_survives_status_writes(self):
+        jobId = self.makeJob(state='queued')
+        self.assertTrue(jobs.cancelJob(jobId))
+        jobs.writeStatus(jobId, rows=1000)
+        self.assertTrue(jobs.readStatus(jobId).get('cancelRequested'))
+        self.assertTrue(jobs.cancelRequested(jobId))
+        done = self.makeJob(state='done')
+        self.assertFalse(jobs.cancelJob(done))
+
+    @override_settings(XGDS_DATA_JOB_TTL=100, XGDS_DATA_JOB_DEADLINE=10, XGDS_DATA_JOB_GRACE=10)
+    def test_cleanup(self):
+        now = time.time()
+        abandoned = self.makeJob(state='running', started=now - 30)
+        running = self.makeJob(state='running', started=now - 5)
+        expired = self.makeJob(state='done', finished=now - 200)
+        recent = self.makeJob(state='done', finished=now - 5)
+        jobs.cleanupJobs()
+        self.assertEqual(jobs.readStatus(abandoned)['state'], 'failed')
+        self.assertEqual(jobs.readStatus(abandoned)['error'], 'abandoned')
+        self.assertEqual(jobs.readStatus(running)['state'], 'running')
+        self.assertEqual(jobs.readStatus(expired), None)
+        self.assertEqual(jobs.readStatus(recent)['state'], 'done')
+
+    def test_result_pages(self):
+        jobId = self.makeJob(records=[{'n': n} for n in range(30)], state='done', rows=30)
+        self.assertEqual(jobs.jobResults(jobId, 25, 50), [{'n': n} for n in range(25, 30)])
+        factory = RequestFactory()
+        response = views.jobResults(factory.get('/', {'pageno': 2, 'pageSize': 10}), jobId)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['n'] for r in json.loads(response.content)['results']],
+                         list(range(10, 20)))
+        for bad in ({'pageno': 0}, {'pageno': 'x'}, {'pageSize': -5}):
+            response = views.jobResults(factory.get('/', bad), jobId)
+            self.assertEqual(response.status_code, 400)
+        response = views.jobResults(factory.get('/'), uuid.uuid4().hex)
+        self.assertEqual(response.status_code, 404)
+
+
+## a query that never ends on its own
+ENDLESS = ('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) '
+           'SELECT COUNT(*) FROM c')
+
+
+class SearchLimitTest(TestCase):
+    """
+    Deadlines, cancellation and the cost guard
+    """
+    def test_limit(self):
+        self.assertTrue(9 < Limit(10).remaining() <= 10)
+        self.assertEqual(Limit(None).remaining(), None)
+        limit = Limit(10, cancelled=lambda: True)
+        self.assertTrue(limit.isCancelled())
+        self.assertTrue(limit.stop.is_set())
+
+    def test_nested_deadlines(self):
+        with deadline(5):
+            self.assertEqual(currentLimit(TrigramPosting).seconds, 5)
+            with deadline(1):
+                self.assertEqual(currentLimit(TrigramPosting).seconds, 1)
+            self.assertEqual(currentLimit(TrigramPosting).seconds, 5)
+        with override_settings(XGDS_DATA_SEARCH_DEADLINE=7):
+            self.assertEqual(currentLimit(TrigramPosting).seconds, 7)
+
+    @skipUnless(connection.vendor == 'sqlite', 'uses the SQLite progress handler')
+    def test_timeout(self):
+        started = time.time()
+        with self.assertRaises(SearchTimeout) as raised:
+            with transaction.atomic():
+                with deadline(0.2):
+                    connection.cursor().execute(ENDLESS)
+        self.assertTrue(time.time() - started < 5)
+        self.assertTrue('narrow' in unicode(raised.exception))
+        ## the connection is still usable, without the limit
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1')
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+    @skipUnless(connection.vendor == 'sqlite', 'uses the SQLite progress handler')
+    def test_cancel(self):
+        timer = threading.Timer(0.2, cancelSearch, ['cancelTest'])
+        timer.start()
+        try:
+            with self.assertRaises(SearchTimeout) as raised:
+                with transaction.atomic():
+                    with deadline(None, searchId='cancelTest'):
+                        connection.cursor().execute(ENDLESS)
+        finally:
+            timer.cancel()
+        self.assertTrue('cancelled' in unicode(raised.exception))
+
+    @skipUnless(connection.vendor == 'sqlite', 'SQLite costs are rows scanned')
+    def test_cost_guard(self):
+        TrigramPosting.objects.bulk_create([TrigramPosting(model='m', field='f', trigram='abc', rowId=n)
+                                            for n in range(20)])
+        clearCaches()
+        query = TrigramPosting.objects.filter(trigram__contains='b')
+        self.assertTrue(guardCost(TrigramPosting, query) is query)
+        with override_settings(XGDS_DATA_SEARCH_COST_BUDGET=1000):
+            self.assertTrue(guardCost(TrigramPosting, query) is query)
+        with override_settings(XGDS_DATA_SEARCH_COST_BUDGET=5,
+                               XGDS_DATA_SEARCH_OVER_BUDGET='reject'):
+            self.assertRaises(SearchTooExpensive, guardCost, TrigramPosting, query)
+            ## lists are already fetched
+            self.assertEqual(guardCost(TrigramPosting, list(query)), list(query))
+
+
+class Row(object):
+    def __init__(self, score, name):
+        self.score = score
+        self.name = name
+
+
+class FederationTest(TestCase):
+    """
+    Merging results from several databases, and finding records again
+    """
+    def queries(self):
+        rng = random.Random(1)
+        rows = [Row(rng.randint(0, 10), 'row%03d' % n) for n in range(60)]
+        ## each database sorts its own rows the same way
+        parts = [sorted(rows[n::3], key=lambda r: (-r.score, r.name)) for n in range(3)]
+        return rows, [('default', p) for p in parts]
+
+    def test_merge_order(self):
+        rows, queries = self.queries()
+        expected = sorted(rows, key=lambda r: (-r.score, r.name))
+        merged = MergedResults(TrigramPosting, queries, ['name'])
+        self.assertEqual(merged[5:15], expected[5:15])
+        ## only as much of each database as the page needs
+        self.assertTrue(all(len(f) <= 15 for f in merged.fetched))
+        self.assertEqual(merged[0], expected[0])
+        self.assertEqual(list(merged), expected)
+        self.assertRaises(IndexError, lambda: merged[60])
+
+    def test_counts(self):
+        rows, queries = self.queries()
+        federated = FederatedResults(TrigramPosting, [('default', queries[0][1]),
+                                                      ('other', queries[1][1])],
+                                     ['name'], alias='default')
+        self.assertEqual(federated.count(), 40)
+        self.assertEqual(federated.counts, {'default': 20, 'other': 20})
+
+    def test_fullid(self):
+        posting = TrigramPosting.objects.create(model='m', field='f', trigram='abc', rowId=1)
+        fid = fullid(posting)
+        self.assertEqual(fid.split(':')[2], str(posting.pk))
+        self.assertEqual(len(fid.split(':')), 3)
+        ## records from another campaign's database say where they are
+        posting._state.db = 'campaign2'
+        self.assertEqual(fullid(posting), fid + ':campaign2')
+        self.assertEqual(getRecord(TrigramPosting, posting.pk, 'default'), posting)
+        self.assertRaises(TrigramPosting.DoesNotExist, getRecord, TrigramPosting, posting.pk + 1)
+
+
+class SingleFlightTest(SimpleTestCase):
+    """
+    Identical concurrent searches run once
+    """
+    def test_one_run(self):
+        runs = []
+        release = threading.Event()
+        results = []
+
+        def compute():
+            runs.append(1)
+            release.wait(5)
+            return ['answer']
+
+        def request():
+            results.append(singleFlight('sameSearch', compute))
+
+        workers = [threading.Thread(target=request) for n in range(10)]
+        for w in workers:
+            w.start()
+        time.sleep(0.2)
+        release.set()
+        for w in workers:
+            w.join()
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(results, [['answer']] * 10)
+
+    def test_errors_are_shared(self):
+        started = threading.Event()
+        errors = []
+
+        def compute():
+            started.set()
+            time.sleep(0.2)
+            raise ValueError('bad search')
+
+        def request():
+            try:
+                singleFlight('failingSearch', compute)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        started.wait(5)
+        request()
+        leader.join()
+        self.assertEqual(len(errors), 2)
+
+    def test_wait_capped_by_deadline(self):
+        release = threading.Event()
+        leader = threading.Thread(target=singleFlight, args=('slowSearch', lambda: release.wait(5)))
+        leader.start()
+        time.sleep(0.1)
+        started = time.time()
+        try:
+            self.assertRaises(SearchTimeout, singleFlight, 'slowSearch', lambda: 'mine', Limit(0.2))
+            self.assertTrue(time.time() - started < 2)
+        finally:
+            release.set()
+            leader.join()
+
+    def test_fingerprint(self):
+        qd = [{'name': 'abc', 'empty': '', 'ids': [3, 1, 2]}]
+        key = searchFingerprint(TrigramPosting, qd, pageno=1)
+        self.assertEqual(key, searchFingerprint(TrigramPosting, [{'ids': (1, 2, 3), 'name': 'abc'}],
+                                                pageno=1))
+        self.assertNotEqual(key, searchFingerprint(TrigramPosting, qd, pageno=2))
+        ## closures may hold per-request state
+        self.assertEqual(searchFingerprint(TrigramPosting, qd, queryGenerator=lambda: key), None)
+        with override_settings(XGDS_DATA_SINGLE_FLIGHT=False):
+            self.assertEqual(searchFingerprint(TrigramPosting, qd), None)
+
+    def test_data_version(self):
+        version = dataVersion(User)
+        dataChangedHandler(User)
+        self.assertEqual(dataVersion(User), version + 1)
+        ## fixture loads and our own bookkeeping don't count
+        dataChangedHandler(User, raw=True)
+        dataChangedHandler(TrigramPosting)
+        self.assertEqual(dataVersion(User), version + 1)
+        ## writes that send no signals
+        bumpDataVersion(User)
+        self.assertEqual(dataVersion(User), version + 2)
+
+
+class ParallelFetchTest(TransactionTestCase):
+    """
+    Counts and pages fetched side by side, on the workers' own connections
+    (so the rows are committed, for the workers to see)
+    """
+    def test_side_by_side(self):
+        def slow(value):
+            return lambda: time.sleep(0.3) or value
+
+        started = time.time()
+        done = runConcurrently(TrigramPosting, [('a', slow(1)), ('b', slow(2)), ('c', slow(3))])
+        self.assertEqual(done, {'a': 1, 'b': 2, 'c': 3})
+        self.assertTrue(time.time() - started < 0.8)
+
+        def fail():
+            raise ValueError('bad query')
+        self.assertRaises(ValueError, runConcurrently, TrigramPosting, [('a', slow(1)), ('b', fail)])
+
+    def test_same_page(self):
+        TrigramPosting.objects.bulk_create([TrigramPosting(model='m', field='f', trigram='abc', rowId=n)
+                                            for n in range(30)])
+        results, hardCount, totalCount = parallelFetchPage(TrigramPosting, [{}], 5, 15, soft=False)
+        expected = getMatches(TrigramPosting, [{}], threshold=1.0)
+        self.assertEqual((hardCount, totalCount), (30, 30))
+        self.assertEqual([r.pk for r in results], [r.pk for r in expected[5:15]])
+
+    @skipUnless(connection.vendor == 'sqlite', 'uses the SQLite progress handler')
+    def test_workers_under_deadline(self):
+        def endless():
+            connection.cursor().execute(ENDLESS)
+
+        started = time.time()
+        with self.assertRaises(SearchTimeout):
+            with deadline(0.3):
+                runConcurrently(TrigramPosting, [('endless', endless)])
+        self.assertTrue(time.time() - started < 5)
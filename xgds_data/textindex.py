@@ -0,0 +1,356 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+"""
+Index-backed text search.
+
+Fields listed in XGDS_DATA_FULLTEXT_FIELDS are searched by word: Postgres
+uses a tsvector GIN index, MySQL a FULLTEXT index and SQLite an FTS5
+shadow table kept in sync by triggers.
+
+Fields listed in XGDS_DATA_TRIGRAM_FIELDS are searched by substring:
+Postgres uses a pg_trgm GIN index that its ILIKE can use directly; other
+backends use the TrigramPosting table, which we keep up to date.
+
+Indexes are created with ./manage.py xgds_data_textindex.
+"""
+
+import re
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.conf import settings
+
+from xgds_data.introspection import (settingsForModel, db_table, pk,
+                                     qualifiedModelName)
+from xgds_data.models import TrigramPosting
+from xgds_data.routers import readAlias, primaryAlias
+
+wordPattern = re.compile(r'\w+', re.UNICODE)
+
+
+def dbVendor(alias=None):
+    """
+    Which kind of database we are talking to: postgresql, mysql, sqlite, ...
+    By default the one reads are going to (see routers), which may be a
+    replica or a mirror of another kind than the primary.
+    """
+    return connections[alias or readAlias()].vendor
+
+
+def fullTextLanguage():
+    try:
+        return settings.XGDS_DATA_FULLTEXT_LANGUAGE
+    except AttributeError:
+        return 'english'
+
+
+def isFullTextField(model, field):
+    """
+    Is this field configured for full-text search?
+    """
+    try:
+        return field.name in settingsForModel(settings.XGDS_DATA_FULLTEXT_FIELDS, model)
+    except AttributeError:
+        return False
+
+
+def fullTextFields(model):
+    """
+    The configured full-text fields that exist on the model
+    """
+    try:
+        names = settingsForModel(settings.XGDS_DATA_FULLTEXT_FIELDS, model)
+    except AttributeError:
+        return []
+    return [f for f in model._meta.fields if f.name in names]
+
+
+def qn(name, alias=None):
+    return connections[alias or readAlias()].ops.quote_name(name)
+
+
+def ftsTableName(model, field):
+    """
+    Name of the SQLite FTS5 shadow table for this field
+    """
+    return '%s_%s_fts' % (db_table(model), field.column)
+
+
+def queryTokens(qval):
+    return wordPattern.findall(qval)
+
+
+def fullTextFilter(model, field, qval, prefix=''):
+    """
+    Q object restricting to rows whose field matches all the words in qval,
+    using the text index. None if the backend or query can't use it, in which
+    case the caller should fall back to a substring match. prefix is the
+    relation path to model when filtering from another model.
+    """
+    tokens = queryTokens(qval)
+    if len(tokens) == 0:
+        return None
+    vendor = dbVendor()
+    table = qn(db_table(model))
+    column = qn(field.column)
+    pkcol = qn(pk(model).column)
+    if vendor == 'postgresql':
+        sql = ("SELECT {0} FROM {1} WHERE to_tsvector(%s::regconfig, coalesce({2}, '')) @@ plainto_tsquery(%s::regconfig, %s)"
+               .format(pkcol, table, column))
+        params = [fullTextLanguage(), fullTextLanguage(), ' '.join(tokens)]
+    elif vendor == 'mysql':
+        sql = ("SELECT {0} FROM {1} WHERE MATCH({2}) AGAINST (%s IN BOOLEAN MODE)"
+               .format(pkcol, table, column))
+        params = [' '.join(['+' + t for t in tokens])]
+    elif vendor == 'sqlite':
+        fts = qn(ftsTableName(model, field))
+        sql = "SELECT rowid FROM {0} WHERE {0} MATCH %s".format(fts)
+        params = [' '.join(['"%s"' % t for t in tokens])]
+    else:
+        return None
+    return Q(**{prefix + pk(model).name + '__in': RawSQL(sql, params)})
+
+
+def createIndexSql(model, field):
+    """
+    Statements to build the text index for a field on the current backend
+    """
+    vendor = dbVendor()
+    table = db_table(model)
+    indexName = qn('%s_%s_fulltext' % (table, field.column))
+    if vendor == 'postgresql':
+        return ["CREATE INDEX {0} ON {1} USING GIN (to_tsvector('{2}'::regconfig, coalesce({3}, '')))"
+                .format(indexName, qn(table), fullTextLanguage(), qn(field.column))]
+    elif vendor == 'mysql':
+        return ["CREATE FULLTEXT INDEX {0} ON {1} ({2})"
+                .format(indexName, qn(table), qn(field.column))]
+    elif vendor == 'sqlite':
+        fts = ftsTableName(model, field)
+        subs = {'fts': qn(fts),
+                'table': qn(table),
+                'col': qn(field.column),
+                'pk': qn(pk(model).column),
+                'trig': fts}
+        return ["CREATE VIRTUAL TABLE {fts} USING fts5({col}, content={table}, content_rowid={pk})".format(**subs),
+                ("CREATE TRIGGER {trig}_ai AFTER INSERT ON {table} BEGIN "
+                 "INSERT INTO {fts}(rowid, {col}) VALUES (new.{pk}, new.{col}); END").format(**subs),
+                ("CREATE TRIGGER {trig}_ad AFTER DELETE ON {table} BEGIN "
+                 "INSERT INTO {fts}({fts}, rowid, {col}) VALUES ('delete', old.{pk}, old.{col}); END").format(**subs),
+                ("CREATE TRIGGER {trig}_au AFTER UPDATE ON {table} BEGIN "
+                 "INSERT INTO {fts}({fts}, rowid, {col}) VALUES ('delete', old.{pk}, old.{col}); "
+                 "INSERT INTO {fts}(rowid, {col}) VALUES (new.{pk}, new.{col}); END").format(**subs),
+                "INSERT INTO {fts}({fts}) VALUES ('rebuild')".format(**subs)]
+    else:
+        return []
+
+
+def dropIndexSql(model, field):
+    """
+    Statements to remove the text index for a field on the current backend
+    """
+    vendor = dbVendor()
+    table = db_table(model)
+    indexName = qn('%s_%s_fulltext' % (table, field.column))
+    if vendor == 'postgresql':
+        return ["DROP INDEX IF EXISTS {0}".format(indexName)]
+    elif vendor == 'mysql':
+        return ["DROP INDEX {0} ON {1}".format(indexName, qn(table))]
+    elif vendor == 'sqlite':
+        fts = ftsTableName(model, field)
+        return ["DROP TRIGGER IF EXISTS {0}_ai".format(fts),
+                "DROP TRIGGER IF EXISTS {0}_ad".format(fts),
+                "DROP TRIGGER IF EXISTS {0}_au".format(fts),
+                "DROP TABLE IF EXISTS {0}".format(qn(fts))]
+    else:
+        return []
+
+
+def isTrigramField(model, field):
+    """
+    Is this field configured for trigram substring search?
+    """
+    try:
+        return field.name in settingsForModel(settings.XGDS_DATA_TRIGRAM_FIELDS, model)
+    except AttributeError:
+        return False
+
+
+def trigramFields(model):
+    """
+    The configured trigram fields that exist on the model
+    """
+    try:
+        names = settingsForModel(settings.XGDS_DATA_TRIGRAM_FIELDS, model)
+    except AttributeError:
+        return []
+    return [f for f in model._meta.fields if f.name in names]
+
+
+def trigrams(text):
+    """
+    The set of (lower case) three character substrings
+    """
+    if text is None:
+        return set()
+    text = (u'%s' % text).lower()
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+
+def usesPostingTable(alias=None):
+    """
+    Postgres has pg_trgm; everyone else gets our own posting table
+    """
+    return dbVendor(alias) != 'postgresql'
+
+
+def trigramCandidatesSql(model, field, grams):
+    """
+    Subquery for the ids of rows whose field contains all the given trigrams
+    """
+    sql = ('SELECT {0} FROM {1} WHERE {2} = %s AND {3} = %s AND {4} IN ({5}) GROUP BY {0} HAVING COUNT(DISTINCT {4}) = %s'
+           .format(qn('rowId'), qn(TrigramPosting._meta.db_table),
+                   qn('model'), qn('field'), qn('trigram'),
+                   ', '.join(['%s'] * len(grams))))
+    params = [qualifiedModelName(model), field.name] + sorted(grams) + [len(grams)]
+    return sql, params
+
+
+def trigramSimilaritySql(model, field, grams, pkRef):
+    """
+    Expression for the Jaccard similarity between grams and the trigrams of
+    the row pkRef refers to, from the posting table of whichever database
+    runs the query. Score formulas take no parameters, so the grams are
+    inlined; they must be plain words (see search.similarityLiteral).
+    """
+    postings = ("SELECT COUNT(*) FROM {0} WHERE {1} = '{2}' AND {3} = '{4}' AND {5} = {6}"
+                .format(qn(TrigramPosting._meta.db_table), qn('model'), qualifiedModelName(model),
+                        qn('field'), field.name, qn('rowId'), pkRef))
+    shared = "({0} AND {1} IN ({2}))".format(postings, qn('trigram'),
+                                            ', '.join(["'%s'" % g for g in sorted(grams)]))
+    return "(1.0 * {0} / ({1} + ({2}) - {0}))".format(shared, len(grams), postings)
+
+
+def trigramFilter(model, field, qval, prefix=''):
+    """
+    Q object restricting to candidate rows that share every trigram of qval,
+    from the posting table. The caller still has to verify the substring
+    match. None if the posting table can't narrow things down.
+    """
+    if not usesPostingTable():
+        return None
+    grams = trigrams(qval)
+    if len(grams) == 0:
+        return None
+    sql, params = trigramCandidatesSql(model, field, grams)
+    return Q(**{prefix + pk(model).name + '__in': RawSQL(sql, params)})
+
+
+def indexTrigrams(instance, tfields=None, created=False):
+    """
+    (Re)post the trigrams of one row, touching only the grams that changed
+    """
+    model = instance.__class__
+    if tfields is None:
+        tfields = trigramFields(model)
+    qname = qualifiedModelName(model)
+    postings = TrigramPosting.objects.using(primaryAlias())
+    for f in tfields:
+        grams = trigrams(getattr(instance, f.attname))
+        mine = postings.filter(model=qname, field=f.name, rowId=instance.pk)
+        if created:
+            ## a new row has nothing posted yet
+            posted = set()
+        else:
+            posted = set(mine.values_list('trigram', flat=True))
+        if posted == grams:
+            ## this field did not change
+            continue
+        if posted - grams:
+            mine.filter(trigram__in=list(posted - grams)).delete()
+        postings.bulk_create([TrigramPosting(model=qname, field=f.name,
+                                             trigram=g, rowId=instance.pk)
+                              for g in grams - posted])
+
+
+def rebuildTrigrams(model, chunkSize=1000):
+    """
+    Repost the trigrams of every row of the model
+    """
+    tfields = trigramFields(model)
+    qname = qualifiedModelName(model)
+    TrigramPosting.objects.filter(model=qname).delete()
+    postings = []
+    rows = 0
+    for row in model.objects.values_list(pk(model).attname, *[f.attname for f in tfields]).iterator():
+        rows = rows + 1
+        for f, val in zip(tfields, row[1:]):
+            postings.extend([TrigramPosting(model=qname, field=f.name, trigram=g, rowId=row[0])
+                             for g in trigrams(val)])
+        if len(postings) >= chunkSize:
+            TrigramPosting.objects.bulk_create(postings)
+            postings = []
+    TrigramPosting.objects.bulk_create(postings)
+    return rows
+
+
+def trigramSaveHandler(sender, instance, created=False, raw=False,
+                       update_fields=None, **kwargs):
+    """
+    post_save handler that keeps the posting table current; fixtures
+    (raw saves) are left to rebuildTrigrams
+    """
+    if raw:
+        return
+    ## postings are written to the primary, whatever reads go to
+    if usesPostingTable(primaryAlias()):
+        tfields = trigramFields(sender)
+        if update_fields is not None:
+            tfields = [f for f in tfields if f.name in update_fields]
+        if tfields:
+            indexTrigrams(instance, tfields, created)
+
+
+def trigramDeleteHandler(sender, instance, **kwargs):
+    """
+    post_delete handler that keeps the posting table current
+    """
+    if usesPostingTable(primaryAlias()) and trigramFields(sender):
+        TrigramPosting.objects.filter(model=qualifiedModelName(sender), rowId=instance.pk).delete()
+
+
+def createTrigramIndexSql(model, field):
+    """
+    Statements to build the pg_trgm index for a field; other backends use
+    the posting table instead
+    """
+    if dbVendor() == 'postgresql':
+        table = db_table(model)
+        ## matches the UPPER(col::text) that Django generates for icontains
+        return ["CREATE EXTENSION IF NOT EXISTS pg_trgm",
+                "CREATE INDEX {0} ON {1} USING GIN ((UPPER({2}::text)) gin_trgm_ops)"
+                .format(qn('%s_%s_trigram' % (table, field.column)), qn(table), qn(field.column))]
+    else:
+        return []
+
+
+def dropTrigramIndexSql(model, field):
+    if dbVendor() == 'postgresql':
+        return ["DROP INDEX IF EXISTS {0}".format(qn('%s_%s_trigram' % (db_table(model), field.column)))]
+    else:
+        return []
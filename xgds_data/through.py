@@ -0,0 +1,168 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+The models and fields a VirtualIncludedField reaches through its through
+field, worked out once per field rather than on every call.
+
+For a generic (content type) through field that means one DISTINCT scan
+of the content types in use, which is remembered until a row first links
+to a content type that wasn't seen before; post_save notices that (see
+throughTypeHandler) and every process drops its through models. With
+XGDS_DATA_SINGLE_FLIGHT_CACHE set, the other processes are told through
+that shared cache, checked at most once a second.
+"""
+
+import time
+import threading
+
+from django.db import transaction
+from django.contrib.contenttypes.models import ContentType
+
+from xgds_data.cache import Cache
+from xgds_data.introspection import modelFields, resolveField, qualifiedModelName
+from xgds_data.singleflight import sharedCache
+
+## (model, field name) -> (version, through models, target fields, content type ids)
+throughCache = Cache('throughModels', ttl=None, maxSize=None)
+## model -> genericThroughFields(model)
+genericFieldsCache = Cache('genericThroughFields', ttl=None, maxSize=None)
+VERSION_KEY = 'xgds_data_through_version'
+versionLock = threading.Lock()
+localVersion = [0]
+## (checked at, version) of the shared version
+sharedVersion = [0, 0]
+
+
+def throughVersion():
+    """
+    A number that changes whenever a generic through field sees a new content type
+    """
+    cache = sharedCache()
+    if cache is None:
+        return localVersion[0]
+    now = time.time()
+    checkedAt, version = sharedVersion
+    if now - checkedAt > 1:
+        version = cache.get(VERSION_KEY, 0)
+        sharedVersion[:] = [now, version]
+    return version
+
+
+def bumpThroughVersion():
+    cache = sharedCache()
+    if cache is not None:
+        cache.add(VERSION_KEY, 0, None)
+        try:
+            version = cache.incr(VERSION_KEY)
+        except ValueError:
+            cache.set(VERSION_KEY, 1, None)  # evicted in between
+            version = 1
+        sharedVersion[:] = [time.time(), version]
+    else:
+        with versionLock:
+            localVersion[0] += 1
+    throughCache.clear()
+
+
+def throughField(field):
+    """
+    The field a virtual field goes through, or None
+    """
+    return resolveField(field.model, field.throughfield_name)
+
+
+def findThrough(field):
+    """
+    (through models, target fields, content type ids) of a virtual field, from the database
+    """
+    match = throughField(field)
+    ctIds = frozenset()
+    if match is None:
+        throughmodels = []
+    else:
+        try:
+            ct_field = match.ct_field
+        except AttributeError:  # not a GenericForeignKey
+            ct_field = None
+        if ct_field:
+            ctIds = frozenset([x[0] for x in field.model.objects.values_list(ct_field).distinct()
+                               if x[0] is not None])
+            throughmodels = [ContentType.objects.get_for_id(x).model_class() for x in sorted(ctIds)]
+        else:
+            throughmodels = [match.rel.to]
+    targets = []
+    for tm in throughmodels:
+        for tmf in modelFields(tm):
+            if tmf.name == field.base_name:
+                targets.append(tmf)
+    return (throughmodels, targets, ctIds)
+
+
+def resolveThrough(field):
+    """
+    (through models, target fields) of a virtual field
+    """
+    key = (qualifiedModelName(field.model), field.name)
+    version = throughVersion()
+    entry = throughCache.get(key)
+    if (entry is None) or (entry[0] != version):
+        entry = (version,) + findThrough(field)
+        throughCache.set(key, entry)
+    return (entry[1], entry[2])
+
+
+def genericThroughFields(model):
+    """
+    (virtual field, content type field) for the model's virtual fields through generic relations
+    """
+    def find():
+        found = []
+        for f in modelFields(model):
+            if getattr(f, 'throughfield_name', None) is not None:
+                ct_field = getattr(throughField(f), 'ct_field', None)
+                if ct_field is not None:
+                    found.append((f, resolveField(model, ct_field)))
+        return found
+
+    return genericFieldsCache.getOrCompute(model, find)
+
+
+def throughTypeHandler(sender, instance, raw=False, **kwargs):
+    """
+    post_save handler that drops the through models when a row links to a new content type
+    """
+    if raw:
+        return
+    for field, ctField in genericThroughFields(sender):
+        ctId = getattr(instance, ctField.attname, None)
+        if ctId is None:
+            continue
+        entry = throughCache.get((qualifiedModelName(sender), field.name))
+        if (entry is not None) and (ctId in entry[3]):
+            continue
+        ## not seen here; is it new to the table?
+        if not sender.objects.filter(**{ctField.attname: ctId}).exclude(pk=instance.pk).exists():
+            ## once the row is visible, or a scan in between would cache
+            ## the old types under the new version
+            try:
+                transaction.on_commit(bumpThroughVersion)
+            except AttributeError:
+                ## before Django 1.9
+                bumpThroughVersion()
+            return
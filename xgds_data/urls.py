@@ -30,6 +30,10 @@ urlpatterns = [
     ## Searching
     url(r'^search/$', views.chooseSearchApp,
         name='xgds_data_searchChooseApp'),
+    url(r'^search/batch/$', views.batchSearch,
+        name='xgds_data_batchSearch'),
+    url(r'^search/all/$', views.globalSearchView,
+        name='xgds_data_globalSearch'),
     url(r'^search/(?P<searchModuleName>[^/]+)/$', views.chooseSearchModel,
         name='xgds_data_searchChooseModel'),
 
@@ -38,15 +42,50 @@ urlpatterns = [
     url(r'^search/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/(?P<expert>[^/]+)$',
         views.searchChosenModel,name='xgds_data_searchChosenModel'),
 
+    url(r'^refresh/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/$',
+        views.refreshSearch, name='xgds_data_refreshSearch'),
+    url(r'^refresh/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/(?P<soft>[^/]+)/*$',
+        views.refreshSearch, name='xgds_data_refreshSearch'),
+
     url(r'^similar/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/(?P<pkid>[^/]+)$',
         views.searchSimilar, name='xgds_data_searchSimilar'),
 
 
+    ## background searches and exports
+    url(r'^job/submit/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/(?P<kind>[^/]+)/$',
+        views.submitSearchJob, name='xgds_data_submitSearchJob'),
+    url(r'^job/(?P<jobId>[0-9a-f]+)/$',
+        views.jobStatus, name='xgds_data_jobStatus'),
+    url(r'^job/(?P<jobId>[0-9a-f]+)/cancel/$',
+        views.cancelJob, name='xgds_data_cancelJob'),
+    url(r'^job/(?P<jobId>[0-9a-f]+)/results/$',
+        views.jobResults, name='xgds_data_jobResults'),
+    url(r'^job/(?P<jobId>[0-9a-f]+)/download/$',
+        views.jobDownload, name='xgds_data_jobDownload'),
+
+
+    ## standing queries, checked against new rows
+    url(r'^standing/$', views.listStandingQueries,
+        name='xgds_data_listStandingQueries'),
+    url(r'^standing/create/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/$',
+        views.createStandingQuery, name='xgds_data_createStandingQuery'),
+    url(r'^standing/create/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/(?P<soft>[^/]+)/*$',
+        views.createStandingQuery, name='xgds_data_createStandingQuery'),
+    url(r'^standing/(?P<queryId>\d+)/hits/$',
+        views.standingQueryHits, name='xgds_data_standingQueryHits'),
+    url(r'^standing/(?P<queryId>\d+)/cancel/$',
+        views.cancelStandingQuery, name='xgds_data_cancelStandingQuery'),
+
+
     ## Plotting
     url(r'^retrieve/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/(?P<field>[^/]*)$',
         views.getFieldValues, name='xgds_data_getFieldValues'),
     url(r'^retrieve/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/(?P<field>[^/]+)/(?P<soft>[^/]+)/*$',
         views.getFieldValues, name='xgds_data_getFieldValues'),
+    url(r'^estimate/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/$',
+        views.getApproxCount, name='xgds_data_getApproxCount'),
+    url(r'^estimate/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/(?P<soft>[^/]+)/*$',
+        views.getApproxCount, name='xgds_data_getApproxCount'),
     url(r'^search/plot/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/$',
         views.plotQueryResults, name='xgds_data_searchPlotQueryResults'),
     url(r'^search/plot/(?P<searchModuleName>[^/]+)/(?P<searchModelName>[^/]+)/(?P<soft>[^/]+)/*$',
@@ -58,6 +97,10 @@ urlpatterns = [
         views.displayRecord, name='xgds_data_displayRecord'),
     url(r'^display/(?P<displayModuleName>[^/]+)/(?P<displayModelName>[^/]+)/(?P<rid>[^/]*)/(?P<force>[^/]*)$',
         views.displayRecord, name='xgds_data_displayRecord'),
+    url(r'^displayRecord/(?P<fid>[^/]+)$',
+        views.displayFullid, name='xgds_data_displayFullid'),
+    url(r'^displayRecord/(?P<fid>[^/]+)/(?P<force>[^/]*)$',
+        views.displayFullid, name='xgds_data_displayFullid'),
 
 
     ## Handling collections
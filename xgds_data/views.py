@@ -25,12 +25,13 @@ import pytz
 import calendar
 #import StringIO
 from itertools import chain
+from multiprocessing.pool import ThreadPool
 
 
 from django.apps import apps
 from django import forms
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.core.urlresolvers import (resolve, reverse, NoReverseMatch)
 #from django.template import RequestContext
 #from django.db import connection, DatabaseError
@@ -51,17 +52,32 @@ except ImportError:
     GEOCAMUTIL_FOUND = False
 
 from django.conf import settings
-from xgds_data.introspection import (modelFields, maskField, resolveField, isAbstract,
+from xgds_data.introspection import (modelFields, visibleFields, maskField, resolveField, isAbstract,
                                      getModuleNames, getModels,
                                      resolveModel, ordinalField,
                                      pk, pkValue, verbose_name, verbose_name_plural,
-                                     settingsForModel,
-                                     modelName, moduleName, fullid)
+                                     settingsForModel, isSkippedApp,
+                                     modelName, moduleName, fullid,
+                                     getPrimaryTimeField, resolveSetting,
+                                     qualifiedModelName)
 from xgds_data.forms import QueryForm, SearchForm, EditForm, AxesForm, SpecializedForm
-from xgds_data.models import Collection, GenericLink
+from xgds_data.models import Collection, GenericLink, StandingQuery
 from xgds_data.dlogging import recordRequest, recordList, log_and_render
 from xgds_data.logconfig import logEnabled
-from xgds_data.search import getMatches, pageLimits, retrieve
+from xgds_data.search import (getMatches, pageLimits, retrieve, getRecord, estimateMatches,
+                              searchWatermark, refreshMatches, mergeTop)
+from xgds_data.globalindex import globalIndexEnabled, globalSearch
+from xgds_data.knn import similarRecords
+from xgds_data import jobs
+from xgds_data.cache import Cache
+from xgds_data.routers import readsFromReplica, closeConnections
+from xgds_data.federation import searchDatabases, resultCount
+from xgds_data.singleflight import searchFingerprint, singleFlight
+from xgds_data.admission import admitted, Overloaded, overloadedResponse
+from xgds_data.parallel import concurrentFetchEnabled, parallelFetchPage, SOFT_LIMIT
+from xgds_data.standing import invalidateStandingQueries
+from xgds_data.limits import (deadline, searchDeadline, exportDeadline, guardCost,
+                              SearchLimitExceeded, SearchTimeout, currentLimit)
 from xgds_data.utils import total_seconds, getDataFromRequest
 from xgds_data.templatetags import xgds_data_extras
 
@@ -78,7 +94,8 @@ except ImportError:
 if logEnabled():
     from xgds_data.models import RequestLog, RequestArgument, ResponseLog, HttpRequestReplay
 
-queryCache = {}
+## results of plotted queries, keyed by their sql
+queryCache = Cache('query', ttl=300, maxSize=50)
 
 def PostGet(request):
     """
@@ -104,17 +121,6 @@ def index(request):
 #         'qualifiedName': qualifiedName
 #     }
 
-if (hasattr(settings, 'XGDS_DATA_SEARCH_SKIP_APP_PATTERNS')):
-    SKIP_APP_REGEXES = [re.compile(_p) for _p in settings.XGDS_DATA_SEARCH_SKIP_APP_PATTERNS]
-
-
-def isSkippedApp(appName):
-    try:
-        return any((r.match(appName) for r in SKIP_APP_REGEXES))
-    except NameError:
-        return (appName.find('django') > -1)
-
-
 # def searchModelsDefault():
 #     """
 #     Pick out some reasonable search models if none were explicitly listed
@@ -220,7 +226,35 @@ def chooseSearchApp(request):
     return render(request,
                   'xgds_data/chooseSearchApp.html',
                   {'title': 'Search Apps',
-                   'apps': apps})
+                   'apps': apps,
+                   'globalIndex': globalIndexEnabled()})
+
+
+@readsFromReplica
+def globalSearchView(request):
+    """
+    Search all models at once through the global index. start and end
+    are epoch seconds.
+    """
+    data = PostGet(request)
+    query = data.get('q', '')
+    try:
+        start = float(data['start']) if data.get('start') else None
+        end = float(data['end']) if data.get('end') else None
+    except ValueError:
+        start = end = None
+    results = []
+    if query or (start is not None) or (end is not None):
+        for rec, hits in globalSearch(query, start=start, end=end):
+            results.append((moduleName(rec), modelName(rec), verbose_name(rec),
+                            pkValue(rec), unicode(rec), hits))
+    return render(request,
+                  'xgds_data/globalSearch.html',
+                  {'title': 'Search Everything',
+                   'query': query,
+                   'start': start,
+                   'end': end,
+                   'results': results})
 
 
 def chooseModel(request, moduleName, title, action, urlName):
@@ -263,33 +297,47 @@ def csvEncode(something):
         return something
 
 
-def formsetifyFieldName(i, fname):
+def writeCsv(out, results, myFields):
     """
-    Returns the field name for the ith form and given fname
+    Write results to a file-like object as csv, one column per field
     """
-    return '-'.join(['form', str(i), fname])
+    writer = csv.writer(out)
+    writer.writerow([f.verbose_name for f in myFields])
+    for r in results:
+        ##            r.get(f.name,None)
+        ## writer.writerow([csvEncode(safegetattr(r, f.name, None)) for f in myFields ])
+        row = []
+        for f in myFields:
+            val = xgds_data_extras.getattribute(r, f)
+            if isinstance(f, models.ImageField):
+                val = f.storage.url(val)
+            elif isinstance(f, models.ManyToManyField):
+                vals = []
+                for v in val:
+                    vals.append(unicode(v))
+                val = '"{0}"'.format(','.join(vals))
+            elif isinstance(val, basestring):
+                pass
+            elif isinstance(val, User):
+                val = ', '.join([val.last_name, val.first_name])
+            else:
+                try:
+                    val = val()
+                except TypeError:
+                    pass
+                try:
+                    val = ', '.join(unicode(x) for x in val)
+                except TypeError:
+                    pass
+            row.append(val)
+        writer.writerow([csvEncode(x) for x in row ])
 
 
-def resolveSetting(configName, myModel, defaultSetting, override=None):
+def formsetifyFieldName(i, fname):
     """
-    Figures out whether a specialized setting exists, or if the default should be used
+    Returns the field name for the ith form and given fname
     """
-    setting = None
-    if override:
-        oconfig = override.get(configName,None)
-    else:
-        oconfig = None
-    config = getattr(settings, configName, None)
-    for model in myModel.__mro__:
-        if issubclass(model, Model) and model != Model:
-            if not setting and oconfig:
-                setting = oconfig.get(model._meta.object_name, None)
-            if not setting and config:
-                setting = config.get(model._meta.object_name, None)
-    if setting:
-        return setting
-    else:
-        return defaultSetting
+    return '-'.join(['form', str(i), fname])
 
 
 def searchSimilar(request, searchModuleName, searchModelName, pkid,
@@ -351,6 +399,16 @@ def searchSimilar(request, searchModuleName, searchModelName, pkid,
         simdata = multidict
         simdata.update(defaults)
 
+    ## answer straight from the nearest-neighbour index when there is one
+    neighbors = similarRecords(myModel, me)
+    if neighbors is not None:
+        simdata = QueryDict('fnctn=similar', mutable=True)
+        simdata.update(getDataFromRequest(request))
+        for key, val in defaults.items():
+            simdata[key] = val
+        return searchChosenModelCore(request, simdata, searchModuleName, searchModelName,
+                                     queryGenerator=queryGenerator, presetResults=neighbors)
+
     return searchChosenModelCore(request, defaults, searchModuleName, searchModelName)
 
 
@@ -389,18 +447,6 @@ def safegetattr(obj, attname, default = None):
         return None
 
 
-def getPrimaryTimeField(model):
-    fieldDict = dict([(f.name, f)
-                      for f in model._meta.fields])
-    try:
-        for f in settings.XGDS_DATA_TIME_FIELDS:
-            if f in fieldDict:
-                return f
-    except AttributeError:
-        pass  # no worries
-    return None
-
-
 def getDtFromQueryParam(param):
     if param is None:
         return None
@@ -450,7 +496,7 @@ def editRecord(request, editModuleName, editModelName, rid):
     reqlog = recordRequest(request)
     myModel = resolveModel(editModuleName, editModelName)
     tmpFormClass = SpecializedForm(EditForm, myModel)
-    myFields = [x for x in modelFields(myModel) if not maskField(x) ]
+    myFields = list(visibleFields(myModel))
     record = myModel.objects.get(pk=rid)
     data = PostGet(request)
     if (data.get('fnctn',None) == 'edit'):
@@ -501,14 +547,26 @@ def editRecord(request, editModuleName, editModelName, rid):
                            })
 
 
-def displayRecord(request, displayModuleName, displayModelName, rid, force=False):
+def displayFullid(request, fid, force=False):
     """
-    Default display for a record
+    displayRecord by fullid, which names the database of a record found by
+    a federated search
+    """
+    parts = fid.split(':')
+    if len(parts) < 3:
+        raise Http404
+    return displayRecord(request, parts[0], parts[1], parts[2], force=force,
+                         database=(parts[3] if len(parts) > 3 else None))
+
+
+def displayRecord(request, displayModuleName, displayModelName, rid, force=False, database=None):
+    """
+    Default display for a record; database is the alias it is in, if not the usual one
     """
     reqlog = recordRequest(request)
     myModel = resolveModel(displayModuleName, displayModelName)
     try:
-        record = myModel.objects.get(pk=rid)
+        record = getRecord(myModel, rid, database)
         retformat = PostGet(request).get('format', 'html')
         try:
             if settings.XGDS_DATA_EDITING:
@@ -534,7 +592,7 @@ def displayRecord(request, displayModuleName, displayModelName, rid, force=False
         except AttributeError:
             pass # not defined
 
-        myFields = [x for x in modelFields(myModel) if not maskField(x) ]
+        myFields = list(visibleFields(myModel))
         if retformat == 'json':
             renderfn = log_and_json
         else:
@@ -777,20 +835,35 @@ def log_and_json(request, reqlog, template, templateargs, nolog = None, listing
 
 
 def queryLogic(myModel, formset, queryStart = None, queryEnd = None,
-               soft = True, queryGenerator=None):
+               soft = True, queryGenerator=None, notes=None, databases=None):
     """
-    query logic
+    query logic. Messages for the user (e.g., that the results are only
+    approximate) are added to notes, if given. Run it under limits.deadline.
+    databases lists the aliases to search across, by default the model's
+    XGDS_DATA_SEARCH_DATABASES.
     """
-    hardresults = getMatches(myModel,formsetToQD(formset),
-                             threshold=1.0,
-                             queryGenerator=queryGenerator)
+    if databases is None:
+        databases = searchDatabases(myModel)
+    ## the cost guard runs before anything is counted, so counting can't
+    ## scan more than the budget allows; downgraded queries count the sample
+    candidateNotes = []
+    hardresults = guardCost(myModel,
+                            getMatches(myModel,formsetToQD(formset),
+                                       threshold=1.0,
+                                       queryGenerator=queryGenerator,
+                                       databases=databases),
+                            notes=candidateNotes)
     try:
         hardCount = hardresults.count()
     except (AttributeError, TypeError):
         hardCount = len(hardresults)
     if (hardCount <= 1E2) and soft:
-        results = getMatches(myModel,formsetToQD(formset),
-                             queryGenerator=queryGenerator)
+        candidateNotes = []
+        results = guardCost(myModel,
+                            getMatches(myModel,formsetToQD(formset),
+                                       queryGenerator=queryGenerator,
+                                       databases=databases),
+                            notes=candidateNotes)
         try:
             totalCount = results.count()
         except (AttributeError, TypeError):
@@ -798,6 +871,11 @@ def queryLogic(myModel, formset, queryStart = None, queryEnd = None,
     else:
         results = hardresults
         totalCount = hardCount
+    if notes is not None:
+        notes.extend(candidateNotes)
+    if (notes is not None) and (getattr(results, 'counts', None) is not None):
+        notes.append('Matches per database: ' +
+                     ', '.join(['%s %d' % (alias, n) for alias, n in results.counts.items()]))
 
     if (queryEnd is not None) and (queryStart is None):
         results = results[0:queryEnd]
@@ -815,14 +893,76 @@ def queryLogic(myModel, formset, queryStart = None, queryEnd = None,
     #                                             queryGenerator=queryGenerator)
 
 
-def searchChosenModelCore(request, data, searchModuleName, searchModelName, expert=False, override=None, passthroughs=dict(), queryGenerator=None):
+def fetchPage(myModel, formset, queryStart=None, queryEnd=None,
+              soft=True, queryGenerator=None, notes=None):
     """
-    Search over the fields of the selected model
+    queryLogic, with the page of results fetched into a list
+    """
+    pfs = [ f.name for f in modelFields(myModel) if isinstance(f,related.RelatedField) and not maskField(f) ]
+    if concurrentFetchEnabled():
+        fetched = parallelFetchPage(myModel, formsetToQD(formset), queryStart=queryStart,
+                                    queryEnd=queryEnd, soft=soft, queryGenerator=queryGenerator,
+                                    notes=notes, databases=searchDatabases(myModel),
+                                    prefetch=pfs)
+        if fetched is not None:
+            return fetched
+    results, hardCount, totalCount = queryLogic(myModel, formset,
+                                                queryStart = queryStart,
+                                                queryEnd = queryEnd,
+                                                soft = soft, queryGenerator=queryGenerator,
+                                                notes=notes)
+    try:
+        results = results.prefetch_related(*pfs)
+    except AttributeError:
+        pass # probably got list-ified
+    if totalCount:
+        results = list(results)
+    else:
+        ## saves time if this was an expensive query
+        ## we already know there are no results
+        results = list()
+    return (results, hardCount, totalCount)
+
+
+def searchPage(myModel, formset, queryStart=None, queryEnd=None,
+               soft=True, queryGenerator=None, notes=None, fetchAll=False):
+    """
+    fetchPage, except that identical searches running at the same time
+    (same query, page and data version) are only run once (see singleflight).
+    Only the search that runs waits for admission (raising Overloaded);
+    the requests sharing its result don't hold a slot.
+    """
+    def run():
+        runNotes = []
+        with admitted(myModel, formsetToQD(formset), soft=soft, fetchAll=fetchAll):
+            results, hardCount, totalCount = fetchPage(myModel, formset, queryStart=queryStart,
+                                                       queryEnd=queryEnd, soft=soft,
+                                                       queryGenerator=queryGenerator, notes=runNotes)
+        return (results, hardCount, totalCount, runNotes)
+
+    key = searchFingerprint(myModel, formsetToQD(formset), queryGenerator=queryGenerator,
+                            soft=soft, queryStart=queryStart, queryEnd=queryEnd)
+    if key is None:
+        results, hardCount, totalCount, runNotes = run()
+    else:
+        results, hardCount, totalCount, runNotes = singleFlight(key, run, currentLimit(myModel))
+    if notes is not None:
+        notes.extend(runNotes)
+    ## a copy, since the list may be shared with other requests
+    return (list(results), hardCount, totalCount)
+
+
+@readsFromReplica
+def searchChosenModelCore(request, data, searchModuleName, searchModelName, expert=False, override=None, passthroughs=dict(), queryGenerator=None,
+                          presetResults=None):
+    """
+    Search over the fields of the selected model. presetResults, if given,
+    are shown instead of running the query (e.g., nearest neighbours).
     """
     starttime = datetime.datetime.now(pytz.utc)
     reqlog = recordRequest(request)
     myModel = resolveModel(searchModuleName, searchModelName)
-    myFields = [x for x in modelFields(myModel) if not maskField(x) ]
+    myFields = list(visibleFields(myModel))
 
     # If 'start' or 'end' query parameters are specified in the initial
     # GET method URL, use them to set initial values for the 'primary
@@ -892,6 +1032,7 @@ def searchChosenModelCore(request, data, searchModuleName, searchModelName, expe
 
     totalCount = None
     hardCount = None
+    watermark = None
 
     if (mode == 'addform'):
         formCount = int(data['form-TOTAL_FORMS'])
@@ -919,6 +1060,15 @@ def searchChosenModelCore(request, data, searchModuleName, searchModelName, expe
     elif (mode == None):
         formset = tmpFormSet(initial=[initialData])
     ##elif ((mode == 'query') or (mode == 'csv') or (mode == 'similar')):
+    elif presetResults is not None:
+        formset = tmpFormSet(initial=[data])
+        totalCount = len(presetResults)
+        if page is None:
+            results = presetResults
+        else:
+            queryStart, queryEnd = pageLimits(page, pageSize)
+            results = presetResults[queryStart:queryEnd]
+            more = queryEnd < totalCount
     else:
         if (mode == 'similar'):
             formCount = 1
@@ -942,57 +1092,30 @@ def searchChosenModelCore(request, data, searchModuleName, searchModelName, expe
             #     hardCount = getCount(myModel, formset, False)
             #     if hardCount > 100:
             #         soft = False
-            results, hardCount, totalCount = queryLogic(myModel, formset,
-                                                        queryStart = queryStart,
-                                                        queryEnd = queryEnd,
-                                                        soft = soft, queryGenerator=queryGenerator)
-            # hardresults = getMatches(myModel,formsetToQD(formset),
-            #                          threshold=1.0,
-            #                          queryGenerator=queryGenerator)
-            # hardCount = hardresults.count()
-            # try:
-            #     hardCount = hardresults.count()
-            # except (AttributeError, TypeError):
-            #     hardCount = len(hardresults)
-
-            # if (hardCount <= 1E2) and soft:
-            #     results = getMatches(myModel,formsetToQD(formset),
-            #                          queryGenerator=queryGenerator)
-            #     try:
-            #         totalCount = results.count()
-            #     except (AttributeError, TypeError):
-            #         totalCount = len(results)
-            # else:
-            #     results = hardresults
-            #     totalCount = hardCount
-
-            # if (queryEnd is not None) and (queryStart is None):
-            #     results = results[0:queryEnd]
-            # elif (queryEnd is None) and (queryStart is not None):
-            #     results = results[queryStart:totalCount]
-            # elif (queryEnd is not None) and (queryStart is not None):
-            #     results = results[queryStart:queryEnd]
-
-            # results, totalCount, hardCount = getMatches(myModel,
-            #                                             formsetToQD(formset),
-            #                                             soft,
-            #                                             queryStart = queryStart,
-            #                                             queryEnd = queryEnd,
-            #                                             queryGenerator=queryGenerator)
-            pfs = [ f.name for f in modelFields(myModel) if isinstance(f,related.RelatedField) and not maskField(f) ]
-            try:
-                results = results.prefetch_related(*pfs)
-            except AttributeError:
-                pass # probably got list-ified
-            if totalCount:
-                results = list(results)
+            if (mode == 'csv'):
+                ## exports are expected to take a while; an empty file is no answer
+                seconds = exportDeadline(myModel)
             else:
-                ## saves time if this was an expensive query
-                ## we already know there are no results
+                seconds = searchDeadline(myModel)
+            try:
+                with deadline(seconds):
+                    ## taken first, so rows added while searching are picked up by a refresh
+                    watermark = searchWatermark(myModel, queryGenerator)
+                    results, hardCount, totalCount = searchPage(myModel, formset,
+                                                                queryStart = queryStart,
+                                                                queryEnd = queryEnd,
+                                                                soft = soft, queryGenerator=queryGenerator,
+                                                                notes=debug, fetchAll=(mode == 'csv'))
+                    if queryStart:
+                        more = queryStart + len(results) < totalCount
+            except Overloaded as e:
+                return overloadedResponse(e)
+            except SearchLimitExceeded as e:
+                if (mode == 'csv'):
+                    return HttpResponse(unicode(e), content_type='text/plain',
+                                        status=(504 if isinstance(e, SearchTimeout) else 400))
                 results = list()
-
-            if queryStart:
-                more = queryStart + len(results) < totalCount
+                debug.append(unicode(e))
         else:
             for formdex in range(0,len(formset.errors)):
                 for field, fielderrors in formset.errors[formdex].items():
@@ -1021,36 +1144,7 @@ def searchChosenModelCore(request, data, searchModuleName, searchModelName, expe
             response = HttpResponse(content_type=content_type)
             # if you want to download instead of display in browser
             response['Content-Disposition'] = 'attachment; filename='+ verbose_name(myModel) + '.csv'
-            writer = csv.writer(response)
-            writer.writerow([f.verbose_name for f in myFields])
-            for r in results:
-            ##            r.get(f.name,None)
-                ## writer.writerow([csvEncode(safegetattr(r, f.name, None)) for f in myFields ])
-                row = []
-                for f in myFields:
-                    val = xgds_data_extras.getattribute(r, f)
-                    if isinstance(f, models.ImageField):
-                        val = f.storage.url(val)
-                    elif isinstance(f, models.ManyToManyField):
-                        results = []
-                        for v in val:
-                            results.append(unicode(v))
-                        val = '"{0}"'.format(','.join(results))
-                    elif isinstance(val, basestring):
-                        pass
-                    elif isinstance(val, User):
-                        val = ', '.join([val.last_name, val.first_name])
-                    else:
-                        try:
-                            val = val()
-                        except TypeError:
-                            pass
-                        try:
-                            val = ', '.join(unicode(x) for x in val)
-                        except TypeError:
-                            pass
-                    row.append(val)
-                writer.writerow([csvEncode(x) for x in row ])
+            writeCsv(response, results, myFields)
 
 
         if logEnabled():
@@ -1116,6 +1210,7 @@ def searchChosenModelCore(request, data, searchModuleName, searchModelName, expe
                         'results': results,
                         'count': totalCount,
                         'exactCount': hardCount,
+                        'watermark': watermark,
                         'duration': total_seconds(datetime.datetime.now(pytz.utc) - starttime),
                         'page': page,
                         'pageSize': pageSize,
@@ -1242,19 +1337,7 @@ def jsonify(obj,level=2):
     return jsonifier(obj,level=level)
 
 
-def cleanQueryCache(timeout):
-    """
-    Remove entries exceeding timeout (in seconds)
-    """
-    curtime = datetime.datetime.now(pytz.utc)
-    timedout = []
-    for k,v in queryCache.iteritems():
-        if total_seconds(curtime - v[0]) > timeout:
-            timedout.append(k)
-    for k in timedout:
-        del queryCache[k]
-
-
+@readsFromReplica
 def getFieldValuesReal(request, searchModuleName, searchModelName, field,
                    soft=True,  queryGenerator=None):
     """
@@ -1266,7 +1349,7 @@ def getFieldValuesReal(request, searchModuleName, searchModelName, field,
     #modelmodule = __import__('.'.join([searchModuleName, 'models'])).models
     #myModel = getattr(modelmodule, searchModelName)
     myModel = resolveModel(searchModuleName, searchModelName)
-    myFields = [ x for x in modelFields(myModel) if not maskField(x) ]
+    myFields = list(visibleFields(myModel))
     tmpFormClass = SpecializedForm(SearchForm, myModel,
                                    queryGenerator=queryGenerator)
     tmpFormSet = formset_factory(tmpFormClass)
@@ -1283,21 +1366,19 @@ def getFieldValuesReal(request, searchModuleName, searchModelName, field,
     if formset.is_valid():
         pkName = pk(myModel).name
 
-        query, hardCount, totalCount = queryLogic(myModel, formset, soft = soft, queryGenerator=queryGenerator)
-        # if soft:
-        #     query = getMatches(myModel, formsetToQD(formset), queryGenerator=queryGenerator)
-        # else:
-        #     query = getMatches(myModel, formsetToQD(formset), threshold=1, queryGenerator=queryGenerator)
-
-        # print(str(objs.query))
-        ## need to turn into list, as a query will get re-values()'d.
-        qkey = str(query.query)
-        cleanQueryCache(300)
-        if (qkey in queryCache):
-            cachetime, objs = queryCache[qkey]
-        else:
-            objs = list(query)
-            queryCache[qkey] = (starttime, objs)
+        try:
+            with admitted(myModel, formsetToQD(formset), soft=soft, fetchAll=True):
+                query, hardCount, totalCount = queryLogic(myModel, formset, soft = soft, queryGenerator=queryGenerator)
+                # if soft:
+                #     query = getMatches(myModel, formsetToQD(formset), queryGenerator=queryGenerator)
+                # else:
+                #     query = getMatches(myModel, formsetToQD(formset), threshold=1, queryGenerator=queryGenerator)
+
+                # print(str(objs.query))
+                ## need to turn into list, as a query will get re-values()'d.
+                objs = queryCache.getOrCompute(str(query.query), lambda: list(query))
+        except Overloaded as e:
+            return overloadedResponse(e)
 
         if myField is None:
             dbobjs = [(pkValue(x), str(x)) for x in objs]
@@ -1354,6 +1435,403 @@ def getFieldValues(request, searchModuleName, searchModelName, field,
     except Exception:
         traceback.print_exc()
 
+@readsFromReplica
+def getApproxCount(request, searchModuleName, searchModelName, soft=True):
+    """
+    "About N results" preview for a search, estimated from the stored sample
+    without querying the table
+    """
+    myModel = resolveModel(searchModuleName, searchModelName)
+    tmpFormClass = SpecializedForm(SearchForm, myModel)
+    tmpFormSet = formset_factory(tmpFormClass)
+    data = PostGet(request)
+    soft = soft not in (False, 'False', 'exact')
+
+    try:
+        formset = tmpFormSet(data)
+        valid = formset.is_valid()
+    except ValidationError:
+        valid = False
+
+    if valid:
+        result = {'count': estimateMatches(myModel, formsetToQD(formset), soft=soft),
+                  'approximate': True}
+    else:
+        result = {'count': None, 'approximate': True}
+
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
+@readsFromReplica
+def refreshSearch(request, searchModuleName, searchModelName, soft=True,
+                  queryGenerator=None):
+    """
+    Bring an open search up to date by looking only at rows added since
+    its watermark. Takes the search form data plus 'watermark', 'pageSize'
+    and optionally 'top', the client's current results as a JSON list of
+    [fullid, score]. Returns the new rows that make the top pageSize, the
+    merged top list, the count changes and the new watermark. With a time
+    watermark the counts include any matches stamped at the old watermark.
+    As in queryLogic, the search is only soft while there are at most 100
+    exact matches in all: 'exactCount', the client's current exact count,
+    saves counting them again. A primary key watermark misses rows whose
+    insert committed after a row with a higher key was seen (see
+    search.sinceWatermark).
+    """
+    myModel = resolveModel(searchModuleName, searchModelName)
+    tmpFormSet = formset_factory(SpecializedForm(SearchForm, myModel,
+                                                 queryGenerator=queryGenerator))
+    data = PostGet(request)
+    soft = soft not in (False, 'False', 'exact')
+    try:
+        watermark = float(data['watermark'])
+        pageSize = int(data.get('pageSize', 25))
+        top = [(fid, score) for fid, score in json.loads(data.get('top', '[]'))]
+        exactCount = data.get('exactCount')
+        if exactCount not in (None, ''):
+            exactCount = int(exactCount)
+        else:
+            exactCount = None
+    except (KeyError, ValueError, TypeError):
+        return jsonResponse({'error': 'need a numeric watermark and exactCount, and a valid top list'},
+                            status=400)
+    try:
+        formset = tmpFormSet(data)
+        valid = formset.is_valid()
+    except ValidationError:
+        valid = False
+    if not valid:
+        return jsonResponse({'error': jsonify(formset.errors)}, status=400)
+
+    try:
+        with deadline(searchDeadline(myModel)):
+            newWatermark = searchWatermark(myModel, queryGenerator)
+            hardresults, softresults = refreshMatches(myModel, formsetToQD(formset), watermark,
+                                                      soft=False, queryGenerator=queryGenerator)
+            hardDelta = resultCount(hardresults)
+            if soft:
+                ## the same rule as queryLogic, on the exact count including the new rows
+                if exactCount is None:
+                    hardCount = resultCount(guardCost(myModel,
+                                                      getMatches(myModel, formsetToQD(formset), threshold=1.0,
+                                                                 queryGenerator=queryGenerator)))
+                else:
+                    hardCount = exactCount + hardDelta
+                soft = hardCount <= SOFT_LIMIT
+            if soft:
+                hardresults, softresults = refreshMatches(myModel, formsetToQD(formset), watermark,
+                                                          soft=True, queryGenerator=queryGenerator)
+            if softresults is None:
+                newresults = hardresults
+                countDelta = hardDelta
+            else:
+                newresults = softresults
+                countDelta = resultCount(softresults)
+            ## only the best pageSize new rows can make the top list, besides
+            ## rows at a time watermark that are already in it
+            newresults = list(newresults[:pageSize + len(top)])
+    except SearchLimitExceeded as e:
+        return jsonResponse({'error': unicode(e)}, status=503)
+
+    seen = set([fid for fid, score in top])
+    newresults = [r for r in newresults if fullid(r) not in seen][:pageSize]
+
+    merged = mergeTop(top, [(fullid(r), getattr(r, 'score', None)) for r in newresults], pageSize)
+    keep = set([fid for fid, score in merged])
+    return jsonResponse({'watermark': newWatermark if newWatermark is not None else watermark,
+                         'soft': soft,
+                         'countDelta': countDelta,
+                         'exactCountDelta': hardDelta,
+                         'top': merged,
+                         'results': [dict(jsonify(r), fullid=fullid(r), score=getattr(r, 'score', None))
+                                     for r in newresults if fullid(r) in keep]})
+
+
+def batchWorkers():
+    try:
+        return settings.XGDS_DATA_BATCH_WORKERS
+    except AttributeError:
+        return 4
+
+
+@readsFromReplica
+def runBatchSearch(job):
+    """
+    One search of a batch, run on a worker thread
+    """
+    myModel, formset, soft, queryStart, queryEnd = job
+    notes = []
+    try:
+        with deadline(searchDeadline(myModel)):
+            results, hardCount, totalCount = searchPage(myModel, formset,
+                                                        queryStart=queryStart,
+                                                        queryEnd=queryEnd,
+                                                        soft=soft, notes=notes)
+            return {'count': totalCount,
+                    'exactCount': hardCount,
+                    'notes': notes,
+                    'results': [dict(jsonify(r), fullid=fullid(r), score=getattr(r, 'score', None))
+                                for r in results]}
+    except Exception as e:
+        return {'error': unicode(e)}
+    finally:
+        ## each thread has its own connections; don't leave them open
+        closeConnections()
+
+
+def batchSearch(request):
+    """
+    Run several searches in one request. The body (or the 'searches'
+    parameter) is a JSON list of {"module", "model", "data", "soft",
+    "page", "pageSize"}, where data is the formset data of a search form.
+    An entry that isn't a valid search gets an error and status 400 in
+    place of its results. Form classes are built once per model and the searches run on a
+    bounded thread pool (XGDS_DATA_BATCH_WORKERS); the response lists the
+    results in the same order.
+    """
+    starttime = datetime.datetime.now(pytz.utc)
+    reqlog = recordRequest(request)
+    try:
+        specs = PostGet(request).get('searches')
+        if specs is None:
+            specs = request.body
+        specs = json.loads(specs)
+        assert isinstance(specs, list)
+    except (ValueError, AssertionError):
+        return HttpResponse(json.dumps({'error': 'expected a JSON list of searches'}),
+                            content_type='application/json', status=400)
+
+    formsetClasses = dict()
+    jobs = []
+    responses = []
+    for spec in specs:
+        ## bad entries get their own error, with the status they would have had alone
+        if not isinstance(spec, dict):
+            responses.append({'error': 'expected a JSON object', 'status': 400})
+            continue
+        response = {'module': spec.get('module'), 'model': spec.get('model')}
+        responses.append(response)
+        try:
+            myModel = resolveModel(spec['module'], spec['model'])
+        except (KeyError, LookupError, TypeError, AttributeError):
+            response.update(error='unknown model', status=400)
+            continue
+        if not isinstance(spec.get('data', {}), dict):
+            response.update(error='data must be a JSON object', status=400)
+            continue
+        try:
+            page = int(spec.get('page', 1))
+            pageSize = int(spec.get('pageSize', 25))
+            assert (page >= 1) and (pageSize >= 1)
+        except (ValueError, TypeError, AssertionError):
+            response.update(error='page and pageSize must be positive integers', status=400)
+            continue
+        if myModel not in formsetClasses:
+            formsetClasses[myModel] = formset_factory(SpecializedForm(SearchForm, myModel), extra=0)
+        data = QueryDict('', mutable=True)
+        for k, v in spec.get('data', {}).items():
+            if isinstance(v, (list, tuple)):
+                data.setlist(k, [unicode(x) for x in v])
+            else:
+                data[k] = unicode(v)
+        formset = formsetClasses[myModel](data)
+        try:
+            valid = formset.is_valid()
+        except ValidationError:
+            valid = False
+        if not valid:
+            response.update(error=jsonify(formset.errors), status=400)
+            continue
+        queryStart, queryEnd = pageLimits(page, pageSize)
+        soft = spec.get('soft', True) not in (False, 'False', 'exact')
+        jobs.append((response, (myModel, formset, soft, queryStart, queryEnd)))
+
+    if jobs:
+        pool = ThreadPool(min(batchWorkers(), len(jobs)))
+        try:
+            outcomes = pool.map(runBatchSearch, [job for response, job in jobs])
+        finally:
+            pool.close()
+        for (response, job), outcome in zip(jobs, outcomes):
+            response.update(outcome)
+
+    result = {'searches': responses,
+              'duration': total_seconds(datetime.datetime.now(pytz.utc) - starttime)}
+    return HttpResponse(json.dumps(result, default=jsonify), content_type='application/json')
+
+
+def jsonResponse(result, status=200):
+    return HttpResponse(json.dumps(result, default=jsonify), content_type='application/json',
+                        status=status)
+
+
+def submitSearchJob(request, searchModuleName, searchModelName, kind='search'):
+    """
+    Queue a search ('search') or export ('csv', 'csvhard') from the
+    search form data and return its job id
+    """
+    myModel = resolveModel(searchModuleName, searchModelName)
+    if kind not in jobs.KINDS:
+        return jsonResponse({'error': 'unknown job kind %s' % kind}, status=400)
+    tmpFormSet = formset_factory(SpecializedForm(SearchForm, myModel))
+    data = PostGet(request)
+    try:
+        formset = tmpFormSet(data)
+        valid = formset.is_valid()
+    except ValidationError:
+        valid = False
+    if not valid:
+        return jsonResponse({'error': jsonify(formset.errors)}, status=400)
+    try:
+        user = request.user.username or None
+    except AttributeError:
+        user = None
+    jobId = jobs.submitJob(kind, myModel, formset, user=user)
+    return jsonResponse({'job': jobId,
+                         'status': reverse('xgds_data_jobStatus', args=[jobId])})
+
+
+def jobStatus(request, jobId):
+    """
+    State, row counts and timing of a job
+    """
+    status = jobs.readStatus(jobId)
+    if status is None:
+        return jsonResponse({'error': 'no such job'}, status=404)
+    status.pop('trace', None)
+    return jsonResponse(status)
+
+
+def cancelJob(request, jobId):
+    """
+    Stop a queued or running job
+    """
+    return jsonResponse({'job': jobId, 'cancelled': jobs.cancelJob(jobId)})
+
+
+def jobResults(request, jobId):
+    """
+    A page of the stored results of a finished search job
+    """
+    data = PostGet(request)
+    try:
+        page = int(data.get('pageno', 1))
+        pageSize = int(data.get('pageSize', 25))
+        assert (page >= 1) and (pageSize >= 1)
+    except (ValueError, TypeError, AssertionError):
+        return jsonResponse({'error': 'pageno and pageSize must be positive integers'}, status=400)
+    queryStart, queryEnd = pageLimits(page, pageSize)
+    status = jobs.readStatus(jobId)
+    records = jobs.jobResults(jobId, queryStart, queryEnd)
+    if (status is None) or (records is None):
+        return jsonResponse({'error': 'no results for this job'}, status=404)
+    return jsonResponse({'job': jobId,
+                         'state': status.get('state'),
+                         'count': status.get('rows'),
+                         'page': page,
+                         'pageSize': pageSize,
+                         'results': records})
+
+
+def jobDownload(request, jobId):
+    """
+    The export file of a finished export job
+    """
+    status = jobs.readStatus(jobId)
+    if (status is None) or (status.get('state') != 'done') or not status.get('filename'):
+        return jsonResponse({'error': 'no export for this job'}, status=404)
+    response = HttpResponse(open(jobs.jobPath(jobId, status['filename']), 'rb'),
+                            content_type=status.get('contentType', 'text/csv'))
+    response['Content-Disposition'] = 'attachment; filename=' + status['model'] + '.csv'
+    return response
+
+
+def standingQueryJson(standing):
+    return {'id': standing.pk,
+            'name': standing.name,
+            'model': standing.model,
+            'user': standing.user.username if standing.user else None,
+            'soft': standing.soft,
+            'threshold': standing.threshold,
+            'active': standing.active,
+            'created': standing.created,
+            'hits': reverse('xgds_data_standingQueryHits', args=[standing.pk])}
+
+
+def createStandingQuery(request, searchModuleName, searchModelName, soft=True):
+    """
+    Register the posted search form data as a standing query, checked
+    against every new row of the model. Takes 'name' and optionally 'threshold'.
+    """
+    myModel = resolveModel(searchModuleName, searchModelName)
+    tmpFormSet = formset_factory(SpecializedForm(SearchForm, myModel))
+    data = PostGet(request)
+    soft = soft not in (False, 'False', 'exact')
+    try:
+        formset = tmpFormSet(data)
+        valid = formset.is_valid()
+    except ValidationError:
+        valid = False
+    if not valid:
+        return jsonResponse({'error': jsonify(formset.errors)}, status=400)
+    name = data.get('name')
+    if not name:
+        return jsonResponse({'error': 'a standing query needs a name'}, status=400)
+    try:
+        threshold = float(data['threshold']) if data.get('threshold') else None
+    except ValueError:
+        return jsonResponse({'error': 'threshold must be a number'}, status=400)
+    formData = dict([(k, v) for k, v in data.lists()
+                     if k not in ('name', 'threshold', 'csrfmiddlewaretoken')])
+    user = request.user if request.user.is_authenticated() else None
+    standing = StandingQuery.objects.create(name=name, model=qualifiedModelName(myModel),
+                                            user=user, data=json.dumps(formData),
+                                            soft=soft, threshold=threshold)
+    return jsonResponse(standingQueryJson(standing))
+
+
+def listStandingQueries(request):
+    """
+    The active standing queries, optionally only those of 'model' (a qualified model name)
+    """
+    data = PostGet(request)
+    queries = StandingQuery.objects.filter(active=True).order_by('pk')
+    if data.get('model'):
+        queries = queries.filter(model=data['model'])
+    return jsonResponse({'queries': [standingQueryJson(q) for q in queries]})
+
+
+def cancelStandingQuery(request, queryId):
+    """
+    Stop checking new rows against a standing query; its hits are kept
+    """
+    updated = StandingQuery.objects.filter(pk=queryId).update(active=False)
+    invalidateStandingQueries()
+    return jsonResponse({'id': int(queryId), 'cancelled': updated > 0})
+
+
+def standingQueryHits(request, queryId):
+    """
+    Hits of a standing query recorded after hit id 'since', oldest first,
+    at most 'limit' of them. Poll with the last id returned.
+    """
+    try:
+        standing = StandingQuery.objects.get(pk=queryId)
+    except StandingQuery.DoesNotExist:
+        return jsonResponse({'error': 'no such standing query'}, status=404)
+    data = PostGet(request)
+    try:
+        since = int(data.get('since', 0))
+        limit = int(data.get('limit', 1000))
+    except ValueError:
+        return jsonResponse({'error': 'since and limit must be integers'}, status=400)
+    hits = list(standing.hits.filter(pk__gt=since).order_by('pk')[:limit])
+    return jsonResponse({'id': standing.pk,
+                         'since': hits[-1].pk if hits else since,
+                         'hits': [{'id': h.pk, 'fullid': h.fullid, 'score': h.score,
+                                   'recorded': h.recorded} for h in hits]})
+
+
 ## queryGenerator is presumably irrelvant here because we aren't querying
 ## yet, just doing a form validation
 def plotQueryResults(request, searchModuleName, searchModelName,
@@ -1367,7 +1845,7 @@ def plotQueryResults(request, searchModuleName, searchModelName,
     #modelmodule = __import__('.'.join([searchModuleName, 'models'])).models
     #myModel = getattr(modelmodule, searchModelName)
     myModel = resolveModel(searchModuleName, searchModelName)
-    myFields = [ x for x in modelFields(myModel) if not maskField(x) ]
+    myFields = list(visibleFields(myModel))
     tmpFormClass = SpecializedForm(SearchForm, myModel)
     tmpFormSet = formset_factory(tmpFormClass)
     data = PostGet(request)
@@ -1473,7 +1951,7 @@ def editCollection(request, rid):
     reqlog = recordRequest(request)
     myModel = resolveModel(editModuleName, editModelName)
     tmpFormClass = SpecializedForm(EditForm, myModel)
-    myFields = [x for x in modelFields(myModel) if not maskField(x) ]
+    myFields = list(visibleFields(myModel))
     record = myModel.objects.get(pk=rid)
     data = PostGet(request)
     retformat = data.get('format', 'html')
@@ -0,0 +1,163 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2015, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The xGDS platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+
+
+"""
+Warming up a worker before it serves searches.
+
+Much of what a search needs is worked out on first use, in each worker:
+the model registry, accessor dicts, through models, table and field size
+estimates, the plot axes choices and the search form fields (including
+which relations get pulldowns). warmUp does all of that for every
+searchable model, timing the imports of the search modules
+(XGDS_DATA_WARMUP_MODULES) and the warm-up of each app's models, and
+stops starting new models once XGDS_DATA_WARMUP_BUDGET seconds are spent.
+
+What is worked out lives in the process that does it. To warm the
+workers themselves, set XGDS_DATA_WARMUP_ON_READY so each runs warmUp at
+app ready. ./manage.py xgds_data_warmup runs it in a process of its own,
+which only measures the timings and, with XGDS_DATA_SHARED_STATISTICS and
+a shared cache (XGDS_DATA_SINGLE_FLIGHT_CACHE), pre-seeds the table and
+field size estimates there. Those estimates are all the pulldown and plot
+series decisions need, so workers then build their forms without counting
+rows; the registry and the forms themselves are still built in each worker.
+"""
+
+import time
+import importlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import DatabaseError
+
+from xgds_data.introspection import (buildRegistry, searchableModels, moduleName,
+                                     accessorDict, visibleFields, modelFields,
+                                     isAbstract)
+from xgds_data.models import VirtualIncludedField
+
+
+def warmUpOnReady():
+    return getattr(settings, 'XGDS_DATA_WARMUP_ON_READY', False)
+
+
+def warmUpBudget():
+    return getattr(settings, 'XGDS_DATA_WARMUP_BUDGET', None)
+
+
+def warmUpModules():
+    return getattr(settings, 'XGDS_DATA_WARMUP_MODULES',
+                   ['xgds_data.search', 'xgds_data.forms', 'xgds_data.views'])
+
+
+def timeImports(names):
+    """
+    OrderedDict of module name -> seconds to import it (about 0 if it already was)
+    """
+    timings = OrderedDict()
+    for name in names:
+        start = time.time()
+        importlib.import_module(name)
+        timings[name] = time.time() - start
+    return timings
+
+
+def warmModel(model):
+    """
+    Work out what searches on this model will need; OrderedDict of step -> seconds
+    """
+    ## imported here so that timeImports measures their import
+    from xgds_data.DataStatistics import tableSize
+    from xgds_data.forms import axesFieldChoices, searchFormSchema
+
+    timings = OrderedDict()
+
+    def step(name, fn):
+        start = time.time()
+        fn()
+        timings[name] = time.time() - start
+
+    def through():
+        for f in modelFields(model):
+            if isinstance(f, VirtualIncludedField):
+                f.targetFields()
+
+    step('registry', lambda: accessorDict(model))
+    step('through', through)
+    step('statistics', lambda: (tableSize(model), axesFieldChoices(list(visibleFields(model)))))
+    step('form', lambda: searchFormSchema(model))
+    return timings
+
+
+def warmUp(models=None, budget=None, log=None):
+    """
+    Warm up the models (every searchable one by default), within budget seconds
+    if given. Returns (import timings, OrderedDict of app -> seconds, models skipped).
+    """
+    start = time.time()
+    imports = timeImports(warmUpModules())
+    buildRegistry()
+    if models is None:
+        models = searchableModels()
+    apps = OrderedDict()
+    skipped = []
+    for m in models:
+        if isAbstract(m):
+            continue
+        if (budget is not None) and (time.time() - start > budget):
+            skipped.append(m)
+            continue
+        app = moduleName(m)
+        try:
+            timings = warmModel(m)
+        except DatabaseError as inst:
+            ## tables not made yet, say before a migrate
+            if log:
+                log('%s.%s: skipped (%s)' % (app, m.__name__, inst))
+            continue
+        apps[app] = apps.get(app, 0) + sum(timings.values())
+        if log:
+            log('%s.%s: %.2fs (%s)' % (app, m.__name__, sum(timings.values()),
+                                       ', '.join(['%s %.2f' % kv for kv in timings.iteritems()])))
+    return (imports, apps, skipped)
+
+
+def report(imports, apps, skipped, budget=None):
+    """
+    Lines summarizing a warm-up
+    """
+    lines = ['import %s: %.2fs' % kv for kv in imports.iteritems()]
+    lines.extend(['warm %s: %.2fs' % kv for kv in apps.iteritems()])
+    total = sum(imports.values()) + sum(apps.values())
+    line = 'total: %.2fs' % total
+    if budget is not None:
+        line = '%s of a %.2fs budget' % (line, budget)
+    lines.append(line)
+    if skipped:
+        lines.append('out of time, skipped %d models: %s' %
+                     (len(skipped), ', '.join([m.__name__ for m in skipped])))
+    return lines
+
+
+def readyWarmUp():
+    """
+    The warm-up at app ready, if XGDS_DATA_WARMUP_ON_READY is set
+    """
+    if not warmUpOnReady():
+        return
+    budget = warmUpBudget()
+    for line in report(*warmUp(budget=budget), budget=budget):
+        print('xgds_data warm-up ' + line)